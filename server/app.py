@@ -1,17 +1,41 @@
+import hmac
 import json
+import math
+import mmap
+import os
+import secrets
+import tempfile
+import threading
+import time
+import uuid
 from io import BytesIO
 from typing import cast
 
-from flask import Flask, Response, request, send_file
+from flask import Flask, Response, g, request, send_file
 from flask_cors import CORS
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError, NoResultFound
 
 from app_logging import DEBUG, LOGGER, init_logging
-from configure import CONFIG
+import metrics
+import resilience
+import sql_profiler
+from configure import CONFIG, DIRS
+from sampling_profiler import SamplingProfiler, profile_for
+from image_processing import ImageOptimizer
 from receipt import Receipt, Tag
+from compression import FastJSONProvider, compress_response, orjson
+from events import Broker, get_broker
+from reconcile import DeferredDeletes, PeriodicReconcile
+from response_cache import ResponseCache
 from storage_hooks.hook_config_factory import get_file_hook, get_meta_hook
-
-init_logging(local_level=DEBUG)
+from storage_hooks.storage_hooks import (
+    DatabaseHook,
+    InvalidUploadError,
+    UploadOffsetError,
+    track_client,
+    untrack_client,
+)
+from storage_hooks.tiered import TieredHook
 
 
 def error_response(status: int, error_name: str, error_message: str) -> Response:
@@ -41,22 +65,479 @@ def response_code(status: int) -> Response:
     return Response("", status=status, mimetype="application/json")
 
 
+def init_metrics(app: Flask):
+    """Records request metrics and serves them at /metrics
+
+    Must be registered before any after_request function that changes the body
+    (such as compression), since those run in reverse order of registration.
+    """
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response: Response) -> Response:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        if (start := g.pop("request_start", None)) is not None:
+            metrics.HTTP_LATENCY.observe(
+                time.perf_counter() - start, route, request.method
+            )
+        metrics.HTTP_REQUESTS.inc(route, request.method, str(response.status_code))
+        if request.content_length:
+            metrics.HTTP_BYTES.inc(route, "in", amount=request.content_length)
+        if not response.is_streamed and response.content_length:
+            metrics.HTTP_BYTES.inc(route, "out", amount=response.content_length)
+        return response
+
+    @app.route("/metrics")
+    def serve_metrics():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_sql_profiling(app: Flask, meta_hook):
+    """Reports the SQL statements run by each request in a Server-Timing header"""
+    for engine in meta_hook.engines:
+        sql_profiler.attach(engine)
+
+    @app.before_request
+    def track_queries():
+        g.sql_stats = sql_profiler.track()
+
+    @app.after_request
+    def report_queries(response: Response) -> Response:
+        if (stats := g.pop("sql_stats", None)) is None:
+            return response
+        response.headers.add("Server-Timing", stats.server_timing())
+        budget = CONFIG.Profiling.query_budget
+        if budget is not None and stats.count > budget:
+            LOGGER.warning(
+                "%s %s ran %d SQL statements (budget %d)",
+                request.method,
+                request.path,
+                stats.count,
+                budget,
+            )
+        return response
+
+    @app.teardown_request
+    def stop_tracking(_exc):
+        sql_profiler.stop()
+
+
+def init_sampling_profiler(app: Flask):
+    """Serves the sampling profiler behind Profiling.sampling_token
+
+    ``GET /debug/profile?seconds=N`` samples every thread of this worker for N
+    seconds. A request with the token in an ``X-Profile`` header is profiled on
+    its own; the result is saved and its id returned in ``X-Profile-Id`` for
+    ``GET /debug/profile/<id>``. Results are in the folded flame graph format.
+    """
+    config = CONFIG.Profiling
+    interval = config.sampling_interval_ms / 1000
+    # Shared between the workers on a machine, unlike memory
+    profile_dir = os.path.join(DIRS.user_log_dir, "profiles")
+    keep_profiles = 50
+
+    def authorized(token: str | None) -> bool:
+        return token is not None and hmac.compare_digest(
+            token.encode(), cast(str, config.sampling_token).encode()
+        )
+
+    def unauthorized() -> Response:
+        return error_response(
+            401, "Unauthorized", "A valid profiling token is required"
+        )
+
+    @app.route("/debug/profile")
+    def profile_worker():
+        if not authorized(request.authorization and request.authorization.token):
+            return unauthorized()
+        seconds = min(
+            request.args.get("seconds", 10, type=float), config.sampling_max_seconds
+        )
+        LOGGER.info("Profiling worker %d for %.1f seconds", os.getpid(), seconds)
+        profiler = profile_for(seconds, interval)
+        return Response(profiler.folded(), mimetype="text/plain")
+
+    @app.route("/debug/profile/<profile_id>")
+    def fetch_profile(profile_id: str):
+        if not authorized(request.authorization and request.authorization.token):
+            return unauthorized()
+        try:
+            profile_id = uuid.UUID(profile_id).hex
+        except ValueError:
+            return response_code(404)
+        with open(os.path.join(profile_dir, f"{profile_id}.folded")) as file:
+            return Response(file.read(), mimetype="text/plain")
+
+    @app.before_request
+    def start_request_profile():
+        if authorized(request.headers.get("X-Profile")):
+            g.request_profiler = SamplingProfiler(interval, [threading.get_ident()])
+            g.request_profiler.start()
+
+    @app.after_request
+    def save_request_profile(response: Response) -> Response:
+        if (profiler := g.pop("request_profiler", None)) is None:
+            return response
+        profile_id = uuid.uuid4().hex
+        os.makedirs(profile_dir, exist_ok=True)
+        with open(os.path.join(profile_dir, f"{profile_id}.folded"), "w") as file:
+            file.write(profiler.stop().folded())
+
+        saved = sorted(
+            os.scandir(profile_dir), key=lambda e: e.stat().st_mtime, reverse=True
+        )
+        for entry in saved[keep_profiles:]:
+            os.remove(entry.path)
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+
+def init_read_your_writes(app: Flask, meta_hook: DatabaseHook):
+    """Sends each client's reads to the primary shortly after its writes
+
+    The time of a client's last write is returned in a signed Last-Write
+    cookie and header, which it sends back with later requests (to any worker).
+    See ``storage_hooks.ClientWrites``.
+
+    Must be registered before init_unit_of_work, whose commit happens in an
+    after_request function that has to run first.
+    """
+    key = app.secret_key.encode() if isinstance(app.secret_key, str) else b""
+
+    def sign(last_write: str) -> str:
+        digest = hmac.new(key, last_write.encode(), "sha256").hexdigest()
+        return f"{last_write}.{digest[:32]}"
+
+    def verify(token: str) -> float:
+        last_write, _, digest = token.rpartition(".")
+        if not hmac.compare_digest(sign(last_write), token):
+            return 0.0
+        try:
+            return float(last_write)
+        except ValueError:
+            return 0.0
+
+    @app.before_request
+    def track_writes():
+        token = request.headers.get("Last-Write") or request.cookies.get(
+            "last_write", ""
+        )
+        last_write = verify(token) if token else 0.0
+        g.client_writes, g.client_token = track_client(last_write)
+        g.client_last_write = last_write
+
+    @app.after_request
+    def report_writes(response: Response) -> Response:
+        client = g.get("client_writes")
+        if client is not None and client.last_write > g.client_last_write:
+            token = sign(f"{client.last_write:.3f}")
+            response.headers["Last-Write"] = token
+            response.set_cookie(
+                "last_write",
+                token,
+                max_age=math.ceil(meta_hook.sticky_seconds),
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
+
+    @app.teardown_request
+    def stop_tracking_writes(_e):
+        if (token := g.pop("client_token", None)) is not None:
+            untrack_client(token)
+
+
+def init_unit_of_work(app: Flask, meta_hook: DatabaseHook):
+    """Runs the database calls of each write request in one transaction
+
+    The session is opened on first use and committed once the response is
+    ready, or rolled back if the request failed. Reads (GET) keep a session
+    per call, so they can still be served by replicas.
+    """
+
+    @app.before_request
+    def begin_unit_of_work():
+        if request.method not in ("GET", "HEAD", "OPTIONS"):
+            g.unit_of_work = meta_hook.begin()
+
+    @app.after_request
+    def finish_unit_of_work(response: Response) -> Response:
+        if (unit := g.pop("unit_of_work", None)) is not None:
+            unit.finish(commit=response.status_code < 400)
+        return response
+
+    @app.teardown_request
+    def abort_unit_of_work(_e):
+        # The request raised before after_request could finish it
+        if (unit := g.pop("unit_of_work", None)) is not None:
+            unit.finish(commit=False)
+
+
+def init_events(app: Flask, meta_hook: DatabaseHook) -> Broker:
+    """Publishes committed changes and streams them at /api/events
+
+    Each stream holds a request thread until it ends after
+    ``Events.stream_seconds``, so the number per worker is limited.
+
+    Returns:
+        The broker events are published to
+    """
+    config = CONFIG.Events
+    broker = get_broker(config.broker or "Local", meta_hook)
+    meta_hook.change_listeners.append(
+        lambda kind, action, id_: broker.publish(kind, {"action": action, "id": id_})
+    )
+    streams = threading.BoundedSemaphore(
+        config.max_streams or max(1, CONFIG.Server.threads // 2)
+    )
+
+    @app.route("/api/events")
+    def stream_events():
+        """API Endpoint streaming receipt and tag changes as server-sent events"""
+        if not streams.acquire(blocking=False):
+            response = error_response(
+                503, "Too Many Streams", "No stream is free, poll /api/sync instead"
+            )
+            response.headers["Retry-After"] = str(math.ceil(config.heartbeat_seconds))
+            return response
+
+        # Browsers send Last-Event-ID when reconnecting on their own
+        last_id = request.headers.get("Last-Event-ID") or request.args.get("last_id")
+        subscription = broker.subscribe(last_id)
+
+        def generate():
+            deadline = time.monotonic() + config.stream_seconds
+            yield ": connected\n\n"  # Sends the headers straight away
+            while (remaining := deadline - time.monotonic()) > 0:
+                events = subscription.get(min(config.heartbeat_seconds, remaining))
+                if not events:
+                    yield ": keepalive\n\n"  # Also detects gone clients
+                for event in events:
+                    yield (
+                        f"id: {event.id}\nevent: {event.kind}\n"
+                        f"data: {json.dumps(event.data)}\n\n"
+                    )
+
+        def release():
+            subscription.close()
+            streams.release()
+
+        response = Response(
+            generate(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        # Called by the server even if the stream never started
+        response.call_on_close(release)
+        return response
+
+    return broker
+
+
+def init_resilience(*hooks):
+    """Gives each hook a circuit breaker, and remote ones timeouts and hedging
+
+    Args:
+        hooks: FileHooks and DatabaseHooks. A TieredHook's cold hook is
+            protected as well, as it is the one that can be slow.
+    """
+    config = CONFIG.Resilience
+    hooks += tuple(hook.cold for hook in hooks if isinstance(hook, TieredHook))
+    for hook in hooks:
+        name = type(hook).__name__
+        if isinstance(hook, DatabaseHook):
+            timeout = config.meta_timeout
+            expected = resilience.EXPECTED_ERRORS + (NoResultFound, IntegrityError)
+        else:
+            timeout = config.file_timeout
+            expected = resilience.EXPECTED_ERRORS
+        guard = resilience.Guard(
+            name,
+            resilience.CircuitBreaker(
+                name, config.failure_threshold, config.reset_seconds
+            ),
+            timeout=timeout if hook.remote else None,
+            hedge_percentile=config.hedge_percentile if hook.remote else None,
+            hedge_min_delay=config.hedge_min_delay,
+            workers=config.workers,
+            expected=expected,
+        )
+        resilience.protect(hook, guard)
+
+
+def after_fork(app: Flask):
+    """Prepares an app created before forking for use in the new process
+
+    The storage hooks' connection pools and clients are recreated, as sharing
+    them between processes corrupts connections.
+    """
+    for resource in app.extensions["receipt_database"].values():
+        if resource is not None:
+            resource.after_fork()
+
+
 def create_app(file_hook=None, meta_hook=None):
+    init_logging()
+
     if file_hook is None:
         file_hook = get_file_hook(CONFIG.StorageHooks.file_hook)
 
     if meta_hook is None:
         meta_hook = get_meta_hook(CONFIG.StorageHooks.meta_hook)
 
-    LOGGER.info(f"Starting flask app: {__name__}")
+    if isinstance(file_hook, TieredHook):
+        # Receipts are mostly read shortly after upload, so start with the newest
+        file_hook.warm(
+            lambda: [
+                r.storage_key
+                for r in meta_hook.fetch_receipt_rows(limit=CONFIG.Tiered.warm_count)
+            ]
+        )
+
+    LOGGER.info("Starting flask app: %s", __name__)
     app = Flask(__name__)
     CORS(app)
+    if CONFIG.Responses.fast_json and orjson is not None:
+        app.json = FastJSONProvider(app)
+    if CONFIG.Metrics.enabled:
+        init_metrics(app)
+    if CONFIG.Profiling.server_timing:
+        init_sql_profiling(app, meta_hook)
+    if CONFIG.Profiling.sampling_token:
+        init_sampling_profiler(app)
+    app.after_request(compress_response)
+    if CONFIG.Resilience.enabled:
+        init_resilience(file_hook, meta_hook)
+
+    optimizer = ImageOptimizer() if CONFIG.Ingest.optimize else None
+    deferred_deletes = DeferredDeletes(
+        meta_hook, file_hook, CONFIG.StorageHooks.delete_delay_seconds
+    )
+    reconcile_config = CONFIG.Reconcile
+    periodic_reconcile = PeriodicReconcile(
+        meta_hook,
+        file_hook,
+        reconcile_config.interval_seconds,
+        reconcile_config.lock_path
+        or os.path.join(tempfile.gettempdir(), "receipt-reconcile.lock"),
+        delete=reconcile_config.delete,
+        grace_seconds=reconcile_config.grace_hours * 60 * 60,
+    )
+    # Process specific resources, see after_fork
+    app.extensions["receipt_database"] = {
+        "file_hook": file_hook,
+        "meta_hook": meta_hook,
+        "optimizer": optimizer,
+        "deferred_deletes": deferred_deletes,
+        "periodic_reconcile": periodic_reconcile,
+    }
+    # Started by a request, so not in a preloading master, which only forks
+    app.before_request(periodic_reconcile.start)
+
+    # Workers forked from a preloading master share a generated key
+    app.secret_key = CONFIG.Server.secret_key or secrets.token_hex(32)
+    if meta_hook.sticky_seconds > 0:
+        init_read_your_writes(app, meta_hook)
+    if CONFIG.StorageHooks.request_transactions:
+        init_unit_of_work(app, meta_hook)
+    if CONFIG.Events.enabled:
+        app.extensions["receipt_database"]["broker"] = init_events(app, meta_hook)
+
+    responses = CONFIG.Responses
+    if responses.cache_lists:
+        list_cache = ResponseCache(
+            meta_hook.generations, responses.cache_entries, responses.cache_seconds
+        )
+        app.extensions["response_cache"] = list_cache
+        cached = list_cache.cached
+    else:
+
+        def cached(*_tables: str):
+            return lambda view: view
+
+    def ingest(im_bytes: bytes, filename: str) -> tuple[str, str | None]:
+        """Stores an uploaded image, optimizing it first if configured
+
+        Args:
+            im_bytes: The uploaded image
+            filename: The uploaded filename
+
+        Returns:
+            The storage key, and the key of the kept original image (if any)
+        """
+        original_key = None
+        if optimizer is not None and (
+            optimized := optimizer.optimize(im_bytes, filename)
+        ):
+            if CONFIG.Ingest.keep_original:
+                original_key = file_hook.save(im_bytes, filename)
+            im_bytes, filename = optimized
+        return file_hook.save(im_bytes, filename), original_key
+
+    def ingest_staged(storage_key: str) -> tuple[str, str | None]:
+        """Like ingest, for an image the file hook already stored
+
+        Args:
+            storage_key: The key of the stored upload, also used as its filename
+
+        Returns:
+            The storage key, and the key of the kept original image (if any)
+        """
+        if optimizer is None or not (
+            optimized := optimizer.optimize(file_hook.fetch(storage_key), storage_key)
+        ):
+            return storage_key, None
+        im_bytes, filename = optimized
+        optimized_key = file_hook.save(im_bytes, filename)
+        if CONFIG.Ingest.keep_original:
+            return optimized_key, storage_key
+        return optimized_key, None
+
+    def new_receipt(
+        storage_key: str, original_key: str | None, upload_id: str | None = None
+    ) -> Receipt:
+        """Creates the receipt of an uploaded image, named and tagged by the form"""
+        receipt = Receipt()
+        receipt.name = request.form.get("name", None) or None
+        receipt.storage_key = storage_key
+        receipt.original_key = original_key
+        receipt.upload_id = upload_id
+        receipt.tags = meta_hook.fetch_tags(
+            tag_ids=request.form.getlist("tag", type=int)
+        )
+        return meta_hook.create_receipt(receipt)
+
+    def delete_unreferenced(storage_key: str):
+        """Deletes a stored image unless another receipt still uses it
+
+        A content addressed image may have just been saved again by a request
+        whose receipt isn't committed yet, so it is only deleted later.
+        """
+        if not file_hook.content_addressed:
+            file_hook.delete(storage_key)
+        elif not meta_hook.count_references(storage_key):
+            deferred_deletes.add(storage_key)
 
     @app.errorhandler(FileNotFoundError)
     @app.errorhandler(NoResultFound)
     def code_404(_e) -> Response:
         return response_code(404)
 
+    @app.errorhandler(resilience.CircuitOpenError)
+    def circuit_open(e: resilience.CircuitOpenError) -> Response:
+        response = error_response(
+            503, "Service Unavailable", f"{e.name} is failing, try again later"
+        )
+        response.headers["Retry-After"] = str(math.ceil(e.retry_after))
+        return response
+
+    @app.errorhandler(resilience.HookTimeoutError)
+    def hook_timeout(e: resilience.HookTimeoutError) -> Response:
+        return error_response(504, "Storage Timeout", str(e))
+
     @app.route("/api/receipt/", methods=["POST"])
     def upload_receipt():
         """API Endpoint for uploading a receipt image"""
@@ -66,7 +547,7 @@ def create_app(file_hook=None, meta_hook=None):
             )
 
         file = request.files["file"]
-        LOGGER.debug(f"Filename: {file.filename}, Stream: {file.stream}")
+        LOGGER.debug("Filename: %s, Stream: %s", file.filename, file.stream)
 
         if file is None or len(im_bytes := file.stream.read()) == 0:
             LOGGER.error("UPLOAD ENDPOINT: API client did not send file")
@@ -78,25 +559,134 @@ def create_app(file_hook=None, meta_hook=None):
                 404, "Missing Filename", "The file has been sent but with no filename."
             )
 
-        LOGGER.debug(f"UPLOAD ENDPOINT: {request.form}")
-        tags = request.form.getlist("tag", type=int)
+        LOGGER.debug("UPLOAD ENDPOINT: %s", request.form)
 
         filename = file.filename
         filename = cast(str, filename)
 
         file.close()
 
-        storage_key = file_hook.save(im_bytes, filename)
+        storage_key, original_key = ingest(im_bytes, filename)
+        receipt = new_receipt(storage_key, original_key)
+        LOGGER.info("UPLOAD ENDPOINT: Saving uploaded file: %s", storage_key)
 
-        receipt = Receipt()
-        receipt.name = request.form.get("name", None) or None
-        receipt.storage_key = storage_key
-        receipt.tags = meta_hook.fetch_tags(tag_ids=tags)
+        return receipt.export()
+
+    @app.errorhandler(UploadOffsetError)
+    def upload_offset(e: UploadOffsetError) -> Response:
+        response = error_response(409, "Offset Mismatch", str(e))
+        response.headers["Upload-Offset"] = str(e.offset)
+        return response
 
-        receipt = meta_hook.create_receipt(receipt)
-        LOGGER.info(f"UPLOAD ENDPOINT: Saving uploaded file: {storage_key}")
+    @app.errorhandler(InvalidUploadError)
+    def invalid_upload(e: InvalidUploadError) -> Response:
+        return error_response(400, "Invalid Upload", str(e))
 
-        return receipt.export()
+    @app.route("/api/upload/", methods=["POST"])
+    def begin_upload():
+        """API Endpoint for starting a resumable upload, sent in chunks
+
+        The form holds the filename and size of the image. The receipt is
+        created once every chunk is received, see complete_upload.
+        """
+        filename = request.form.get("filename", "")
+        size = request.form.get("size", "")
+        if not filename or not size.isdigit() or int(size) == 0:
+            return error_response(
+                400, "Invalid Upload", "A filename and positive size are required."
+            )
+        if int(size) > CONFIG.Uploads.max_bytes:
+            return error_response(
+                413,
+                "Upload Too Large",
+                f"Uploads are limited to {CONFIG.Uploads.max_bytes} bytes.",
+            )
+
+        upload_id = file_hook.begin_upload(filename, int(size))
+        LOGGER.info("UPLOAD ENDPOINT: Began upload %s of %s", upload_id, filename)
+        response = app.json.response(
+            {"id": upload_id, "chunk_size": file_hook.upload_chunk_size, "offset": 0}
+        )
+        response.status_code = 201
+        response.headers["Location"] = f"/api/upload/{upload_id}"
+        return response
+
+    @app.route("/api/upload/<upload_id>", methods=["PATCH", "PUT"])
+    def upload_chunk(upload_id: str):
+        """API Endpoint for sending the chunk of an upload at Upload-Offset"""
+        offset = request.headers.get("Upload-Offset", "")
+        if not offset.isdigit():
+            return error_response(
+                400, "Invalid Offset", "The Upload-Offset header is required."
+            )
+        chunk_size = file_hook.upload_chunk_size
+        too_large = error_response(
+            413, "Chunk Too Large", f"Chunks are limited to {chunk_size} bytes."
+        )
+        # Checked before reading the body, which is otherwise unbounded
+        if (request.content_length or 0) > chunk_size:
+            return too_large
+        # Bodies sent with Transfer-Encoding: chunked have no Content-Length
+        chunk = request.stream.read(chunk_size + 1)
+        if len(chunk) > chunk_size:
+            return too_large
+
+        try:
+            received = file_hook.stage_chunk(upload_id, int(offset), chunk)
+        except (UploadOffsetError, InvalidUploadError):
+            raise
+        except ValueError as e:
+            return error_response(400, "Invalid Chunk", str(e))
+        response = response_code(204)
+        response.headers["Upload-Offset"] = str(received)
+        return response
+
+    @app.route("/api/upload/<upload_id>", methods=["GET"])
+    def upload_status(upload_id: str):
+        """API Endpoint for how much of an upload was received, to resume it"""
+        received, size = file_hook.upload_progress(upload_id)
+        response = app.json.response({"offset": received, "size": size})
+        response.headers["Upload-Offset"] = str(received)
+        response.headers["Upload-Length"] = str(size)
+        response.cache_control.no_store = True
+        return response
+
+    @app.route("/api/upload/<upload_id>/complete", methods=["POST"])
+    def complete_upload(upload_id: str):
+        """API Endpoint for creating the receipt of a completely sent upload
+
+        The form may hold the name and tags of the receipt, as for
+        upload_receipt. Completing again, e.g. when the response was lost,
+        returns the same receipt.
+        """
+        if (receipt := meta_hook.fetch_receipt_by_upload(upload_id)) is not None:
+            return receipt.export()
+
+        # Finishing again returns the same key until the upload is forgotten
+        staged_key = file_hook.finish_upload(upload_id)
+        storage_key, original_key = ingest_staged(staged_key)
+        receipt = new_receipt(storage_key, original_key, upload_id)
+        LOGGER.info("UPLOAD ENDPOINT: Saving upload %s: %s", upload_id, storage_key)
+
+        def forget_upload():
+            # Called once the unit of work committed the receipt, so a failed
+            # request can be completed again from the staged upload
+            try:
+                file_hook.abort_upload(upload_id)
+                if staged_key not in (storage_key, original_key):
+                    delete_unreferenced(staged_key)  # Replaced by its optimization
+            except Exception:
+                LOGGER.exception("Failed to forget upload %s", upload_id)
+
+        response = app.json.response(receipt.export())
+        response.call_on_close(forget_upload)
+        return response
+
+    @app.route("/api/upload/<upload_id>", methods=["DELETE"])
+    def abort_upload(upload_id: str):
+        """API Endpoint for discarding an unfinished upload"""
+        file_hook.abort_upload(upload_id)
+        return response_code(204)
 
     @app.route("/api/receipt/<int:id_>/image")
     def view_receipt(id_: int):
@@ -117,25 +707,27 @@ def create_app(file_hook=None, meta_hook=None):
             )
 
         # FileNotFoundError will be converted to 404 by flask
-        raw_bytes = file_hook.fetch(receipt.storage_key)
-
-        # Convert receipt image into BytesIO object
-        receipt_bytes = BytesIO(raw_bytes)
-
-        file = send_file(receipt_bytes, download_name=receipt.storage_key)
+        image = file_hook.fetch_buffer(receipt.storage_key)
+        size = len(image)
+
+        # Memory maps are file-like, and closed once the response is sent.
+        # BytesIO shares the memory of bytes rather than copying them.
+        body = image if isinstance(image, mmap.mmap) else BytesIO(image)
+        file = send_file(body, download_name=receipt.storage_key)
+        file.content_length = size
         file.headers["Upload-Date"] = str(receipt.upload_dt)
         LOGGER.info(
-            f"GET_KEY ENDPOINT: "
-            f"Returning file, {receipt.storage_key}, to client. "
-            f"Size: {len(raw_bytes)};"
+            "GET_KEY ENDPOINT: Returning file, %s, to client. Size: %d;",
+            receipt.storage_key,
+            size,
         )
-        LOGGER.debug(f"GET_KEY ENDPOINT: Headers: {file.headers}")
+        LOGGER.debug("GET_KEY ENDPOINT: Headers: %s", file.headers)
         return file
 
     @app.route("/api/receipt/<int:id_>", methods=["PUT"])
     def update_receipt(id_: int):
         """API Endpoint for updating a receipt"""
-        LOGGER.debug(f"UPDATE ENDPOINT: {request.form}")
+        LOGGER.debug("UPDATE ENDPOINT: %s", request.form)
 
         receipt = meta_hook.update_receipt(
             receipt_id=id_,
@@ -148,7 +740,20 @@ def create_app(file_hook=None, meta_hook=None):
         if (file := request.files.get("file", None)) is not None:
             im_bytes = file.stream.read()
             file.close()
-            file_hook.replace(receipt.storage_key, im_bytes)
+            if file_hook.content_addressed or optimizer is not None:
+                # The stored image may be shared or change format, so save a new one
+                old_keys = {receipt.storage_key, receipt.original_key} - {None}
+                new_key, original_key = ingest(
+                    im_bytes, file.filename or receipt.storage_key
+                )
+                receipt = meta_hook.update_receipt(
+                    id_, storage_key=new_key, original_key=original_key or ""
+                )
+                meta_hook.commit()
+                for old_key in old_keys - {new_key, original_key}:
+                    delete_unreferenced(old_key)
+            else:
+                file_hook.replace(receipt.storage_key, im_bytes)
 
         return receipt.export()
 
@@ -168,14 +773,16 @@ def create_app(file_hook=None, meta_hook=None):
         return receipt.export()
 
     @app.route("/api/receipt/")
+    @cached("receipt")
     def fetch_receipt_keys():
         # ToDo: Server side sorting from query string
-        receipts = meta_hook.fetch_receipts()
+        receipts = meta_hook.fetch_receipt_rows()
 
         response = [r.export() for r in receipts]
 
-        LOGGER.info(f"FETCH_MANY_KEYS ENDPOINT: Returning {len(receipts)} receipts")
-        LOGGER.debug(f"FETCH_MANY_KEYS ENDPOINT: Response: {json.dumps(response)}")
+        LOGGER.info("FETCH_MANY_KEYS ENDPOINT: Returning %d receipts", len(receipts))
+        if LOGGER.isEnabledFor(DEBUG):
+            LOGGER.debug("FETCH_MANY_KEYS ENDPOINT: Response: %s", json.dumps(response))
 
         response = sorted(response, key=lambda receipt: receipt["name"])
 
@@ -192,7 +799,7 @@ def create_app(file_hook=None, meta_hook=None):
 
         if r is None:
             LOGGER.info(
-                f"Client attempted to delete receipt -- {id_} -- that doesn't exists"
+                "Client attempted to delete receipt -- %d -- that doesn't exists", id_
             )
             return error_response(
                 404,
@@ -200,11 +807,14 @@ def create_app(file_hook=None, meta_hook=None):
                 f"The key, {id_} was not found in the database",
             )
 
-        storage_key = r.storage_key
+        storage_key, original_key = r.storage_key, r.original_key
         meta_hook.delete_receipt(id_)
-        file_hook.delete(storage_key)
+        meta_hook.commit()  # The receipt must be gone before its images
+        delete_unreferenced(storage_key)
+        if original_key is not None:
+            delete_unreferenced(original_key)
 
-        LOGGER.info(f"DELETE ENDPOINT: Deleting Receipt {id_}")
+        LOGGER.info("DELETE ENDPOINT: Deleting Receipt %d", id_)
 
         return response_code(204)
 
@@ -239,18 +849,21 @@ def create_app(file_hook=None, meta_hook=None):
         response = tag.export()
 
         LOGGER.info("FETCH_TAG ENDPOINT: Returning 1 tag")
-        LOGGER.debug(f"FETCH_TAG ENDPOINT: Response: {json.dumps(response)}")
+        if LOGGER.isEnabledFor(DEBUG):
+            LOGGER.debug("FETCH_TAG ENDPOINT: Response: %s", json.dumps(response))
 
         return response
 
     @app.route("/api/tag/")
+    @cached("tag")
     def fetch_tags():
         tags = meta_hook.fetch_tags()
 
         response = [t.export() for t in tags]
 
-        LOGGER.info(f"FETCH_TAGS ENDPOINT: Returning {len(tags)} tags")
-        LOGGER.debug(f"FETCH_TAGS ENDPOINT: Response: {json.dumps(response)}")
+        LOGGER.info("FETCH_TAGS ENDPOINT: Returning %d tags", len(tags))
+        if LOGGER.isEnabledFor(DEBUG):
+            LOGGER.debug("FETCH_TAGS ENDPOINT: Response: %s", json.dumps(response))
 
         return response
 
@@ -278,8 +891,34 @@ def create_app(file_hook=None, meta_hook=None):
         """
         meta_hook.delete_tag(tag_id)
 
-        LOGGER.info(f"DELETE TAG ENDPOINT: Deleting tag: {tag_id}")
+        LOGGER.info("DELETE TAG ENDPOINT: Deleting tag: %d", tag_id)
 
         return response_code(204)
 
+    @app.route("/api/sync")
+    def sync():
+        """API Endpoint for the receipts and tags changed since a previous sync
+
+        Clients send the token of their previous sync as ``since`` (0, the
+        default, for everything) and keep the returned one for the next.
+        """
+        since = request.args.get("since", "0")
+        if not since.isdigit():
+            return error_response(
+                400, "Invalid Token", "since must be a token returned by a sync"
+            )
+
+        config = CONFIG.Sync
+        changes = meta_hook.fetch_changes(
+            int(since), config.page_size, config.settle_seconds
+        )
+
+        LOGGER.info(
+            "SYNC ENDPOINT: Returning %d receipts and %d tags changed since %s",
+            len(changes.receipts) + len(changes.deleted_receipts),
+            len(changes.tags) + len(changes.deleted_tags),
+            since,
+        )
+        return changes.export()
+
     return app
@@ -1,10 +1,12 @@
+import atexit
 import logging
 import os
+import queue
 import sys
 import time
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-from configure import DIRS
+from configure import CONFIG, DIRS
 
 LOG_NAME = "receipt_database"
 LOGGER = log = logging.getLogger(LOG_NAME)
@@ -17,16 +19,62 @@ CRITICAL, ERROR, WARNING, INFO, DEBUG = (
     logging.DEBUG,
 )
 
+# Writes queued records to the real handlers, see init_logging
+_listener: QueueListener | None = None
+
+
+class _LazyQueueHandler(QueueHandler):
+    """Queues records without formatting them first
+
+    The standard QueueHandler formats each message on the logging thread so that
+    records can be pickled. Our queue never leaves the process, so formatting is
+    left to the listener thread. Arguments must therefore not be mutated after
+    they are logged.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def _level(level: int | str) -> int:
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(level.upper())
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown log level {level}")
+    return value
+
 
 def init_logging(
-    to_stdout: bool = True,
-    local_level: int = logging.INFO,
-    root_level: int = logging.WARNING,
+    to_stdout: bool | None = None,
+    local_level: int | str | None = None,
+    root_level: int | str | None = None,
 ):
-    logging.Formatter.converter = time.gmtime  # Set logs to UTC
+    """Sets up logging to rotating files (and stdout)
+
+    Records are put on a queue and written by a background QueueListener thread,
+    so logging never blocks request handling on file I/O. Calling this again
+    only updates the levels.
+
+    Args:
+        to_stdout: Also log to stdout, defaults to CONFIG.Logging.to_stdout
+        local_level: Level for our app's logger, defaults to CONFIG.Logging
+        root_level: Level for all other loggers, defaults to CONFIG.Logging
+    """
+    global _listener
+    config = CONFIG.Logging
+    to_stdout = config.to_stdout if to_stdout is None else to_stdout
+    local_level = _level(config.local_level if local_level is None else local_level)
+    root_level = _level(config.root_level if root_level is None else root_level)
 
     root_logger = logging.getLogger()  # Logger for whole process
     local_logger = logging.getLogger(LOG_NAME)  # Logger for our app, excluding libs
+    root_logger.setLevel(root_level)
+    local_logger.setLevel(local_level)
+    if _listener is not None:
+        return
+
+    logging.Formatter.converter = time.gmtime  # Set logs to UTC
 
     log_dir = DIRS.user_log_dir
     os.makedirs(log_dir, exist_ok=True)
@@ -60,11 +108,41 @@ def init_logging(
     root_error_handler.setLevel(logging.WARNING)
     local_error_handler.setLevel(logging.WARNING)
 
-    root_logger.setLevel(root_level)
-    local_logger.setLevel(local_level)
-
-    root_logger.addHandler(root_error_handler)
-    local_logger.addHandler(local_error_handler)
-    local_logger.addHandler(standard_log_handler)
+    # Every record reaches the root logger's queue, so local handlers filter
+    local_only = logging.Filter(LOG_NAME)
+    handlers: list[logging.Handler] = [
+        root_error_handler,
+        local_error_handler,
+        standard_log_handler,
+    ]
     if to_stdout:
-        local_logger.addHandler(console_handler)
+        handlers.append(console_handler)
+    for handler in handlers[1:]:
+        handler.addFilter(local_only)
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+    root_logger.addHandler(_LazyQueueHandler(log_queue))
+
+
+def _restart_listener():
+    # Only the forking thread survives a fork, so the child needs its own
+    if _listener is not None:
+        _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_listener)
+
+
+def stop_logging():
+    """Writes out any queued records and stops the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        for handler in logging.getLogger().handlers[:]:
+            if isinstance(handler, QueueHandler):
+                logging.getLogger().removeHandler(handler)
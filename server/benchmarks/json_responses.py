@@ -0,0 +1,84 @@
+"""Compares serialization and compression of the receipt list response
+
+Run from the server directory:
+    python -m benchmarks.json_responses --receipts 5000
+"""
+import argparse
+import datetime as dt
+import gzip
+import timeit
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from compression import FastJSONProvider, brotli, orjson
+from receipt import Receipt, Tag
+
+UTC = dt.timezone.utc
+
+
+def make_response_body(count: int) -> list[dict]:
+    tags = [Tag(id=i, name=f"Tag {i}") for i in range(10)]
+    start = dt.datetime(2020, 1, 1, tzinfo=UTC)
+    receipts = [
+        Receipt(
+            id=i,
+            name=f"Receipt {i}",
+            storage_key=f"IMG_{i:05} ({start.isoformat()}).jpg",
+            upload_dt=start + dt.timedelta(hours=i),
+            tags=tags[i % 3 : i % 3 + 3],
+        )
+        for i in range(count)
+    ]
+    return [r.export() for r in receipts]
+
+
+def bench(label: str, func, number: int) -> float:
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{label:<28} {seconds * 1000:9.3f} ms")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--receipts", type=int, default=5000)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    body = make_response_body(args.receipts)
+    print(f"Serializing {args.receipts} receipts")
+
+    with app.app_context():
+        default = DefaultJSONProvider(app)
+        before = bench(
+            "json (Flask default)", lambda: default.response(body), args.number
+        )
+        if orjson is not None:
+            fast = FastJSONProvider(app)
+            after = bench("orjson", lambda: fast.response(body), args.number)
+            print(f"{'speedup':<28} {before / after:9.1f} x")
+        else:
+            print("orjson is not installed")
+
+        raw = default.response(body).get_data()
+
+    print(f"\n{'encoding':<12} {'bytes':>10} {'ratio':>7} {'time':>12}")
+    print(f"{'identity':<12} {len(raw):>10} {1:>7.2f}")
+    encoders = {
+        f"gzip-{level}": lambda level=level: gzip.compress(raw, level)
+        for level in (1, 6)
+    }
+    if brotli is not None:
+        for quality in (4, 11):
+            encoders[f"br-{quality}"] = lambda q=quality: brotli.compress(
+                raw, quality=q
+            )
+    for name, encode in encoders.items():
+        size = len(encode())
+        seconds = min(timeit.repeat(encode, number=5, repeat=3)) / 5
+        print(f"{name:<12} {size:>10} {size / len(raw):>7.2f} {seconds * 1000:9.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Measures worker cold start: importing the app and calling create_app
+
+Each run is a fresh interpreter, started in a scratch directory holding the
+config so nothing is cached between runs. ``-X importtime`` output of the
+first run is used to list the slowest imports.
+
+Run from the server directory:
+    python -m benchmarks.startup
+    python -m benchmarks.startup --config config.json --runs 10
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+# "import time: self [us] | cumulative | imported package", nesting is indented
+IMPORT_LINE = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)")
+
+
+def default_config(directory: str) -> dict:
+    return {
+        "StorageHooks": {"file_hook": "FS", "meta_hook": "SQLite3"},
+        "SQLite3": {"db_path": os.path.join(directory, "receipts.sqlite3")},
+        "FileSystem": {"file_path": os.path.join(directory, "files")},
+        "Logging": {"to_stdout": False},
+    }
+
+
+def run_once(directory: str, importtime: bool) -> tuple[float, float, str]:
+    env = dict(os.environ, PYTHONPATH=SERVER_DIR)
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    result = subprocess.run(
+        command + ["-c", SCRIPT],
+        cwd=directory,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_seconds, create_seconds = map(float, result.stdout.split()[-2:])
+    return import_seconds, create_seconds, result.stderr
+
+
+def slowest_imports(stderr: str, count: int) -> list[tuple[str, float]]:
+    imports = []
+    for match in IMPORT_LINE.finditer(stderr):
+        cumulative, indent, name = match.groups()
+        # The app and what it imports directly
+        if len(indent) <= 3:
+            imports.append((name, int(cumulative) / 1000))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", help="Config file, defaults to FS + SQLite3")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports shown")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        config_path = os.path.join(directory, "config.json")
+        if args.config:
+            shutil.copy(args.config, config_path)
+        else:
+            with open(config_path, "w") as file:
+                json.dump(default_config(directory), file)
+
+        *_, stderr = run_once(directory, importtime=True)
+        runs = [run_once(directory, importtime=False) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    import_ms = statistics.median(r[0] for r in runs) * 1000
+    create_ms = statistics.median(r[1] for r in runs) * 1000
+    print(f"import app:   {import_ms:8.1f} ms (median of {args.runs})")
+    print(f"create_app(): {create_ms:8.1f} ms")
+    print(f"total:        {import_ms + create_ms:8.1f} ms")
+    print("\nSlowest imports (including those in create_app):")
+    for name, ms in slowest_imports(stderr, args.top):
+        print(f"  {name:<40} {ms:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
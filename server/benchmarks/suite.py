@@ -0,0 +1,277 @@
+"""Throughput and latency benchmarks for the API
+
+Drives ``create_app`` through Flask's test client for each combination of
+metadata and file hooks, reporting operations per second and latency
+percentiles. Listing is measured after seeding receipts with
+``synthetic.generate``. Results can be saved as a baseline and later runs
+compared against it to flag regressions.
+
+Run from the server directory:
+    python -m benchmarks.suite
+    python -m benchmarks.suite --meta SQLite3 --file FS S3 --sizes 1000 100000
+    python -m benchmarks.suite --save-baseline benchmarks/baseline.json
+    python -m benchmarks.suite --compare benchmarks/baseline.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Iterator
+
+from flask.testing import FlaskClient
+from sqlalchemy import create_engine
+
+import synthetic
+from configure import CONFIG
+from storage_hooks.file_system import FileSystemHook
+from storage_hooks.SQLite3 import SQLite3
+from storage_hooks.storage_hooks import DatabaseHook, FileHook
+
+IMAGE = os.urandom(200 * 1024)  # Roughly a compressed phone photo
+
+
+class MemorySQLite3(DatabaseHook):
+    """SQLite3 in raw memory"""
+
+    def __init__(self):
+        super().__init__()
+        self.engine = create_engine("sqlite://")
+
+
+@contextlib.contextmanager
+def meta_hook(name: str, workdir: str) -> Iterator[DatabaseHook]:
+    match name:
+        case "MemorySQLite3":
+            hook = MemorySQLite3()
+        case "SQLite3":
+            CONFIG.SQLite3.db_path = os.path.join(workdir, "bench.sqlite3")
+            hook = SQLite3()
+        case _:
+            raise ValueError(name)
+    hook.initialize_storage(clean=True)
+    yield hook
+    hook.engine.dispose()
+
+
+@contextlib.contextmanager
+def file_hook(name: str, workdir: str) -> Iterator[FileHook]:
+    match name:
+        case "FS":
+            hook = FileSystemHook(os.path.join(workdir, "files"))
+            hook.initialize_storage(clean=True)
+            yield hook
+        case "S3":
+            # A local S3 stand-in, requires moto
+            from moto import mock_aws
+
+            from storage_hooks.AWS import AWSS3Hook
+
+            os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+            with mock_aws():
+                hook = AWSS3Hook()
+                hook.initialize_storage(clean=True)
+                yield hook
+        case _:
+            raise ValueError(name)
+
+
+@dataclass
+class Result:
+    name: str
+    operations: int
+    seconds: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+    @property
+    def ops_per_sec(self) -> float:
+        return self.operations / self.seconds
+
+    @classmethod
+    def from_latencies(cls, name: str, latencies: list[float]) -> "Result":
+        if len(latencies) > 1:
+            cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+        else:
+            cuts = latencies * 99
+        return cls(
+            name,
+            len(latencies),
+            sum(latencies),
+            cuts[49] * 1000,
+            cuts[94] * 1000,
+            cuts[98] * 1000,
+        )
+
+
+def measure(name: str, iterations: int, operation: Callable[[int], None]) -> Result:
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - start)
+    return Result.from_latencies(name, latencies)
+
+
+def check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.path}: {response.status}")
+    return response
+
+
+def run_scenarios(
+    client: FlaskClient,
+    meta: DatabaseHook,
+    files: FileHook,
+    prefix: str,
+    iterations: int,
+    sizes: list[int],
+) -> list[Result]:
+    results = []
+    uploaded: list[int] = []
+
+    def upload(i: int):
+        response = check(
+            client.post(
+                "/api/receipt/",
+                data={"file": (io.BytesIO(IMAGE), f"{i}.jpg"), "name": f"{i}"},
+                content_type="multipart/form-data",
+            )
+        )
+        uploaded.append(response.json["id"])
+
+    results.append(measure(f"{prefix} upload", iterations, upload))
+    results.append(
+        measure(
+            f"{prefix} image",
+            iterations,
+            lambda i: check(client.get(f"/api/receipt/{uploaded[i]}/image")),
+        )
+    )
+    results.append(
+        measure(
+            f"{prefix} update",
+            iterations,
+            lambda i: check(
+                client.put(f"/api/receipt/{uploaded[i]}", data={"name": f"new {i}"})
+            ),
+        )
+    )
+    results.append(
+        measure(
+            f"{prefix} delete",
+            iterations,
+            lambda i: check(client.delete(f"/api/receipt/{uploaded[i]}")),
+        )
+    )
+
+    seeded = 0
+    for size in sorted(sizes):
+        synthetic.generate(meta, files, size - seeded, images=1, seed=size)
+        seeded = size
+        list_iterations = max(3, min(iterations, 200_000 // size))
+        results.append(
+            measure(
+                f"{prefix} list {size}",
+                list_iterations,
+                lambda _: check(client.get("/api/receipt/")),
+            )
+        )
+    return results
+
+
+def run(metas: list[str], files: list[str], iterations: int, sizes: list[int]):
+    from app import create_app
+    from app_logging import init_logging
+
+    init_logging(to_stdout=False, local_level="WARNING")
+    results = []
+    for meta_name in metas:
+        for file_name in files:
+            prefix = f"{meta_name}+{file_name}"
+            print(f"Running {prefix}...", file=sys.stderr)
+            with tempfile.TemporaryDirectory() as workdir:
+                with meta_hook(meta_name, workdir) as meta, file_hook(
+                    file_name, workdir
+                ) as file:
+                    client = create_app(file, meta).test_client()
+                    results += run_scenarios(
+                        client, meta, file, prefix, iterations, sizes
+                    )
+    return results
+
+
+def report(results: list[Result], baseline: dict[str, dict] | None, threshold: float):
+    """Prints results, returning the names of regressed benchmarks"""
+    regressions = []
+    header = (
+        f"{'benchmark':<36} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    )
+    print(header + (f" {'vs base':>8}" if baseline is not None else ""))
+    for result in results:
+        line = (
+            f"{result.name:<36} {result.ops_per_sec:>10.1f} {result.p50_ms:>9.2f} "
+            f"{result.p95_ms:>9.2f} {result.p99_ms:>9.2f}"
+        )
+        if baseline is not None and (base := baseline.get(result.name)) is not None:
+            change = result.p50_ms / base["p50_ms"] - 1
+            line += f" {change:>+8.0%}"
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions.append(result.name)
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--meta", nargs="+", default=["MemorySQLite3", "SQLite3"], metavar="HOOK"
+    )
+    parser.add_argument("--file", nargs="+", default=["FS"], metavar="HOOK")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 100_000])
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative p50 slowdown reported as a regression",
+    )
+    args = parser.parse_args()
+
+    results = run(args.meta, args.file, args.iterations, args.sizes)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": {r.name: asdict(r) for r in results},
+                },
+                file,
+                indent=2,
+            )
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import gzip
+from typing import Any
+
+from flask import Response, request
+from flask.json.provider import DefaultJSONProvider
+
+from configure import CONFIG
+
+try:
+    import orjson
+except ImportError:  # Optional, falls back to the json module
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Optional, only gzip is offered without it
+    brotli = None
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes with orjson
+
+    Output matches ``DefaultJSONProvider`` (sorted keys, dates via ``default``),
+    but response bodies are built straight from orjson's bytes.
+    """
+
+    OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if kwargs:  # Formatting options are only supported by the json module
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.OPTIONS).decode()
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(
+            obj,
+            default=self.default,
+            option=self.OPTIONS | orjson.OPT_APPEND_NEWLINE,
+        )
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def best_encoding() -> str | None:
+    """The best compression the current request accepts, if any"""
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """Compresses body as "br" or "gzip" with the configured level"""
+    config = CONFIG.Responses
+    if encoding == "br":
+        return brotli.compress(body, quality=config.brotli_quality)
+    return gzip.compress(body, config.gzip_level, mtime=0)
+
+
+def compress_response(response: Response) -> Response:
+    """Compresses large JSON responses with the best encoding the client accepts
+
+    Intended to be registered with ``Flask.after_request``.
+    """
+    if (
+        response.direct_passthrough
+        or response.status_code in (204, 206, 304)
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < CONFIG.Responses.compress_min_bytes:
+        return response
+
+    if (encoding := best_encoding()) is not None:
+        response.set_data(compress(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+    return response
@@ -1,11 +1,11 @@
 import argparse
+import functools
 import json
 import os
 from dataclasses import asdict, dataclass, field
-from typing import Literal
+from typing import Literal, cast
 
 import platformdirs
-from pydantic import TypeAdapter
 
 CURRENT_VERSION = "0.1.0-1.0"
 DIRS = platformdirs.PlatformDirs("Paperless", "Papertrail")
@@ -13,8 +13,17 @@ DIRS = platformdirs.PlatformDirs("Paperless", "Papertrail")
 
 @dataclass
 class _StorageHooks:
-    file_hook: Literal["FS", "AWS"]
-    meta_hook: Literal["SQLite3", "RemoteSQL"]
+    # Names from storage_hooks.hook_config_factory or a hook entry point
+    file_hook: str
+    meta_hook: str
+    # Key images by a hash of their content so identical uploads are stored once
+    content_addressed: bool = False
+    # Make each write request one database transaction, committed at its end
+    request_transactions: bool = True
+    # Content addressed images are deleted this long after their last receipt,
+    # unless used again meanwhile (see reconcile.DeferredDeletes). 0 to delete
+    # straight away
+    delete_delay_seconds: float = 60
 
     @classmethod
     def default(cls) -> "_StorageHooks":
@@ -41,6 +50,12 @@ class RemoteSQLConfig:
     host: str | None = None
     port: str | None = None
     database: str | None = None
+    # URLs of read replicas, which serve read only queries
+    replicas: list[str] = field(default_factory=list)
+    # Seconds after a write that reads stay on the primary (read your writes)
+    sticky_seconds: float = 5
+    # Seconds before a failed replica is checked again
+    replica_retry_seconds: float = 30
 
     @classmethod
     def default(cls) -> "RemoteSQLConfig":
@@ -50,11 +65,18 @@ class RemoteSQLConfig:
 @dataclass
 class ManualRemoteSQLConfig:
     url: str
+    replicas: list[str] = field(default_factory=list)
+    sticky_seconds: float = 5
+    replica_retry_seconds: float = 30
 
 
 @dataclass
 class _FileSystemConfig:
     file_path: str
+    # "sharded" fans images out into hash prefixed subdirectories
+    layout: Literal["flat", "sharded"] = "sharded"
+    # fetch_buffer memory maps images at least this large, None to never
+    mmap_min_bytes: int | None = 64 * 1024
 
     @classmethod
     def default(cls) -> "_FileSystemConfig":
@@ -67,12 +89,165 @@ class _AWSS3Config:
     # If not provided, boto3 falls back to the environment
     access_key_id: str | None = None
     secret_access_key: str | None = None
+    max_pool_connections: int = 50  # Connections shared by all request threads
+    connect_timeout: float = 5
+    read_timeout: float = 30
+    max_attempts: int = 3  # Including retries of throttled or failed requests
+    etag_cache_size: int = 10_000  # Recent objects whose ETag is remembered
+    endpoint_url: str | None = None  # For S3 compatible services
+    async_concurrency: int = 256  # In flight requests of the AsyncAWS hook
 
     @classmethod
     def default(cls) -> "_AWSS3Config":
         return _AWSS3Config("cs425-3-test-bucket")
 
 
+@dataclass
+class _TieredConfig:
+    """Local disk cache kept in front of a (slower) cold storage hook"""
+
+    cache_path: str
+    cold_hook: str = "AWS"  # Any file hook name except Tiered
+    max_bytes: int = 2**30  # Disk budget for the cache, 1 GiB
+    max_age_days: float = 30  # Cached images unread for this long are demoted
+    warm_count: int = 100  # Most recent receipts to pre-fetch on startup
+    sweep_interval: float = 300  # Seconds between age based demotion sweeps
+
+    @classmethod
+    def default(cls) -> "_TieredConfig":
+        return _TieredConfig(os.path.normpath(DIRS.user_cache_dir + "/receipts"))
+
+
+@dataclass
+class _IngestConfig:
+    """Optional re-encoding of images as they are uploaded (requires Pillow)"""
+
+    optimize: bool = False
+    max_dimension: int = 2048  # Maximum width and height in pixels
+    format: Literal["WEBP", "JPEG", "PNG"] = "WEBP"
+    quality: int = 80  # Encoder quality for lossy formats, 1-100
+    keep_original: bool = False  # Also store the image exactly as uploaded
+    workers: int | None = None  # Worker processes, defaults to the CPU count
+
+
+@dataclass
+class _ResponsesConfig:
+    compress_min_bytes: int = 1024  # Smaller JSON responses are sent as is
+    gzip_level: int = 6  # 1 (fastest) - 9 (smallest)
+    brotli_quality: int = 4  # 0 (fastest) - 11 (smallest), needs brotli installed
+    fast_json: bool = True  # Serialize with orjson, when installed
+    # Serve the receipt and tag lists from memory until the database is written
+    cache_lists: bool = True
+    cache_entries: int = 64  # Lists kept, one per query string
+    cache_seconds: float | None = 60  # Catches writes by other hosts, None never
+
+
+@dataclass
+class _LoggingConfig:
+    local_level: str = "INFO"  # Level for our app's logger
+    root_level: str = "WARNING"  # Level for all other (library) loggers
+    to_stdout: bool = True
+
+
+@dataclass
+class _MetricsConfig:
+    enabled: bool = True  # Record metrics and serve them at /metrics
+    # Combine the metrics of all workers in each scrape, see metrics.py
+    multiprocess: bool = True
+    # Where workers share their metrics, a new temporary directory when null
+    multiprocess_dir: str | None = None
+
+
+@dataclass
+class _ProfilingConfig:
+    server_timing: bool = True  # Report SQL statement counts and time per response
+    slow_query_ms: float | None = None  # Log statements slower than this
+    explain_slow: bool = False  # Include the query plan when logging slow queries
+    query_budget: int | None = None  # Warn when a request runs more statements
+    # Sampling profiler endpoints, only served when a token is set
+    sampling_token: str | None = None
+    sampling_interval_ms: float = 5
+    sampling_max_seconds: float = 60
+
+
+@dataclass
+class _ServerConfig:
+    """Production server (launcher.py) settings"""
+
+    bind: str = "127.0.0.1:8000"
+    workers: int | None = None  # Worker processes, defaults to the CPU count
+    threads: int = 4  # Request handling threads per worker
+    timeout: float = 30  # Seconds before a stuck worker is killed and replaced
+    graceful_timeout: float = 30  # Seconds workers get to finish on reload/exit
+    max_requests: int = 0  # Replace workers after this many requests, 0 to never
+    # Signs values clients send back (e.g. Last-Write, S3 upload ids). Generated
+    # at start when null, which only works while all workers are forked from one
+    # master, and invalidates unfinished uploads on restart
+    secret_key: str | None = None
+
+
+@dataclass
+class _ResilienceConfig:
+    """Protection against slow or failing storage backends, see resilience.py"""
+
+    enabled: bool = True
+    failure_threshold: int = 5  # Consecutive failures that open a hook's circuit
+    reset_seconds: float = 30  # Time an open circuit fails fast before a retry
+    file_timeout: float | None = 10  # Seconds for remote file hook operations
+    meta_timeout: float | None = 10  # Seconds for remote database operations
+    hedge_percentile: float | None = 95  # Duplicate image fetches slower than this
+    hedge_min_delay: float = 0.01  # Seconds before any fetch is duplicated
+    workers: int = 32  # Threads per hook for operations with a timeout
+
+
+@dataclass
+class _SyncConfig:
+    """Incremental sync of receipts and tags, see GET /api/sync"""
+
+    page_size: int = 1000  # Changes returned per request at most
+    # Longer than any write transaction takes, see DatabaseHook.fetch_changes
+    settle_seconds: float = 10
+
+
+@dataclass
+class _EventsConfig:
+    """Server-sent events of receipt and tag changes, see events.py"""
+
+    enabled: bool = True
+    # Name from events.BROKERS or a broker entry point. When null, "Local" for
+    # one worker process and "Changes", which all workers share, for several
+    broker: str | None = None
+    poll_seconds: float = 1  # Between reads of the change table by "Changes"
+    replay_size: int = 1000  # Events kept for clients reconnecting
+    heartbeat_seconds: float = 15  # Idle time before a keepalive comment
+    stream_seconds: float = 300  # Streams then end, and clients reconnect
+    # Streams per worker, each holding a request thread. Half of Server.threads
+    # when null, so other requests still have threads
+    max_streams: int | None = None
+
+
+@dataclass
+class _UploadsConfig:
+    """Resumable uploads sent in chunks, see POST /api/upload/"""
+
+    chunk_bytes: int = 1024 * 1024  # Raised to 5 MiB by AWSS3, its minimum part
+    max_bytes: int = 100 * 1024 * 1024  # Largest upload accepted
+    expire_hours: float = 24  # Unfinished uploads are then removed
+    # Where FileHooks without their own place stage uploads, temp dir when null
+    staging_dir: str | None = None
+
+
+@dataclass
+class _ReconcileConfig:
+    """Periodic runs of "configure.py reconcile" by the server, see reconcile.py"""
+
+    interval_seconds: float = 0  # Between runs, 0 to only run it by hand
+    delete: bool = False  # Delete orphaned images, otherwise only log them
+    grace_hours: float = 1  # Ignore images and receipts newer than this
+    # Lets one process per host run it, a file in the temp dir when null
+    lock_path: str | None = None
+
+
 @dataclass
 class _Config:
     SQLite3: _SQLite3Config = field(default_factory=_SQLite3Config.default)
@@ -82,6 +257,18 @@ class _Config:
     StorageHooks: _StorageHooks = field(default_factory=_StorageHooks.default)
     FileSystem: _FileSystemConfig = field(default_factory=_FileSystemConfig.default)
     AWSS3: _AWSS3Config = field(default_factory=_AWSS3Config.default)
+    Tiered: _TieredConfig = field(default_factory=_TieredConfig.default)
+    Ingest: _IngestConfig = field(default_factory=_IngestConfig)
+    Responses: _ResponsesConfig = field(default_factory=_ResponsesConfig)
+    Logging: _LoggingConfig = field(default_factory=_LoggingConfig)
+    Metrics: _MetricsConfig = field(default_factory=_MetricsConfig)
+    Profiling: _ProfilingConfig = field(default_factory=_ProfilingConfig)
+    Server: _ServerConfig = field(default_factory=_ServerConfig)
+    Resilience: _ResilienceConfig = field(default_factory=_ResilienceConfig)
+    Sync: _SyncConfig = field(default_factory=_SyncConfig)
+    Events: _EventsConfig = field(default_factory=_EventsConfig)
+    Uploads: _UploadsConfig = field(default_factory=_UploadsConfig)
+    Reconcile: _ReconcileConfig = field(default_factory=_ReconcileConfig)
 
     DEFAULT_FILE_PATH = os.path.normpath(DIRS.user_config_dir + "/config.json")
 
@@ -104,6 +291,9 @@ class _Config:
             _Config: A valid Config object
         """
         if os.path.exists(path):
+            # pydantic is slow to import, so only load it when needed
+            from pydantic import TypeAdapter
+
             with open(path) as file:
                 # Throws ValidationError if it fails
                 return TypeAdapter(_Config).validate_python(json.load(file))
@@ -117,9 +307,39 @@ class _Config:
         return _Config()
 
 
-# This attempts to load from a config.json file in the cwd, but if one is not found
-# it will default to DEFAULT_FILE_PATH
-CONFIG = _Config.from_file("config.json")
+@functools.cache
+def get_config() -> _Config:
+    """Loads the config on first use
+
+    This attempts to load from a config.json file in the cwd, but if one is not
+    found it will default to DEFAULT_FILE_PATH
+    """
+    return _Config.from_file("config.json")
+
+
+class _LazyConfig:
+    """Forwards attribute access to get_config()
+
+    Importing CONFIG therefore does not read (or validate) any config file until
+    a setting is actually used.
+    """
+
+    __slots__ = ()
+
+    def __getattr__(self, name: str):
+        return getattr(get_config(), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(get_config(), name, value)
+
+    def __delattr__(self, name: str):
+        delattr(get_config(), name)
+
+    def __repr__(self) -> str:
+        return repr(get_config())
+
+
+CONFIG = cast(_Config, _LazyConfig())
 
 
 def make_parser() -> argparse.ArgumentParser:
@@ -147,6 +367,43 @@ def make_parser() -> argparse.ArgumentParser:
         "This will help ensure proper setup, "
         "but results in loss of previous data.",
     )
+
+    # Options to fill the configured hooks with synthetic data
+    generate = subparsers.add_parser(
+        "generate", help="Add synthetic receipts to the configured hooks"
+    )
+    generate.add_argument("count", type=int, help="Number of receipts to add")
+    generate.add_argument(
+        "--years",
+        type=float,
+        default=3,
+        help="Spread upload times over this many years",
+    )
+    generate.add_argument(
+        "--images",
+        type=int,
+        help="Distinct placeholder images to share, defaults to one per receipt",
+    )
+    generate.add_argument("--batch-size", type=int, default=10_000)
+    generate.add_argument(
+        "--workers", type=int, default=16, help="Threads saving images"
+    )
+    generate.add_argument("--seed", type=int, default=0)
+
+    # Options to find images and receipts that lost their counterpart
+    reconcile = subparsers.add_parser(
+        "reconcile", help="Report (or delete) images without a receipt"
+    )
+    reconcile.add_argument(
+        "--delete", action="store_true", help="Delete the orphaned images"
+    )
+    reconcile.add_argument(
+        "--grace-hours",
+        type=float,
+        default=1,
+        help="Ignore images and receipts newer than this",
+    )
+    reconcile.add_argument("--batch-size", type=int, default=1000)
     return parser
 
 
@@ -176,6 +433,44 @@ def main():
                 get_file_hook(CONFIG.StorageHooks.file_hook).initialize_storage(
                     args.clean
                 )
+        case "generate":
+            from storage_hooks.hook_config_factory import get_meta_hook
+            from storage_hooks.hook_config_factory import get_file_hook
+            from synthetic import generate
+
+            meta_hook = get_meta_hook(CONFIG.StorageHooks.meta_hook)
+            meta_hook.initialize_storage(False)
+            ids = generate(
+                meta_hook,
+                get_file_hook(CONFIG.StorageHooks.file_hook),
+                args.count,
+                years=args.years,
+                images=args.images,
+                batch_size=args.batch_size,
+                workers=args.workers,
+                seed=args.seed,
+                progress=lambda done: print(f"{done}/{args.count}", end="\r"),
+            )
+            print(f"Added receipts {ids[0]}-{ids[-1]}" if ids else "Added no receipts")
+        case "reconcile":
+            from storage_hooks.hook_config_factory import get_meta_hook
+            from storage_hooks.hook_config_factory import get_file_hook
+            from reconcile import reconcile
+
+            report = reconcile(
+                get_meta_hook(CONFIG.StorageHooks.meta_hook),
+                get_file_hook(CONFIG.StorageHooks.file_hook),
+                delete=args.delete,
+                grace_seconds=args.grace_hours * 60 * 60,
+                batch_size=args.batch_size,
+            )
+            print(f"Images: {report.images}")
+            print(f"Orphaned images: {report.orphans} ({report.deleted} deleted)")
+            for key in report.orphan_sample:
+                print(f"  {key}")
+            print(f"Receipt keys without an image: {report.dangling}")
+            for key in report.dangling_sample:
+                print(f"  {key}")
         case _:
             raise ValueError
 
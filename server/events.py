@@ -0,0 +1,308 @@
+"""Pushes receipt and tag changes to clients as server-sent events
+
+``DatabaseHook`` reports the records each committed write created, updated or
+deleted to its change listeners; the app publishes them to a ``Broker``, and
+``GET /api/events`` streams them to subscribers. Each event carries an id, so a
+reconnecting client (``Last-Event-ID``) first receives the events it missed,
+as long as the broker still holds them. Otherwise it gets a ``reset`` event and
+should catch up with ``GET /api/sync`` instead.
+
+``LocalBroker`` only reaches subscribers of the same process. ``ChangeBroker``
+reaches every worker process (and host) sharing the database, by polling the
+change table that ``GET /api/sync`` reads, and is what the launcher uses for
+several workers. Other brokers can be added through the
+``receipt_database.brokers`` entry point group.
+"""
+
+import abc
+import collections
+import datetime as dt
+import importlib
+import threading
+import uuid
+from importlib.metadata import entry_points
+from typing import TYPE_CHECKING, NamedTuple
+
+from app_logging import LOGGER
+from configure import CONFIG
+
+if TYPE_CHECKING:
+    from storage_hooks.storage_hooks import DatabaseHook
+
+# Broker name -> "module:Class"
+BROKERS = {
+    "Local": "events:LocalBroker",
+    "Changes": "events:ChangeBroker",
+}
+
+# Changes read from the change table per query by ChangeBroker
+POLL_LIMIT = 1000
+
+
+class Event(NamedTuple):
+    id: str  # Unique to the broker, see Broker.subscribe
+    kind: str  # "receipt", "tag" or "reset"
+    data: dict
+
+
+class Subscription(abc.ABC):
+    """The events published since a client subscribed, see ``Broker.subscribe``"""
+
+    @abc.abstractmethod
+    def get(self, timeout: float) -> list[Event]:
+        """Waits up to timeout seconds for events, returning those not yet returned"""
+
+    def close(self):
+        """Stops receiving events"""
+
+
+class Broker(abc.ABC):
+    """Passes published events on to every subscription"""
+
+    @classmethod
+    def create(cls, meta_hook: "DatabaseHook") -> "Broker":
+        """The broker for the app using meta_hook, see get_broker"""
+        return cls()
+
+    @abc.abstractmethod
+    def publish(self, kind: str, data: dict):
+        """Publishes an event to every current subscription"""
+
+    @abc.abstractmethod
+    def subscribe(self, last_id: str | None = None) -> Subscription:
+        """Subscribes to events published from now on
+
+        Args:
+            last_id: The id of the last event a client received, to first
+                replay the ones after it. When they are no longer known, the
+                subscription starts with a ``reset`` event instead.
+        """
+
+    def after_fork(self):
+        """Resets process specific state in a newly forked worker"""
+
+
+class _LocalSubscription(Subscription):
+    def __init__(self, broker: "LocalBroker | ChangeBroker", cursor: int, reset: bool):
+        self.broker = broker
+        self.cursor = cursor  # Sequence number of the last event returned
+        self.reset = reset
+
+    def get(self, timeout: float) -> list[Event]:
+        broker = self.broker
+        with broker.condition:
+            if self.reset:
+                self.reset = False
+                return [broker.reset_event()]
+            broker.condition.wait_for(lambda: broker.last > self.cursor, timeout)
+            if broker.last - self.cursor > len(broker.replay):
+                # Fell behind by more than the replay buffer holds
+                self.cursor = broker.last
+                return [broker.reset_event()]
+            events = [e for seq, e in broker.replay if seq > self.cursor]
+            self.cursor = broker.last
+            return events
+
+
+class LocalBroker(Broker):
+    """In process broker, keeping the last replay_size events for replay
+
+    Args:
+        replay_size: Events kept for reconnecting clients, defaults to
+            ``Events.replay_size``
+    """
+
+    def __init__(self, replay_size: int | None = None):
+        if replay_size is None:
+            replay_size = CONFIG.Events.replay_size
+        self.replay_size = replay_size
+        self._reset()
+
+    def _reset(self):
+        self.replay: collections.deque[tuple[int, Event]] = collections.deque(
+            maxlen=self.replay_size
+        )
+        self.condition = threading.Condition()
+        self.last = 0  # Sequence number of the last event published
+        # Ids are only meaningful to the broker that made them, e.g. not after
+        # a restart or to another worker
+        self.epoch = uuid.uuid4().hex[:8]
+
+    def reset_event(self) -> Event:
+        return Event(f"{self.epoch}-{self.last}", "reset", {})
+
+    def publish(self, kind: str, data: dict):
+        with self.condition:
+            self.last += 1
+            self.replay.append(
+                (self.last, Event(f"{self.epoch}-{self.last}", kind, data))
+            )
+            self.condition.notify_all()
+
+    def subscribe(self, last_id: str | None = None) -> Subscription:
+        with self.condition:
+            if last_id is None:
+                return _LocalSubscription(self, self.last, reset=False)
+            epoch, _, seq = last_id.partition("-")
+            if epoch == self.epoch and seq.isdigit() and int(seq) <= self.last:
+                oldest = self.replay[0][0] if self.replay else self.last + 1
+                if int(seq) >= oldest - 1:
+                    return _LocalSubscription(self, int(seq), reset=False)
+            return _LocalSubscription(self, self.last, reset=True)
+
+    def after_fork(self):
+        # Events published in the parent were never seen by this worker's clients
+        self._reset()
+
+
+class ChangeBroker(Broker):
+    """Broker shared by every worker through the database's change table
+
+    Each process polls the changes written since its last poll (see
+    ``DatabaseHook.fetch_change_log``), so subscribers receive the changes of
+    every worker, and host, sharing the database. Event ids are the changes'
+    sequence numbers, which mean the same to every process, so a client may
+    reconnect to any worker that still holds the events it missed.
+
+    Sequence numbers are handed out before commit, so a slow transaction may
+    commit a change numbered below one already published. Polls therefore
+    start from the last change older than settle_seconds, skipping those
+    already published.
+
+    Args:
+        meta_hook: Whose change table is polled
+        replay_size: Events kept for reconnecting clients, defaults to
+            ``Events.replay_size``
+        poll_seconds: Between polls, defaults to ``Events.poll_seconds``
+        settle_seconds: Longer than any write transaction takes, defaults to
+            ``Sync.settle_seconds``
+    """
+
+    def __init__(
+        self,
+        meta_hook: "DatabaseHook",
+        replay_size: int | None = None,
+        poll_seconds: float | None = None,
+        settle_seconds: float | None = None,
+    ):
+        self.meta_hook = meta_hook
+        self.replay_size = (
+            CONFIG.Events.replay_size if replay_size is None else replay_size
+        )
+        self.poll_seconds = (
+            CONFIG.Events.poll_seconds if poll_seconds is None else poll_seconds
+        )
+        self.settle_seconds = (
+            CONFIG.Sync.settle_seconds if settle_seconds is None else settle_seconds
+        )
+        self._reset()
+
+    @classmethod
+    def create(cls, meta_hook: "DatabaseHook") -> "ChangeBroker":
+        return cls(meta_hook)
+
+    def _reset(self):
+        # Shares LocalBroker's replay buffer layout, so _LocalSubscription
+        # works for both. Positions are local to this process, ids are not
+        self.replay: collections.deque[tuple[int, Event]] = collections.deque(
+            maxlen=self.replay_size
+        )
+        self.condition = threading.Condition()
+        self.last = 0  # Position of the last event published
+        self.newest = 0  # Highest sequence number published
+        self.settled = 0  # Every change up to here was published
+        self.published: set[int] = set()  # Sequence numbers above settled
+        self._poll_lock = threading.Lock()  # Guards settled and published
+        self._wake = threading.Event()
+        self._poller: threading.Thread | None = None
+
+    def reset_event(self) -> Event:
+        return Event(str(self.newest), "reset", {})
+
+    def _start(self):
+        with self.condition:
+            if self._poller is not None:
+                return
+            # Only changes written from now on are published
+            self.settled = self.newest = self.meta_hook.last_change_seq()
+            self._poller = threading.Thread(
+                target=self._poll_forever, name="change-events", daemon=True
+            )
+            self._poller.start()
+
+    def _poll_forever(self):
+        while True:
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception:
+                LOGGER.exception("Polling the change table for events failed")
+
+    def poll(self):
+        """Publishes the changes written since the last poll"""
+        with self._poll_lock:
+            while True:
+                settled_at = dt.datetime.now(dt.timezone.utc) - dt.timedelta(
+                    seconds=self.settle_seconds
+                )
+                changes = self.meta_hook.fetch_change_log(self.settled, POLL_LIMIT)
+                settled = self.settled
+                for change in changes:
+                    if change.changed_at > settled_at:
+                        break
+                    settled = change.seq
+                new = [change for change in changes if change.seq not in self.published]
+                with self.condition:
+                    for change in new:
+                        action = change.action or (
+                            "deleted" if change.deleted else "updated"
+                        )
+                        self.last += 1
+                        self.newest = max(self.newest, change.seq)
+                        event = Event(
+                            str(change.seq),
+                            change.kind,
+                            {"action": action, "id": change.record_id},
+                        )
+                        self.replay.append((self.last, event))
+                    if new:
+                        self.condition.notify_all()
+                self.published.update(change.seq for change in new)
+                self.published = {seq for seq in self.published if seq > settled}
+                done = len(changes) < POLL_LIMIT or settled == self.settled
+                self.settled = settled
+                if done:
+                    return
+
+    def publish(self, kind: str, data: dict):
+        # Written to the change table already, so just poll it sooner
+        self._start()
+        self._wake.set()
+
+    def subscribe(self, last_id: str | None = None) -> Subscription:
+        self._start()
+        with self.condition:
+            if last_id is None or last_id == str(self.newest):
+                return _LocalSubscription(self, self.last, reset=False)
+            for position, event in self.replay:
+                if event.id == last_id:
+                    return _LocalSubscription(self, position, reset=False)
+            return _LocalSubscription(self, self.last, reset=True)
+
+    def after_fork(self):
+        # The parent's poller thread does not exist in this worker
+        self._reset()
+
+
+def get_broker(name: str, meta_hook: "DatabaseHook") -> Broker:
+    """The broker called name, created for the app using meta_hook"""
+    if (target := BROKERS.get(name)) is not None:
+        module, _, attr = target.partition(":")
+        return getattr(importlib.import_module(module), attr).create(meta_hook)
+    for entry_point in entry_points(group="receipt_database.brokers", name=name):
+        return entry_point.load().create(meta_hook)
+    raise ValueError(
+        f"Unknown broker {name!r}, expected one of {', '.join(BROKERS)}"
+        " or a receipt_database.brokers entry point"
+    )
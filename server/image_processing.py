@@ -0,0 +1,114 @@
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+from configure import CONFIG
+
+SUFFIXES = {"WEBP": ".webp", "JPEG": ".jpg", "PNG": ".png"}
+
+
+def optimize_image(
+    image: bytes, max_dimension: int, format_: str, quality: int
+) -> Optional[bytes]:
+    """Re-encodes an image for storage
+
+    The image is rotated according to its EXIF orientation, shrunk to fit within
+    max_dimension and saved without any metadata (EXIF, GPS, etc.).
+    PNG input (usually screenshots) is re-encoded losslessly.
+
+    Args:
+        image: The uploaded image
+        max_dimension: Maximum width and height in pixels
+        format_: Pillow format name to encode as
+        quality: Encoder quality for lossy formats, 1-100
+
+    Returns:
+        The re-encoded image, or None if image is not an image Pillow can read
+        (e.g. truncated, corrupt or a decompression bomb)
+    """
+    from PIL import Image, ImageOps
+
+    if format_ not in SUFFIXES:
+        raise ValueError(f"Unsupported format {format_}")
+
+    try:
+        # Pillow raises OSError for unidentified or truncated images, and
+        # ValueError for some corrupt ones. Images are only decoded once used.
+        with Image.open(BytesIO(image)) as im:
+            lossless = im.format == "PNG"
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((max_dimension, max_dimension))  # Never enlarges
+
+            match format_:
+                case "WEBP":
+                    options = {"quality": quality, "method": 4, "lossless": lossless}
+                case "JPEG":
+                    if im.mode not in ("RGB", "L"):
+                        im = im.convert("RGB")
+                    options = {
+                        "quality": quality,
+                        "optimize": True,
+                        "progressive": True,
+                    }
+                case _:
+                    options = {"optimize": True}
+
+            out = BytesIO()
+            im.save(out, format_, **options)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return out.getvalue()
+
+
+class ImageOptimizer:
+    """Runs optimize_image in a pool of worker processes"""
+
+    def __init__(self):
+        self.config = CONFIG.Ingest
+        if importlib.util.find_spec("PIL") is None:
+            raise ImportError("Ingest.optimize requires Pillow to be installed")
+        self._pool: ProcessPoolExecutor | None = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Forking a process with running threads is unsafe, so spawn instead
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.config.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def optimize(self, image: bytes, filename: str) -> Optional[tuple[bytes, str]]:
+        """Optimizes an uploaded image
+
+        Args:
+            image: The uploaded image
+            filename: The uploaded filename
+
+        Returns:
+            The optimized image and a filename with a matching suffix, or None
+            if the upload is not a readable image or would not get smaller
+            (e.g. an already compressed JPEG)
+        """
+        future = self._executor().submit(
+            optimize_image,
+            image,
+            self.config.max_dimension,
+            self.config.format,
+            self.config.quality,
+        )
+        if (optimized := future.result()) is None or len(optimized) >= len(image):
+            return None
+        return optimized, Path(filename).stem + SUFFIXES[self.config.format]
+
+    def after_fork(self):
+        # The parent's pool belongs to the parent, start a new one when needed
+        self._pool = None
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
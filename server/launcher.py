@@ -0,0 +1,148 @@
+"""Production entry point, serving the app with gunicorn
+
+The app is created once in the master process (``preload_app``), so workers
+start quickly and share its memory copy-on-write. Each worker then recreates
+its connection pools and clients (see ``app.after_fork``).
+
+Signals sent to the master:
+    HUP: Re-reads the config, creates a new app and gracefully replaces the
+        workers. Code changes need USR2 (start a new master) then TERM to the
+        old one instead.
+    TERM: Graceful shutdown, workers finish their current requests.
+    TTIN/TTOU: Add or remove a worker.
+
+Usage:
+    python launcher.py [--bind HOST:PORT] [--workers N] [--threads N]
+"""
+
+import argparse
+import os
+import tempfile
+from typing import Any
+
+from gunicorn.app.base import BaseApplication
+
+import metrics
+from app_logging import LOGGER
+from configure import CONFIG, get_config
+
+
+def cpu_count() -> int:
+    """CPUs this process may run on, which can be fewer than the machine has"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _post_fork(server, worker):
+    from app import after_fork
+
+    after_fork(server.app.wsgi())
+
+
+def _worker_exit(server, worker):
+    metrics.flush()  # Counted since the last periodic flush
+
+
+def _child_exit(server, worker):
+    # In the master, once the worker's final flush (worker_exit) is written
+    metrics.process_exited(worker.pid)
+
+
+class Launcher(BaseApplication):
+    """Runs create_app in gunicorn with settings from CONFIG.Server
+
+    Args:
+        options: gunicorn settings overriding the config
+    """
+
+    def __init__(self, options: dict[str, Any] | None = None):
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        config = CONFIG.Server
+        threads = max(1, config.threads)
+        settings = {
+            "bind": config.bind,
+            "workers": config.workers or cpu_count(),
+            "threads": threads,
+            "worker_class": "gthread" if threads > 1 else "sync",
+            "timeout": config.timeout,
+            "graceful_timeout": config.graceful_timeout,
+            "max_requests": config.max_requests,
+            # Stagger restarts so workers are not all replaced at once
+            "max_requests_jitter": config.max_requests // 10,
+            "preload_app": True,
+            "post_fork": _post_fork,
+            "worker_exit": _worker_exit,
+            "child_exit": _child_exit,
+        }
+        settings.update(
+            (key, value) for key, value in self.options.items() if value is not None
+        )
+        for key, value in settings.items():
+            self.cfg.set(key, value)
+        self._share_metrics()
+        self._share_events()
+
+    def _share_events(self):
+        config = CONFIG.Events
+        if not config.enabled or self.cfg.workers < 2:
+            return
+        if config.broker == "Local":
+            # Clients would miss the changes made by every other worker
+            LOGGER.warning(
+                "The Local Events.broker only reaches clients of one worker,"
+                " using the Changes broker for %d workers",
+                self.cfg.workers,
+            )
+        if config.broker in (None, "Local"):
+            config.broker = "Changes"
+
+    def _share_metrics(self):
+        config = CONFIG.Metrics
+        if not config.enabled or self.cfg.workers < 2:
+            return
+        if not config.multiprocess:
+            LOGGER.warning(
+                "/metrics only reports the worker answering each scrape; enable"
+                " Metrics.multiprocess for %d workers",
+                self.cfg.workers,
+            )
+        elif metrics._multiprocess_dir is None:  # Kept across reloads
+            directory = config.multiprocess_dir or tempfile.mkdtemp(
+                prefix="receipt-metrics-"
+            )
+            metrics.enable_multiprocess(directory, clear=True)
+            LOGGER.info("Workers share metrics through %s", directory)
+
+    def load(self):
+        from app import create_app
+
+        return create_app()
+
+    def reload(self):
+        # Called in the master on HUP, before the new workers are forked
+        get_config.cache_clear()
+        self.callable = None  # Preloading creates a new app from the new config
+        super().reload()
+        LOGGER.info("Reloaded config, replacing workers")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receipt Database server")
+    parser.add_argument("--bind", help="Address to listen on, e.g. 0.0.0.0:8000")
+    parser.add_argument("--workers", type=int, help="Worker processes")
+    parser.add_argument("--threads", type=int, help="Threads per worker")
+    args = parser.parse_args()
+
+    options: dict[str, Any] = {"bind": args.bind, "workers": args.workers}
+    if args.threads is not None:
+        options["threads"] = args.threads
+        options["worker_class"] = "gthread" if args.threads > 1 else "sync"
+    Launcher(options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+"""In-process metrics in the Prometheus text exposition format
+
+Metrics are module level objects registered in ``REGISTRY`` when created.
+Updating one is a dictionary lookup under a lock, so instrumenting hot paths
+is cheap. ``render`` produces the body for the ``/metrics`` endpoint.
+
+With several worker processes, a scrape only reaches one of them. After
+``enable_multiprocess``, each process writes a snapshot of its metrics to a
+shared directory every ``FLUSH_SECONDS`` (and when it forks or exits), and
+``render`` combines them: counters and histograms are summed over every process
+that ever wrote one, so they don't drop when a worker is replaced, and gauges
+are reported per live process with a ``pid`` label. Once a process exited, the
+one outliving it (gunicorn's master) calls ``process_exited`` to fold its
+snapshot into that of all exited processes, so snapshots don't pile up.
+"""
+
+import abc
+import functools
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from typing import Any, Callable, Iterable
+
+LabelValues = tuple[str, ...]
+Items = list[tuple[LabelValues, Any]]
+
+FLUSH_SECONDS = 1  # How stale other processes' metrics may be in a scrape
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY: list["_Metric"] = []
+
+_multiprocess_dir: str | None = None
+_flusher: threading.Thread | None = None
+# Names this process's snapshot, with its pid, which a later process may reuse
+_snapshot_name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+# Counters and histograms of exited processes, see process_exited
+EXITED_SNAPSHOT = "exited.json"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(abc.ABC):
+    type_ = "untyped"
+    # Summed over processes, otherwise reported per process
+    cumulative = False
+
+    def __init__(self, name: str, help_: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    @abc.abstractmethod
+    def items(self) -> Items:
+        """A copy of the current value of each set of label values"""
+
+    @staticmethod
+    def _add(value: Any, other: Any) -> Any:
+        return value + other
+
+    def _reset(self):
+        """Forgets values, e.g. those a forked process inherited"""
+
+    def _samples(self, items: Items, labelnames: tuple[str, ...]) -> Iterable[str]:
+        for labels, value in items:
+            label_str = _format_labels(labelnames, labels)
+            yield f"{self.name}{label_str} {_format_value(value)}"
+
+    def render(self, snapshots: dict[str, dict[str, Items]] | None = None) -> str:
+        """Renders the metric, combined with other processes' snapshots if given"""
+        items, labelnames = self.items(), self.labelnames
+        if snapshots is not None:
+            items, labelnames = self._combine(items, snapshots)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_}"]
+        lines.extend(self._samples(items, labelnames))
+        return "\n".join(lines)
+
+    def _combine(
+        self, items: Items, snapshots: dict[str, dict[str, Items]]
+    ) -> tuple[Items, tuple[str, ...]]:
+        if not self.cumulative:
+            pid = str(os.getpid())
+            combined = [(labels + (pid,), value) for labels, value in items]
+            for name, snapshot in snapshots.items():
+                other_pid = name.partition("-")[0]
+                if other_pid.isdigit() and _alive(int(other_pid)):
+                    combined.extend(
+                        (labels + (other_pid,), value)
+                        for labels, value in snapshot.get(self.name, ())
+                    )
+            return combined, self.labelnames + ("pid",)
+        totals = dict(items)
+        for snapshot in snapshots.values():
+            self._fold(totals, snapshot.get(self.name, ()))
+        return list(totals.items()), self.labelnames
+
+    def _fold(self, totals: dict[LabelValues, Any], items: Iterable[tuple]):
+        """Adds items to totals, for metrics summed over processes"""
+        for labels, value in items:
+            if labels in totals:
+                totals[labels] = self._add(totals[labels], value)
+            else:
+                totals[labels] = value
+
+
+class Counter(_Metric):
+    """A value that only increases, such as a number of requests"""
+
+    type_ = "counter"
+    cumulative = True
+
+    def __init__(self, name: str, help_: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help_, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def items(self) -> Items:
+        with self._lock:
+            return list(self._values.items())
+
+    def _reset(self):
+        self._values = {}
+
+
+class Gauge(Counter):
+    """A value that can go up and down"""
+
+    type_ = "gauge"
+    cumulative = False
+
+    def set(self, *labels: str, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+
+class CallbackGauge(_Metric):
+    """A gauge whose values are read from a callback when scraped
+
+    Args:
+        callback: Returns a mapping of label values to the current value
+    """
+
+    type_ = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help_: str,
+        labelnames: Iterable[str],
+        callback: Callable[[], dict[LabelValues, float]],
+    ):
+        super().__init__(name, help_, labelnames)
+        self.callback = callback
+
+    def items(self) -> Items:
+        return list(self.callback().items())
+
+
+class Histogram(_Metric):
+    """Counts observations (e.g. latencies) into cumulative buckets"""
+
+    type_ = "histogram"
+    cumulative = True
+
+    def __init__(
+        self,
+        name: str,
+        help_: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help_, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label values -> [per bucket counts..., sum]
+        self._values: dict[LabelValues, list[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            if (counts := self._values.get(labels)) is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *labels: str) -> int:
+        counts = self._values.get(labels)
+        return int(sum(counts[:-1])) if counts else 0
+
+    def items(self) -> Items:
+        with self._lock:
+            return [(labels, counts[:]) for labels, counts in self._values.items()]
+
+    @staticmethod
+    def _add(value: list[float], other: list[float]) -> list[float]:
+        return [a + b for a, b in zip(value, other)]
+
+    def _reset(self):
+        self._values = {}
+
+    def _samples(self, items: Items, labelnames: tuple[str, ...]) -> Iterable[str]:
+        for labels, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                label_str = _format_labels(
+                    labelnames + ("le",), labels + (_format_value(bound),)
+                )
+                yield f"{self.name}_bucket{label_str} {cumulative}"
+            label_str = _format_labels(labelnames, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{label_str} {cumulative}"
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Exists, but belongs to another user
+        return True
+    return True
+
+
+def enable_multiprocess(directory: str, clear: bool = False):
+    """Shares metrics between the processes using directory, see the module docs
+
+    Args:
+        directory: Holds a snapshot file per process
+        clear: Remove the snapshots of an earlier run, e.g. when starting a server
+    """
+    global _multiprocess_dir
+    os.makedirs(directory, exist_ok=True)
+    if clear:
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            os.remove(path)
+    _multiprocess_dir = directory
+
+
+def flush():
+    """Writes this process's snapshot, when metrics are shared between processes"""
+    if (directory := _multiprocess_dir) is None:
+        return
+    snapshot = {metric.name: metric.items() for metric in REGISTRY}
+    _write_snapshot(os.path.join(directory, _snapshot_name), snapshot)
+
+
+def _write_snapshot(path: str, snapshot: dict[str, Items]):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(snapshot, file)  # Label value tuples become lists
+    os.replace(temp_path, path)  # Readers never see a partly written snapshot
+
+
+def _read_snapshot(path: str) -> dict[str, Items] | None:
+    try:
+        with open(path) as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        return None
+    return {
+        name: [(tuple(labels), value) for labels, value in items]
+        for name, items in data.items()
+    }
+
+
+def _read_snapshots() -> dict[str, dict[str, Items]]:
+    """Other processes' snapshots by file name, <pid>-<random>.json, and the
+    snapshot of exited processes"""
+    snapshots = {}
+    for path in glob.glob(os.path.join(_multiprocess_dir or "", "*.json")):
+        if (name := os.path.basename(path)) == _snapshot_name:
+            continue  # Rendered from memory instead, which is up to date
+        if (snapshot := _read_snapshot(path)) is not None:
+            snapshots[name] = snapshot
+    return snapshots
+
+
+def process_exited(pid: int):
+    """Folds the snapshots of an exited process into that of exited processes
+
+    Its counters and histograms are kept, summed with those of the processes
+    that exited before, and its gauges are dropped. Called by a process that
+    outlives it, e.g. gunicorn's master in launcher.py, which is the only one
+    writing the exited processes' snapshot.
+    """
+    if (directory := _multiprocess_dir) is None:
+        return
+    paths = glob.glob(os.path.join(directory, f"{pid}-*.json"))
+    if not paths:
+        return
+    exited_path = os.path.join(directory, EXITED_SNAPSHOT)
+    exited = _read_snapshot(exited_path) or {}
+    for path in paths:
+        snapshot = _read_snapshot(path) or {}
+        for metric in REGISTRY:
+            if metric.cumulative and metric.name in snapshot:
+                totals = dict(exited.get(metric.name, ()))
+                metric._fold(totals, snapshot[metric.name])
+                exited[metric.name] = list(totals.items())
+    _write_snapshot(exited_path, exited)
+    for path in paths:
+        os.remove(path)
+
+
+def _run_flusher():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush()
+        except OSError:
+            pass  # Tried again shortly
+
+
+def _start_flusher():
+    global _flusher
+    if _multiprocess_dir is not None and _flusher is None:
+        _flusher = threading.Thread(
+            target=_run_flusher, name="metrics-flusher", daemon=True
+        )
+        _flusher.start()
+
+
+def _flush_before_fork():
+    try:
+        flush()
+    except OSError:
+        pass
+
+
+def _after_fork_in_child():
+    global _flusher, _snapshot_name
+    _snapshot_name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+    # A lock held by another thread while forking would never be released
+    for metric in REGISTRY:
+        metric._lock = threading.Lock()
+    if _multiprocess_dir is not None:
+        # The parent's values are in its own snapshot, written before forking
+        for metric in REGISTRY:
+            metric._reset()
+        _flusher = None
+        _start_flusher()
+
+
+os.register_at_fork(before=_flush_before_fork, after_in_child=_after_fork_in_child)
+
+
+def render() -> str:
+    """Renders every registered metric in the Prometheus text format"""
+    snapshots = _read_snapshots() if _multiprocess_dir is not None else None
+    return "\n".join(metric.render(snapshots) for metric in REGISTRY) + "\n"
+
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests handled", ("route", "method", "status")
+)
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("route", "method")
+)
+HTTP_BYTES = Counter(
+    "http_bytes_total", "HTTP body bytes transferred", ("route", "direction")
+)
+HOOK_LATENCY = Histogram(
+    "hook_operation_duration_seconds",
+    "Storage hook operation latency",
+    ("hook", "operation"),
+)
+HOOK_ERRORS = Counter(
+    "hook_operation_errors_total",
+    "Storage hook operations that raised an exception",
+    ("hook", "operation", "error"),
+)
+S3_REQUESTS = Counter(
+    "s3_requests_total", "S3 HTTP requests by operation", ("operation", "status")
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Cache lookups by result", ("cache", "result")
+)
+HOOK_TIMEOUTS = Counter(
+    "hook_timeouts_total", "Storage hook operations that timed out", ("hook",)
+)
+HEDGED_REQUESTS = Counter(
+    "hedged_requests_total",
+    "Duplicate reads sent to slow backends, and how often they answered first",
+    ("hook", "result"),
+)
+CIRCUIT_REJECTIONS = Counter(
+    "circuit_rejections_total",
+    "Storage hook calls failed fast by an open circuit",
+    ("hook",),
+)
+
+
+def timed(func: Callable) -> Callable:
+    """Records the latency and errors of a storage hook method"""
+    operation = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        except Exception as e:
+            HOOK_ERRORS.inc(type(self).__name__, operation, type(e).__name__)
+            raise
+        finally:
+            HOOK_LATENCY.observe(
+                time.perf_counter() - start, type(self).__name__, operation
+            )
+
+    wrapper.__timed__ = True
+    return wrapper
+
+
+def instrument(cls: type, operations: Iterable[str]):
+    """Wraps the given methods defined directly on cls with ``timed``"""
+    for name in operations:
+        method = cls.__dict__.get(name)
+        if callable(method) and not getattr(method, "__timed__", False):
+            setattr(cls, name, timed(method))
@@ -2,7 +2,7 @@ from datetime import datetime, timezone
 from typing import Sequence
 from warnings import warn
 
-from sqlalchemy import Column, DateTime, ForeignKey, Table, TypeDecorator
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Table, TypeDecorator
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.sql.expression import func
 
@@ -31,6 +31,10 @@ class TZDateTime(TypeDecorator):
         return value
 
 
+def _now() -> datetime:
+    return datetime.now(UTC)
+
+
 """Intermediary table for many-to-many relationship between receipts and tags"""
 receipt_tag = Table(
     "receipt_tag",
@@ -62,10 +66,18 @@ class Receipt(Base):
     __tablename__ = "receipt"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     name: Mapped[str | None] = mapped_column(default="Unnamed")
-    storage_key: Mapped[str]
+    storage_key: Mapped[str] = mapped_column(index=True)
+    # Image exactly as uploaded, when kept alongside an optimized storage_key
+    original_key: Mapped[str | None] = mapped_column(default=None, index=True)
+    # Resumable upload it was created from, so completing that again returns it
+    upload_id: Mapped[str | None] = mapped_column(default=None, unique=True)
     upload_dt: Mapped[datetime] = mapped_column(
         type_=TZDateTime, server_default=func.now()
     )
+    # Last change to the receipt or its tags, None if unchanged since migrating
+    updated_at: Mapped[datetime | None] = mapped_column(
+        type_=TZDateTime, default=_now, onupdate=_now
+    )
     tags: Mapped[Sequence[Tag]] = relationship(
         secondary=receipt_tag, collection_class=list
     )
@@ -85,3 +97,102 @@ class Receipt(Base):
             "upload_dt": str(self.upload_dt),
             "tags": [t.id for t in self.tags],
         }
+
+
+class ReceiptRow:
+    """A receipt as listed, read without the ORM (see
+    ``DatabaseHook.fetch_receipt_rows``)"""
+
+    __slots__ = ("id", "name", "storage_key", "upload_dt", "tags")
+
+    def __init__(
+        self,
+        id: int,
+        name: str | None,
+        storage_key: str,
+        upload_dt: datetime,
+        tags: list[int],
+    ):
+        self.id = id
+        self.name = name
+        self.storage_key = storage_key
+        self.upload_dt = upload_dt
+        self.tags = tags  # Tag ids
+
+    def export(self) -> dict:
+        """The same as ``Receipt.export``"""
+        if self.name == "":
+            warn(f"Receipt.name is empty for {self.id = }")
+        return {
+            "id": self.id,
+            "name": self.name,
+            "storage_key": self.storage_key,
+            "upload_dt": str(self.upload_dt),
+            "tags": self.tags,
+        }
+
+
+class Change(Base):
+    """The latest change to a receipt or tag, for clients syncing changes
+
+    Each write replaces the record's previous change, so there is at most one
+    row per record, tombstones included. ``seq`` orders changes by when they
+    were written and serves as the sync token (see ``DatabaseHook.fetch_changes``).
+    """
+
+    __tablename__ = "change"
+    __table_args__ = (
+        Index("change_record", "kind", "record_id"),
+        # Otherwise SQLite reuses the highest seq once its change is replaced
+        {"sqlite_autoincrement": True},
+    )
+
+    seq: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    kind: Mapped[str]  # The table of the record, "receipt" or "tag"
+    record_id: Mapped[int]
+    deleted: Mapped[bool] = mapped_column(default=False)
+    # "created", "updated" or "deleted", for change events. None when recorded
+    # for an existing record (see DatabaseHook.update_storage)
+    action: Mapped[str | None]
+    changed_at: Mapped[datetime] = mapped_column(type_=TZDateTime, default=_now)
+
+
+class ChangeSet:
+    """Records changed since a sync token, and the token to sync from next"""
+
+    __slots__ = (
+        "token",
+        "receipts",
+        "tags",
+        "deleted_receipts",
+        "deleted_tags",
+        "more",
+    )
+
+    def __init__(
+        self,
+        token: int,
+        receipts: list[ReceiptRow],
+        tags: Sequence[Tag],
+        deleted_receipts: list[int],
+        deleted_tags: list[int],
+        more: bool = False,
+    ):
+        self.token = token
+        self.receipts = receipts
+        self.tags = tags
+        self.deleted_receipts = deleted_receipts
+        self.deleted_tags = deleted_tags
+        self.more = more  # Fetch again from token for the rest
+
+    def export(self) -> dict:
+        return {
+            "token": self.token,
+            "receipts": [r.export() for r in self.receipts],
+            "tags": [t.export() for t in self.tags],
+            "deleted": {
+                "receipts": self.deleted_receipts,
+                "tags": self.deleted_tags,
+            },
+            "more": self.more,
+        }
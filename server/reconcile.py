@@ -0,0 +1,307 @@
+"""Finds (and optionally deletes) images without a receipt and vice versa
+
+Uploads save the image before its receipt and deletes remove the receipt
+before its image, so a crash in between leaves an orphaned image or a receipt
+whose image is missing ("dangling").
+
+Both key sets are streamed into a scratch SQLite database on disk and compared
+there, so memory use does not grow with the number of images. Images newer than
+the grace period are never treated as orphans, as their receipt may still be
+being created. ``FileHook.save`` touches an image that is saved again, so a
+new upload of an old image is not mistaken for an orphan either.
+
+Deleting the last receipt of a content addressed image defers deleting the
+image, see ``DeferredDeletes``.
+
+Reconcile runs with ``configure.py reconcile``, or periodically in the server
+when ``Reconcile.interval_seconds`` is set, see ``PeriodicReconcile``.
+"""
+
+import heapq
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Iterable, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the server runs one process
+    fcntl = None
+
+from app_logging import LOGGER
+from storage_hooks.storage_hooks import DatabaseHook, FileHook
+
+
+@dataclass
+class ReconcileReport:
+    images: int = 0  # Images in the file hook
+    orphans: int = 0  # Images older than the grace period without a receipt
+    deleted: int = 0
+    dangling: int = 0  # Receipt keys without an image
+    orphan_sample: list[str] = field(default_factory=list)
+    dangling_sample: list[str] = field(default_factory=list)
+
+
+class DeferredDeletes:
+    """Deletes content addressed images some time after their last receipt
+
+    An upload of an image that is already stored gets its key back from
+    ``save`` but only commits its receipt at the end of the request, so an
+    image can't be deleted as soon as no receipt references it. Instead it is
+    checked again after delay seconds, and only deleted when it is still
+    unreferenced and was not saved again meanwhile. Deletes still pending when
+    the process exits are left to ``reconcile``.
+
+    Args:
+        meta_hook: Holds the receipts
+        file_hook: Holds the images
+        delay: Seconds to wait, longer than requests take. At most 0 to delete
+            straight away
+    """
+
+    # LastModified of S3 objects is in whole seconds
+    MODIFIED_MARGIN = 1
+
+    def __init__(self, meta_hook: DatabaseHook, file_hook: FileHook, delay: float):
+        self.meta_hook = meta_hook
+        self.file_hook = file_hook
+        self.delay = delay
+        self._reset()
+
+    def _reset(self):
+        # (due as monotonic time, time added, key), soonest due first
+        self._pending: list[tuple[float, float, str]] = []
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+    def add(self, key: str):
+        """Deletes key after the delay, unless it is used again"""
+        if self.delay <= 0:
+            self._delete(key, float("inf"))
+            return
+        with self._condition:
+            heapq.heappush(
+                self._pending, (time.monotonic() + self.delay, time.time(), key)
+            )
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="deferred-deletes", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def run_due(self, now: float | None = None) -> int:
+        """Runs the deletes due by now (monotonic), returning how many deleted"""
+        now = time.monotonic() if now is None else now
+        due = []
+        with self._condition:
+            while self._pending and self._pending[0][0] <= now:
+                due.append(heapq.heappop(self._pending))
+        return sum(self._delete(key, added) for _, added, key in due)
+
+    def _delete(self, key: str, added: float) -> bool:
+        try:
+            if self.meta_hook.count_references(key):
+                return False
+            modified = self.file_hook.modified(key)
+            if modified is not None and modified >= added - self.MODIFIED_MARGIN:
+                return False  # Saved again, its receipt may not be committed yet
+            self.file_hook.delete(key)
+        except FileNotFoundError:
+            return False
+        except Exception:
+            LOGGER.exception("Failed to delete unreferenced image %s", key)
+            return False
+        LOGGER.info("Deleted unreferenced image %s", key)
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                self._condition.wait(self._pending[0][0] - time.monotonic())
+            self.run_due()
+
+    def after_fork(self):
+        # The parent's thread does not exist here
+        self._reset()
+
+
+def _batches(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def reconcile(
+    meta_hook: DatabaseHook,
+    file_hook: FileHook,
+    *,
+    delete: bool = False,
+    grace_seconds: float = 3600,
+    batch_size: int = 1000,
+    sample_size: int = 20,
+) -> ReconcileReport:
+    """Compares the images in file_hook with the keys referenced in meta_hook
+
+    Args:
+        meta_hook: Holds the receipts
+        file_hook: Holds the images
+        delete: Delete orphaned images, otherwise only report them
+        grace_seconds: Ignore images and receipts newer than this
+        batch_size: Keys inserted, compared or deleted at a time
+        sample_size: Number of orphaned and dangling keys kept in the report
+
+    Returns:
+        ReconcileReport: Counts and a sample of what was found
+    """
+    report = ReconcileReport()
+    cutoff = time.time() - grace_seconds
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        scratch = sqlite3.connect(os.path.join(scratch_dir, "reconcile.sqlite3"))
+        try:
+            scratch.executescript(
+                """
+                PRAGMA journal_mode = OFF;
+                PRAGMA synchronous = OFF;
+                CREATE TABLE image (key TEXT PRIMARY KEY, mtime REAL) WITHOUT ROWID;
+                CREATE TABLE ref (key TEXT, uploaded REAL);
+                """
+            )
+            # Images are listed before receipts are read, so that an upload in
+            # between is seen as a receipt without an image (and then excluded
+            # by the cutoff) rather than an orphaned image
+            for batch in _batches(file_hook.iter_keys(), batch_size):
+                scratch.executemany("INSERT OR IGNORE INTO image VALUES (?, ?)", batch)
+                report.images += len(batch)
+            for batch in _batches(meta_hook.iter_storage_keys(batch_size), batch_size):
+                scratch.executemany(
+                    "INSERT INTO ref VALUES (?, ?)",
+                    ((key, uploaded.timestamp()) for key, uploaded in batch),
+                )
+            scratch.execute("CREATE INDEX ref_key ON ref (key)")
+            scratch.commit()
+
+            orphans = scratch.execute(
+                "SELECT key FROM image WHERE mtime < ?"
+                " AND NOT EXISTS (SELECT 1 FROM ref WHERE ref.key = image.key)",
+                (cutoff,),
+            )
+            for batch in _batches((row[0] for row in orphans), batch_size):
+                report.orphans += len(batch)
+                report.orphan_sample.extend(
+                    batch[: sample_size - len(report.orphan_sample)]
+                )
+                if delete:
+                    # A receipt may have started using an image since it was listed
+                    referenced = meta_hook.referenced_keys(batch)
+                    victims = [key for key in batch if key not in referenced]
+                    file_hook.delete_many(victims)
+                    report.deleted += len(victims)
+                    LOGGER.info("Deleted %d orphaned images", len(victims))
+
+            dangling = scratch.execute(
+                "SELECT DISTINCT key FROM ref WHERE uploaded < ?"
+                " AND NOT EXISTS (SELECT 1 FROM image WHERE image.key = ref.key)",
+                (cutoff,),
+            )
+            for (key,) in dangling:
+                report.dangling += 1
+                if len(report.dangling_sample) < sample_size:
+                    report.dangling_sample.append(key)
+        finally:
+            scratch.close()
+
+    LOGGER.info(
+        "Reconciled %d images: %d orphaned, %d deleted, %d receipt keys dangling",
+        report.images,
+        report.orphans,
+        report.deleted,
+        report.dangling,
+    )
+    return report
+
+
+class PeriodicReconcile:
+    """Runs reconcile every interval seconds in one of the server's processes
+
+    Each process checks every interval seconds whether a run is due. The one
+    that gets the lock on lock_path runs it and records the time there, so the
+    workers of a host take turns instead of each running it. Hosts sharing the
+    storage each run it, which is safe as deletes recheck references.
+
+    Args:
+        meta_hook: Holds the receipts
+        file_hook: Holds the images
+        interval: Seconds between runs, at most 0 to never run
+        lock_path: File coordinating the processes
+        options: Passed to reconcile
+    """
+
+    def __init__(
+        self,
+        meta_hook: DatabaseHook,
+        file_hook: FileHook,
+        interval: float,
+        lock_path: str,
+        **options,
+    ):
+        self.meta_hook = meta_hook
+        self.file_hook = file_hook
+        self.interval = interval
+        self.lock_path = lock_path
+        self.options = options
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        """Starts checking in the background, unless disabled or started"""
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="periodic-reconcile", daemon=True
+            )
+            self._thread.start()
+
+    def run_if_due(self, now: float | None = None) -> ReconcileReport | None:
+        """Runs reconcile unless it ran less than interval seconds before now
+
+        Returns:
+            The report, or None when not due or running in another process
+        """
+        with open(self.lock_path, "a+") as file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+            file.seek(0)
+            try:
+                last = json.load(file)["started"]
+            except (ValueError, KeyError, TypeError):
+                last = 0  # Never ran
+            now = time.time() if now is None else now
+            if now - last < self.interval:
+                return None
+            report = reconcile(self.meta_hook, self.file_hook, **self.options)
+            file.seek(0)
+            file.truncate()
+            json.dump({"started": now}, file)
+            return report  # Unlocked by closing
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_if_due()
+            except Exception:
+                LOGGER.exception("Periodic reconcile failed")
+
+    def after_fork(self):
+        # The parent's thread does not exist here, the next request starts it
+        self._thread = None
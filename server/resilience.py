@@ -0,0 +1,337 @@
+"""Circuit breaking, timeouts and hedged reads for storage hook operations
+
+Hook operations (their ``timed_operations``) are wrapped by ``instrument``,
+and once ``protect`` gives a hook a ``Guard``, a degraded backend can no longer
+tie up every request thread:
+
+- A ``CircuitBreaker`` per hook opens after ``failure_threshold`` consecutive
+  failures. While open, calls fail immediately with ``CircuitOpenError`` (served
+  as 503 with Retry-After) until ``reset_seconds`` have passed, then a single
+  trial call decides whether it closes again.
+- Operations of remote hooks run on a thread pool and raise
+  ``HookTimeoutError`` after the configured timeout. The abandoned call keeps
+  its thread until the client's own timeouts end it, so timeouts count as
+  failures and open the circuit before the pool is exhausted.
+- Image fetches from remote hooks are hedged: when a fetch takes longer than
+  ``hedge_percentile`` of recent fetches, a duplicate is sent and whichever
+  answers first is used.
+
+Circuit states are exported as the ``circuit_breaker_state`` gauge.
+"""
+
+import collections
+import concurrent.futures
+import contextvars
+import functools
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from typing import Any, Callable, Iterable
+
+import metrics
+from app_logging import LOGGER
+
+# Errors caused by the request rather than the backend's health
+EXPECTED_ERRORS: tuple[type[BaseException], ...] = (
+    FileNotFoundError,
+    LookupError,
+    ValueError,
+)
+
+# The guard whose operation is running, so nested calls are not guarded again
+_active: contextvars.ContextVar["Guard | None"] = contextvars.ContextVar(
+    "resilience_guard", default=None
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend whose circuit is open"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class HookTimeoutError(TimeoutError):
+    """A storage hook operation took longer than its timeout"""
+
+
+class CircuitBreaker:
+    """Fails fast after repeated failures, until a trial call succeeds
+
+    Args:
+        name: Identifies the backend in errors, logs and metrics
+        failure_threshold: Consecutive failures that open the circuit
+        reset_seconds: Time the circuit stays open before a trial call
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self._opened_at = 0.0  # Monotonic time the circuit opened, 0 when closed
+        self._trial = False  # A half open trial call is in progress
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if not self._opened_at:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.reset_seconds:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before_call(self):
+        """Raises CircuitOpenError unless a call may be made now"""
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            retry_after = self._opened_at + self.reset_seconds - time.monotonic()
+        metrics.CIRCUIT_REJECTIONS.inc(self.name)
+        raise CircuitOpenError(self.name, max(retry_after, 1))
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at:
+                LOGGER.info("Circuit for %s closed", self.name)
+            self.failures = 0
+            self._opened_at = 0.0
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (
+                not self._opened_at and self.failures >= self.failure_threshold
+            ):
+                if not self._trial:
+                    LOGGER.warning(
+                        "Circuit for %s opened after %d failures",
+                        self.name,
+                        self.failures,
+                    )
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+class LatencyTracker:
+    """Percentiles of the most recent latencies of an operation
+
+    Args:
+        size: Number of recent latencies kept
+        min_samples: Latencies needed before percentiles are reported
+    """
+
+    def __init__(self, size: int = 1000, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._latencies: collections.deque[float] = collections.deque(maxlen=size)
+        self._sorted: list[float] = []
+        self._stale = 0  # Latencies added since _sorted was built
+
+    def add(self, seconds: float):
+        self._latencies.append(seconds)
+        self._stale += 1
+
+    def percentile(self, percent: float) -> float | None:
+        if len(self._latencies) < self.min_samples:
+            return None
+        # Sorting on every call would cost more than the fetch it may hedge
+        if self._stale >= 32 or not self._sorted:
+            self._sorted = sorted(self._latencies)
+            self._stale = 0
+        index = min(len(self._sorted) - 1, int(len(self._sorted) * percent / 100))
+        return self._sorted[index]
+
+
+class Guard:
+    """Protects the operations of one hook, see ``protect``
+
+    Args:
+        name: Identifies the hook in errors, logs and metrics
+        breaker: Shared by every operation of the hook
+        timeout: Seconds an operation may take, None to run it inline
+        hedge_percentile: Hedge reads slower than this percentile, None to never
+        hedge_min_delay: Seconds a read always gets before being hedged
+        workers: Threads running operations with a timeout or hedge
+        expected: Errors that do not count as failures
+    """
+
+    def __init__(
+        self,
+        name: str,
+        breaker: CircuitBreaker,
+        *,
+        timeout: float | None = None,
+        hedge_percentile: float | None = None,
+        hedge_min_delay: float = 0.01,
+        workers: int = 32,
+        expected: tuple[type[BaseException], ...] = EXPECTED_ERRORS,
+    ):
+        self.name = name
+        self.breaker = breaker
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.workers = workers
+        self.expected = expected
+        self.latencies = LatencyTracker()
+        self._executor: ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+        _GUARDS.add(self)
+
+    def after_fork(self):
+        # The parent's threads do not exist here
+        self._executor = None
+        self._lock = threading.Lock()
+        self.breaker._lock = threading.Lock()
+
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix=f"guard-{self.name}"
+                )
+        return self._executor
+
+    def _submit(self, func: Callable, *args, **kwargs) -> concurrent.futures.Future:
+        # Run in a copy of the caller's context, e.g. for SQL profiling
+        context = contextvars.copy_context()
+        return self.executor().submit(context.run, func, *args, **kwargs)
+
+    def call(self, func: Callable, *args, hedge: bool = False, **kwargs) -> Any:
+        """Calls func through the circuit breaker, with the timeout and hedging"""
+        self.breaker.before_call()
+        token = _active.set(self)
+        try:
+            if hedge and self.hedge_percentile is not None:
+                result = self._hedged(func, args, kwargs)
+            elif self.timeout is not None:
+                result = self._with_timeout(func, args, kwargs)
+            else:
+                result = func(*args, **kwargs)
+        except self.expected:
+            self.breaker.record_success()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        finally:
+            _active.reset(token)
+        self.breaker.record_success()
+        return result
+
+    def _timed_out(self, futures: list[concurrent.futures.Future]):
+        for future in futures:
+            future.cancel()  # Only succeeds if it has not started
+        metrics.HOOK_TIMEOUTS.inc(self.name)
+        raise HookTimeoutError(f"{self.name} did not answer within {self.timeout}s")
+
+    def _with_timeout(self, func: Callable, args: tuple, kwargs: dict) -> Any:
+        future = self._submit(func, *args, **kwargs)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            self._timed_out([future])
+
+    def _hedged(self, func: Callable, args: tuple, kwargs: dict) -> Any:
+        start = time.perf_counter()
+        deadline = None if self.timeout is None else start + self.timeout
+        delay = self.latencies.percentile(self.hedge_percentile)
+        futures = [self._submit(func, *args, **kwargs)]
+        if delay is not None:
+            delay = max(delay, self.hedge_min_delay)
+            if deadline is not None:
+                delay = min(delay, self.timeout)
+            done, _ = concurrent.futures.wait(futures, delay)
+            if not done and (deadline is None or time.perf_counter() < deadline):
+                metrics.HEDGED_REQUESTS.inc(self.name, "sent")
+                futures.append(self._submit(func, *args, **kwargs))
+
+        pending = set(futures)
+        error: BaseException | None = None
+        while pending:
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                self._timed_out(list(pending))
+            done, pending = concurrent.futures.wait(
+                pending, remaining, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if (error := future.exception()) is None:
+                    for other in pending:
+                        other.cancel()
+                    if future is not futures[0]:
+                        metrics.HEDGED_REQUESTS.inc(self.name, "won")
+                    self.latencies.add(time.perf_counter() - start)
+                    return future.result()
+        raise error
+
+
+def guarded(func: Callable, hedge: bool = False) -> Callable:
+    """Routes calls of a hook method through the hook's guard, once it has one
+
+    Args:
+        func: The method
+        hedge: The method only reads, so may be hedged
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        guard = self.__dict__.get("guard")
+        # Also skip calls made by the guarded method itself, e.g. to super()
+        if guard is None or _active.get() is guard:
+            return func(self, *args, **kwargs)
+        return guard.call(func, self, *args, hedge=hedge, **kwargs)
+
+    wrapper.__guarded__ = True
+    return wrapper
+
+
+def instrument(cls: type, operations: Iterable[str], hedged: Iterable[str] = ()):
+    """Wraps the given methods defined directly on cls with ``guarded``"""
+    hedged = set(hedged)
+    for name in operations:
+        method = cls.__dict__.get(name)
+        if callable(method) and not getattr(method, "__guarded__", False):
+            setattr(cls, name, guarded(method, hedge=name in hedged))
+
+
+def protect(hook: Any, guard: Guard):
+    """Protects the operations of hook with guard from now on"""
+    hook.guard = guard
+
+
+_GUARDS: "weakref.WeakSet[Guard]" = weakref.WeakSet()
+
+
+def _states() -> dict[metrics.LabelValues, float]:
+    return {
+        (guard.name,): CircuitBreaker.STATE_VALUES[guard.breaker.state]
+        for guard in list(_GUARDS)
+    }
+
+
+def _after_fork():
+    for guard in list(_GUARDS):
+        guard.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+CIRCUIT_STATE = metrics.CallbackGauge(
+    "circuit_breaker_state",
+    "Storage hook circuits: 0 closed, 1 half open, 2 open",
+    ("hook",),
+    _states,
+)
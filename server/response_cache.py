@@ -0,0 +1,137 @@
+"""Cache of serialized list responses, kept until the tables behind them change
+
+Clients poll the receipt and tag lists far more often than they are changed,
+so a cached view's body is stored with the write generations (see
+``storage_hooks.WriteGenerations``) of the tables it reads. Requests are served
+from the cache until one of those tables is written to, without touching the
+database. Compressed variants of a body are made once and kept with it, and
+each variant has an ETag, so an unchanged list is answered with 304.
+
+Writes the hook cannot count (other hosts, scripts) are picked up once an
+entry is ``cache_seconds`` old. Bodies are made from the primary database, as
+a read replica may not have the write that outdated the previous body yet.
+"""
+
+import collections
+import functools
+import hashlib
+import threading
+import time
+from typing import Callable
+
+from flask import Response, current_app, request
+
+import metrics
+from compression import best_encoding, compress
+from configure import CONFIG
+from storage_hooks.storage_hooks import WriteGenerations, read_primary
+
+
+class CachedBody:
+    """A serialized response body and the compressed variants made so far"""
+
+    __slots__ = ("body", "etag", "generation", "expires", "variants")
+
+    def __init__(self, body: bytes, generation: tuple[int, ...], expires: float):
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.generation = generation
+        self.expires = expires
+        self.variants: dict[str, bytes] = {}
+
+    def encoded(self, encoding: str | None) -> bytes:
+        if encoding is None:
+            return self.body
+        if (variant := self.variants.get(encoding)) is None:
+            # Two requests may both compress it, which is harmless
+            variant = self.variants[encoding] = compress(self.body, encoding)
+        return variant
+
+    def response(self) -> Response:
+        """The body in the encoding the current request accepts, or 304"""
+        encoding = None
+        if len(self.body) >= CONFIG.Responses.compress_min_bytes:
+            encoding = best_encoding()
+        # Each encoding is a different representation, so needs its own ETag
+        etag = self.etag if encoding is None else f"{self.etag}-{encoding}"
+
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.encoded(encoding), mimetype="application/json")
+            if encoding is not None:
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        return response
+
+
+class ResponseCache:
+    """Least recently used cache of the bodies of views, see ``cached``
+
+    Args:
+        generations: The write generations of the database the views read
+        max_entries: Bodies kept, one per path and query string
+        ttl: Seconds a body is kept regardless of writes, None for no limit
+    """
+
+    def __init__(
+        self, generations: WriteGenerations, max_entries: int, ttl: float | None
+    ):
+        self.generations = generations
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: collections.OrderedDict[
+            tuple, CachedBody
+        ] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, generation: tuple[int, ...]) -> CachedBody | None:
+        with self._lock:
+            if (entry := self._entries.get(key)) is None:
+                return None
+            if entry.generation != generation or entry.expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, generation: tuple[int, ...], body: bytes) -> CachedBody:
+        ttl = float("inf") if self.ttl is None else self.ttl
+        entry = CachedBody(body, generation, time.monotonic() + ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def cached(self, *tables: str) -> Callable[[Callable], Callable]:
+        """Decorates a Flask view whose JSON response depends only on tables
+
+        Args:
+            tables: The tables (of ``WriteGenerations.TABLES``) the view reads
+        """
+
+        def decorator(view: Callable) -> Callable:
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                key = (request.path, request.query_string)
+                # Read before the view queries, so a write committed meanwhile
+                # leaves the new body with an already outdated generation
+                generation = self.generations.get(*tables)
+                if (entry := self.get(key, generation)) is not None:
+                    metrics.CACHE_REQUESTS.inc("responses", "hit")
+                    return entry.response()
+
+                metrics.CACHE_REQUESTS.inc("responses", "miss")
+                # Kept under the new generation, so must not be stale
+                with read_primary():
+                    response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                return self.put(key, generation, response.get_data()).response()
+
+            return wrapper
+
+        return decorator
@@ -0,0 +1,86 @@
+"""Low overhead sampling profiler for running workers
+
+A background thread periodically records the Python stack of other threads
+using ``sys._current_frames``. Results are in the "folded" format (one
+``frame;frame;frame count`` line per unique stack), which flamegraph.pl,
+speedscope and most other flame graph tools accept.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Iterable, Optional
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+def _stack(frame: Optional[FrameType]) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class SamplingProfiler:
+    """Samples thread stacks every interval seconds until stopped
+
+    Args:
+        interval: Seconds between samples
+        thread_ids: Only sample these threads, defaults to every other thread
+    """
+
+    def __init__(self, interval: float = 0.005, thread_ids: Iterable[int] = ()):
+        self.interval = interval
+        self.thread_ids = set(thread_ids)
+        self.samples: Counter[str] = Counter()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SamplingProfiler":
+        self._thread = threading.Thread(
+            target=self._run, name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> "SamplingProfiler":
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def __enter__(self) -> "SamplingProfiler":
+        return self.start()
+
+    def __exit__(self, *_exc):
+        self.stop()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if self.thread_ids and thread_id not in self.thread_ids:
+                    continue
+                self.samples[_stack(frame)] += 1
+
+    def folded(self) -> str:
+        """The samples in the folded stack format"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.items())
+
+
+def profile_for(seconds: float, interval: float) -> SamplingProfiler:
+    """Samples every other thread for the given number of seconds"""
+    with SamplingProfiler(interval) as profiler:
+        time.sleep(seconds)
+    return profiler
@@ -0,0 +1,99 @@
+"""Per-request SQL statement counting and timing
+
+``attach`` registers SQLAlchemy engine events that add every statement's
+duration to the ``QueryStats`` of the current request (see ``track``).
+Statements slower than ``Profiling.slow_query_ms`` are logged, optionally with
+the database's query plan.
+"""
+
+import contextvars
+import time
+from typing import Any, Optional
+
+from sqlalchemy import Engine, event
+
+from app_logging import LOGGER
+from configure import CONFIG
+
+
+class QueryStats:
+    """Statements executed while handling one request"""
+
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def server_timing(self) -> str:
+        """Formats the stats as a Server-Timing header metric"""
+        return f'db;dur={self.seconds * 1000:.2f};desc="{self.count} queries"'
+
+
+_stats: contextvars.ContextVar[Optional[QueryStats]] = contextvars.ContextVar(
+    "sql_stats", default=None
+)
+# Set while running EXPLAIN so it is not profiled itself
+_explaining: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "sql_explaining", default=False
+)
+
+
+def track() -> QueryStats:
+    """Starts counting statements executed in the current context"""
+    stats = QueryStats()
+    _stats.set(stats)
+    return stats
+
+
+def stop():
+    """Stops counting statements in the current context"""
+    _stats.set(None)
+
+
+def attach(engine: Engine):
+    """Profiles every statement executed by engine"""
+    if not event.contains(engine, "before_cursor_execute", _before_execute):
+        event.listen(engine, "before_cursor_execute", _before_execute)
+        event.listen(engine, "after_cursor_execute", _after_execute)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    if _explaining.get():
+        return
+    if (stats := _stats.get()) is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+
+    config = CONFIG.Profiling
+    if config.slow_query_ms is not None and elapsed * 1000 >= config.slow_query_ms:
+        plan = None
+        if config.explain_slow and not executemany:
+            plan = _explain(conn.engine, statement, parameters)
+        LOGGER.warning(
+            "Slow query (%.1f ms): %s; parameters: %.200r%s",
+            elapsed * 1000,
+            statement,
+            parameters,
+            f"\nPlan:\n{plan}" if plan else "",
+        )
+
+
+def _explain(engine: Engine, statement: str, parameters: Any) -> Optional[str]:
+    prefix = "EXPLAIN QUERY PLAN" if engine.dialect.name == "sqlite" else "EXPLAIN"
+    token = _explaining.set(True)
+    try:
+        # A separate connection leaves the original cursor's results untouched
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(f"{prefix} {statement}", parameters).all()
+        return "\n".join(" | ".join(str(col) for col in row) for row in rows)
+    except Exception:
+        LOGGER.debug("Could not explain slow query", exc_info=True)
+        return None
+    finally:
+        _explaining.reset(token)
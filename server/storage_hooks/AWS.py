@@ -1,86 +1,423 @@
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import uuid
 import warnings
+from collections import OrderedDict
+from pathlib import PurePath
+from typing import Any, Callable, Iterable, Iterator
 
 import boto3
+import botocore.config
 import botocore.exceptions
 
+import metrics
 from app_logging import LOGGER
-from configure import CONFIG
-from storage_hooks.storage_hooks import FileHook
+from configure import CONFIG, _AWSS3Config
+from storage_hooks.storage_hooks import (
+    FileHook,
+    InvalidUploadError,
+    UploadOffsetError,
+    check_chunk,
+    key_suffix,
+)
+
+# Clients are thread safe, so hooks with the same settings share one
+_clients: dict[tuple, Any] = {}
+_clients_lock = threading.Lock()
+
+# Content addressed uploads are assembled here, until their hash is known
+STAGING_PREFIX = ".uploads/"
+# S3's minimum size of a multipart upload's parts, except the last
+MIN_PART_BYTES = 5 * 1024 * 1024
+
+
+def _count_request(event_name: str, response_dict: dict | None = None, **_kwargs):
+    # Emitted for every HTTP attempt, including retries
+    operation = event_name.rsplit(".", 1)[-1]
+    status = str(response_dict["status_code"]) if response_dict else "error"
+    metrics.S3_REQUESTS.inc(operation, status)
+
+
+def shared_client(config: _AWSS3Config):
+    """Returns the S3 client for config, creating it on first use"""
+    settings = (
+        config.access_key_id,  # Key as str or None
+        config.secret_access_key,  # Ditto
+        config.max_pool_connections,
+        config.connect_timeout,
+        config.read_timeout,
+        config.max_attempts,
+        config.endpoint_url,
+    )
+    with _clients_lock:
+        if (client := _clients.get(settings)) is None:
+            # The default session is not thread safe, so use a new one
+            session = boto3.session.Session(
+                aws_access_key_id=config.access_key_id,
+                aws_secret_access_key=config.secret_access_key,
+            )
+            client = session.client(
+                "s3",
+                endpoint_url=config.endpoint_url,
+                config=botocore.config.Config(
+                    max_pool_connections=config.max_pool_connections,
+                    connect_timeout=config.connect_timeout,
+                    read_timeout=config.read_timeout,
+                    retries={"mode": "standard", "max_attempts": config.max_attempts},
+                    tcp_keepalive=True,
+                ),
+            )
+            client.meta.events.register("response-received.s3", _count_request)
+            _clients[settings] = client
+    return client
+
+
+def _error_code(e: botocore.exceptions.ClientError) -> str:
+    return e.response["Error"]["Code"]
 
 
 class AWSS3Hook(FileHook):
-    """Connection to AWS Storage"""
+    """Connection to AWS Storage
+
+    Each operation aims to cost a single request. The ETags of recently saved or
+    fetched objects are remembered, so replace and delete can be made
+    conditional on the object existing (If-Match) instead of checking first
+    with a HEAD request.
+
+    Staged uploads are S3 multipart uploads with a part per chunk, so the hook
+    keeps no state about them. Their key and size travel in the upload id
+    instead, signed with Server.secret_key so clients can't change them.
+    Uploads abandoned by clients are only removed by a lifecycle rule
+    (AbortIncompleteMultipartUpload) on the bucket, as are staged copies of
+    content addressed uploads left by a failed complete request (an expiration
+    rule for the .uploads/ prefix).
+    """
+
+    remote = True
 
     def __init__(self):
         super().__init__()
         self.config = CONFIG.AWSS3
-
-        self.client = boto3.client(
-            "s3",
-            aws_access_key_id=self.config.access_key_id,  # Key as str or None
-            aws_secret_access_key=self.config.secret_access_key,  # Ditto
-        )
+        self.client = shared_client(self.config)
         self.bucket_name = self.config.bucket_name
+        # location -> ETag, least recently used first
+        self._etags: OrderedDict[str, str] = OrderedDict()
+        self._etags_lock = threading.Lock()
+        # Generated keys only verify upload ids within this process and its forks
+        self._upload_key = (CONFIG.Server.secret_key or secrets.token_hex(32)).encode()
+
+    def after_fork(self):
+        # boto3 clients and their connection pools are not safe to share
+        with _clients_lock:
+            _clients.clear()
+        self._etags_lock = threading.Lock()
+        self.client = shared_client(self.config)
+
+    def _remember(self, location: str, etag: str | None):
+        with self._etags_lock:
+            if etag is None:
+                self._etags.pop(location, None)
+                return
+            self._etags[location] = etag
+            self._etags.move_to_end(location)
+            while len(self._etags) > self.config.etag_cache_size:
+                self._etags.popitem(last=False)
+
+    def _etag(self, location: str) -> str | None:
+        with self._etags_lock:
+            return self._etags.get(location)
+
+    def _head(self, location: str):
+        """Raises FileNotFoundError unless location exists"""
+        try:
+            r = self.client.head_object(Bucket=self.bucket_name, Key=location)
+        except botocore.exceptions.ClientError as e:
+            if _error_code(e) in ("404", "NoSuchKey"):
+                raise FileNotFoundError(location)
+            raise
+        self._remember(location, r["ETag"])
 
     def save(self, image: bytes, original_name: str) -> str:
-        key = self._make_key(original_name)
-        r = self.client.put_object(
-            Bucket=self.bucket_name,
-            Key=key,
-            Body=image,
-        )
-        if r["ResponseMetadata"]["HTTPStatusCode"] != 200:
-            raise RuntimeError(
-                f"S3 return code {r['ResponseMetadata']['HTTPStatusCode']} != 200"
+        key = self._make_key(original_name, image)
+        extra = {}
+        if self.content_addressed:
+            extra["IfNoneMatch"] = "*"  # Only write if no identical upload exists
+        try:
+            r = self.client.put_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=image,
+                **extra,
             )
+        except botocore.exceptions.ClientError as e:
+            if self.content_addressed and _error_code(e) in (
+                "PreconditionFailed",
+                "412",
+            ):
+                try:
+                    self._touch(key)  # Already stored by an identical upload
+                except FileNotFoundError:  # Deleted since
+                    return self.save(image, original_name)
+                return key
+            raise
+        self._remember(key, r["ETag"])
         return key
 
+    def _touch(self, location: str):
+        """Updates LastModified of location by copying it onto itself
+
+        Raises:
+            FileNotFoundError: When the location doesn't exist
+        """
+        try:
+            r = self.client.copy_object(
+                Bucket=self.bucket_name,
+                Key=location,
+                CopySource={"Bucket": self.bucket_name, "Key": location},
+                MetadataDirective="REPLACE",
+            )
+        except botocore.exceptions.ClientError as e:
+            if _error_code(e) in ("404", "NoSuchKey"):
+                raise FileNotFoundError(location)
+            raise
+        self._remember(location, r["CopyObjectResult"]["ETag"])
+
+    def modified(self, location: str) -> float:
+        try:
+            r = self.client.head_object(Bucket=self.bucket_name, Key=location)
+        except botocore.exceptions.ClientError as e:
+            if _error_code(e) in ("404", "NoSuchKey"):
+                raise FileNotFoundError(location)
+            raise
+        self._remember(location, r["ETag"])
+        return r["LastModified"].timestamp()
+
     def fetch(self, location: str) -> bytes:
-        print(location)
         try:
             obj = self.client.get_object(Bucket=self.bucket_name, Key=location)
-            # data['ResponseMetadata']['HTTPStatusCode'] should equal 200
-            return obj.get("Body").read()
-        except AttributeError:
-            raise ValueError
         except botocore.exceptions.ClientError as e:
-            if e.response["Error"]["Code"] == "NoSuchKey":
-                raise FileNotFoundError
+            if _error_code(e) == "NoSuchKey":
+                self._remember(location, None)
+                raise FileNotFoundError(location)
             raise
+        if (body := obj.get("Body")) is None:
+            raise ValueError
+        self._remember(location, obj["ETag"])
+        return body.read()
+
+    def _conditional(self, operation, location: str, **kwargs) -> dict:
+        """Runs operation if location exists, in one request when its ETag is known
+
+        Raises:
+            FileNotFoundError: When the location doesn't exist
+        """
+        if (etag := self._etag(location)) is not None:
+            try:
+                return operation(
+                    Bucket=self.bucket_name, Key=location, IfMatch=etag, **kwargs
+                )
+            except botocore.exceptions.ClientError as e:
+                code = _error_code(e)
+                if code in ("NoSuchKey", "404"):
+                    self._remember(location, None)
+                    raise FileNotFoundError(location)
+                if code not in ("PreconditionFailed", "412"):
+                    raise
+                # Changed by someone else, but it does exist
+        else:
+            self._head(location)
+        return operation(Bucket=self.bucket_name, Key=location, **kwargs)
 
     def replace(self, location: str, image: bytes):
+        r = self._conditional(self.client.put_object, location, Body=image)
+        self._remember(location, r["ETag"])
+
+    def delete(self, location: str):
+        self._conditional(self.client.delete_object, location)
+        self._remember(location, None)
+
+    @property
+    def upload_chunk_size(self) -> int:
+        return max(super().upload_chunk_size, MIN_PART_BYTES)
+
+    def _sign(self, data: bytes) -> bytes:
+        digest = hmac.new(self._upload_key, data, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=")
+
+    def _encode_upload(self, key: str, multipart_id: str, size: int) -> str:
+        data = json.dumps([key, multipart_id, size]).encode()
+        data = base64.urlsafe_b64encode(data).rstrip(b"=")
+        return (data + b"." + self._sign(data)).decode()
+
+    def _decode_upload(self, upload_id: str) -> tuple[str, str, int]:
+        """The key, multipart upload id and size an upload id was made from
+
+        Raises:
+            InvalidUploadError: The upload id was not made by this hook
+        """
+        data, _, signature = upload_id.encode().rpartition(b".")
+        if not hmac.compare_digest(self._sign(data), signature):
+            raise InvalidUploadError(upload_id)
+        # Signed, so no longer untrusted
+        key, multipart_id, size = json.loads(
+            base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+        )
+        return key, multipart_id, size
+
+    def _multipart(self, operation: Callable, upload_id: str, **kwargs) -> dict:
+        key, multipart_id, _ = self._decode_upload(upload_id)
         try:
-            self.client.head_object(Bucket=self.bucket_name, Key=location)
+            return operation(
+                Bucket=self.bucket_name, Key=key, UploadId=multipart_id, **kwargs
+            )
         except botocore.exceptions.ClientError as e:
-            if e.response["Error"]["Code"] == "404":
-                raise FileNotFoundError
+            if _error_code(e) in ("NoSuchUpload", "404"):
+                raise FileNotFoundError(upload_id)
             raise
 
-        r = self.client.put_object(
-            Bucket=self.bucket_name,
-            Key=location,
-            Body=image,
+    def _parts(self, upload_id: str) -> list[dict]:
+        parts: list[dict] = []
+        marker = 0
+        while True:
+            r = self._multipart(
+                self.client.list_parts, upload_id, PartNumberMarker=marker
+            )
+            parts.extend(r.get("Parts", []))
+            if not r.get("IsTruncated"):
+                return sorted(parts, key=lambda part: part["PartNumber"])
+            marker = r["NextPartNumberMarker"]
+
+    @staticmethod
+    def _received(parts: list[dict]) -> int:
+        """The length of the parts before the first missing one"""
+        received = 0
+        for number, part in enumerate(parts, 1):
+            if part["PartNumber"] != number:
+                break
+            received += part["Size"]
+        return received
+
+    def begin_upload(self, original_name: str, size: int) -> str:
+        if size < 1:
+            raise ValueError("An upload must not be empty")
+        if self.content_addressed:
+            suffix = key_suffix(original_name)
+            key = f"{STAGING_PREFIX}{uuid.uuid4().hex}{suffix}"
+        else:
+            key = self._make_key(original_name, b"")
+        r = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key)
+        return self._encode_upload(key, r["UploadId"], size)
+
+    def stage_chunk(self, upload_id: str, offset: int, chunk: bytes) -> int:
+        _, _, size = self._decode_upload(upload_id)
+        chunk_size = self.upload_chunk_size
+        check_chunk(offset, len(chunk), size, chunk_size)
+        # Parts may arrive in any order, finish_upload checks that none is missing
+        self._multipart(
+            self.client.upload_part,
+            upload_id,
+            PartNumber=offset // chunk_size + 1,
+            Body=chunk,
         )
-        if r["ResponseMetadata"]["HTTPStatusCode"] != 200:
-            raise RuntimeError(f"S3 return code {r} != 200")
+        return offset + len(chunk)
 
-    def delete(self, location: str):
+    def upload_progress(self, upload_id: str) -> tuple[int, int]:
+        _, _, size = self._decode_upload(upload_id)
+        return self._received(self._parts(upload_id)), size
+
+    def finish_upload(self, upload_id: str) -> str:
+        key, _, size = self._decode_upload(upload_id)
+        try:
+            parts = self._parts(upload_id)
+        except FileNotFoundError:
+            # Completed by an earlier call, or never existed
+            if key.startswith(STAGING_PREFIX):
+                return self._move_staged(key)
+            self._head(key)
+            return key
+        if (received := self._received(parts)) != size:
+            raise UploadOffsetError(received)
+        r = self._multipart(
+            self.client.complete_multipart_upload,
+            upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": part["PartNumber"], "ETag": part["ETag"]}
+                    for part in parts
+                ]
+            },
+        )
+        if key.startswith(STAGING_PREFIX):
+            return self._move_staged(key)
+        self._remember(key, r["ETag"])
+        return key
+
+    def _move_staged(self, staged_key: str) -> str:
+        """Copies an assembled content addressed upload to its hash's key
+
+        The staged copy is kept for finishing again, until abort_upload.
+        """
+        digest = hashlib.sha256()
         try:
-            self.client.head_object(Bucket=self.bucket_name, Key=location)
+            r = self.client.get_object(Bucket=self.bucket_name, Key=staged_key)
         except botocore.exceptions.ClientError as e:
-            if e.response["Error"]["Code"] == "404":
-                raise FileNotFoundError
+            if _error_code(e) in ("NoSuchKey", "404"):
+                raise FileNotFoundError(staged_key)
             raise
+        body = r["Body"]
+        for data in body.iter_chunks(1024 * 1024):
+            digest.update(data)
+        key = f"{digest.hexdigest()}{PurePath(staged_key).suffix}"
+        try:
+            self._touch(key)  # Already stored by an identical upload
+        except FileNotFoundError:
+            r = self.client.copy_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                CopySource={"Bucket": self.bucket_name, "Key": staged_key},
+            )
+            self._remember(key, r["CopyObjectResult"]["ETag"])
+        return key
 
+    def abort_upload(self, upload_id: str):
+        key, _, _ = self._decode_upload(upload_id)
         try:
-            r = self.client.delete_object(Bucket=self.bucket_name, Key=location)
-        except botocore.exceptions.ClientError as e:
-            if e.response["Error"]["Code"] == "NoSuchKey":
-                raise FileNotFoundError
-            else:
-                raise RuntimeError
-        if (r_code := r["ResponseMetadata"]["HTTPStatusCode"]) != 204:
-            raise RuntimeError(f"S3 return code {r_code} != 204")
+            self._multipart(self.client.abort_multipart_upload, upload_id)
+        except FileNotFoundError:
+            # Finished when its key exists, then only a staged copy is left
+            self._head(key)
+            if key.startswith(STAGING_PREFIX):
+                self.client.delete_object(Bucket=self.bucket_name, Key=key)
+                self._remember(key, None)
+
+    def iter_keys(self) -> Iterator[tuple[str, float]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name):
+            for obj in page.get("Contents", []):
+                # Staged uploads are not images, nor orphaned while in flight
+                if not obj["Key"].startswith(STAGING_PREFIX):
+                    yield obj["Key"], obj["LastModified"].timestamp()
+
+    def delete_many(self, locations: Iterable[str]):
+        locations = list(locations)
+        for start in range(0, len(locations), 1000):  # The request's limit
+            r = self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={
+                    "Objects": [
+                        {"Key": key} for key in locations[start : start + 1000]
+                    ],
+                    "Quiet": True,
+                },
+            )
+            for error in r.get("Errors", []):
+                LOGGER.warning(
+                    "Could not delete %s: %s", error["Key"], error.get("Message")
+                )
 
     def _delete_all(self):
         """Deletes all objects from the bucket"""
@@ -101,9 +438,9 @@ class AWSS3Hook(FileHook):
             _r = self.client.head_bucket(Bucket=self.bucket_name)
         except botocore.exceptions.ClientError as e:
             match e.response["Error"]["Code"]:
-                case 403:
+                case "403":
                     raise ValueError(f"Bucket {self.bucket_name} Already Exists")
-                case 404:
+                case "404":
                     pass
                 case _:
                     raise
@@ -1,11 +1,130 @@
-from sqlalchemy import URL, create_engine
+import functools
+import itertools
+import threading
+import time
 
+from sqlalchemy import URL, Engine, create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+from app_logging import LOGGER
 from configure import CONFIG, ManualRemoteSQLConfig, RemoteSQLConfig
-from storage_hooks.storage_hooks import DatabaseHook
+from storage_hooks.storage_hooks import DatabaseHook, current_client
+
+
+class _Replica:
+    __slots__ = ("engine", "down_until")
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.down_until = 0.0  # Monotonic time to check again, 0 when healthy
+
+
+class ReplicaRouter:
+    """Chooses the engine for read only queries
+
+    Reads go to the healthy replicas in turn, or the primary when none are
+    healthy or the client (see ``storage_hooks.ClientWrites``) wrote within the
+    last sticky_seconds. Outside of a client's context, any write made by this
+    process counts instead. Replicas that fail to connect are skipped for
+    retry_seconds and then must answer a probe query before serving reads again.
+
+    Args:
+        primary: The engine receiving writes
+        replicas: Engines of read replicas of primary
+        sticky_seconds: How long a client's reads stay on the primary after its
+            writes
+        retry_seconds: How long a failed replica is skipped
+    """
+
+    def __init__(
+        self,
+        primary: Engine,
+        replicas: list[Engine],
+        sticky_seconds: float,
+        retry_seconds: float,
+    ):
+        self.primary = primary
+        self.replicas = [_Replica(engine) for engine in replicas]
+        self.sticky_seconds = sticky_seconds
+        self.retry_seconds = retry_seconds
+        self._last_write = float("-inf")
+        self._lock = threading.Lock()
+        self._next = itertools.cycle(self.replicas)
+
+        # Writes made outside of a client's context
+        event.listen(primary, "commit", self._on_commit)
+        for replica in self.replicas:
+            event.listen(
+                replica.engine,
+                "handle_error",
+                functools.partial(self._on_error, replica),
+            )
+
+    def _on_commit(self, _conn):
+        if current_client() is None:
+            self._last_write = time.monotonic()
+
+    def _on_error(self, replica: _Replica, context):
+        # The connection is None when connecting failed
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(replica)
+
+    def mark_down(self, replica: _Replica):
+        if not replica.down_until:
+            LOGGER.warning("Read replica %s is down", replica.engine.url)
+        replica.down_until = time.monotonic() + self.retry_seconds
+
+    def healthy_count(self) -> int:
+        return sum(1 for replica in self.replicas if not replica.down_until)
+
+    def _probe(self, replica: _Replica) -> bool:
+        try:
+            with replica.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        except OperationalError:
+            self.mark_down(replica)
+            return False
+        replica.down_until = 0.0
+        LOGGER.info("Read replica %s is back up", replica.engine.url)
+        return True
+
+    def read_engine(self) -> Engine:
+        now = time.monotonic()
+        if (client := current_client()) is not None:
+            if time.time() - client.last_write < self.sticky_seconds:
+                return self.primary
+        elif now - self._last_write < self.sticky_seconds:
+            return self.primary
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = next(self._next)
+            if not replica.down_until:
+                return replica.engine
+            if replica.down_until <= now and self._probe(replica):
+                return replica.engine
+        return self.primary
+
+
+def _replica_fallback(func):
+    """Retries a read once when it failed because a replica went down"""
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        healthy = self.router.healthy_count()
+        try:
+            return func(self, *args, **kwargs)
+        except OperationalError:
+            if self.router.healthy_count() >= healthy:
+                raise
+            return func(self, *args, **kwargs)
+
+    return wrapper
 
 
 class RemoteSQL(DatabaseHook):
-    """Arbitrary SQLAlchemy Connection"""
+    """Arbitrary SQLAlchemy Connection, with optional read replicas"""
+
+    remote = True
 
     @staticmethod
     def build_url(config: RemoteSQLConfig) -> URL:
@@ -30,11 +149,26 @@ class RemoteSQL(DatabaseHook):
         else:
             self.url = self.build_url(self.config)
         self.engine = create_engine(self.url)
+        self.router = ReplicaRouter(
+            self.engine,
+            [create_engine(url) for url in self.config.replicas],
+            self.config.sticky_seconds,
+            self.config.replica_retry_seconds,
+        )
+        if self.router.replicas:
+            self.sticky_seconds = self.config.sticky_seconds
+
+    @property
+    def engines(self) -> list[Engine]:
+        return [self.engine] + [replica.engine for replica in self.router.replicas]
+
+    def _read_engine(self) -> Engine:
+        return self.router.read_engine()
+
+    def after_fork(self):
+        super().after_fork()
+        self.router._lock = threading.Lock()
 
-    def update_storage(self) -> bool:
-        """Migrates a copy of the database to the current scheme version.
 
-        Returns:
-            True if successful, False otherwise.
-        """
-        raise NotImplementedError
+for _name in DatabaseHook.read_operations:
+    setattr(RemoteSQL, _name, _replica_fallback(getattr(DatabaseHook, _name)))
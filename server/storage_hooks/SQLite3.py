@@ -15,11 +15,3 @@ class SQLite3(DatabaseHook):
 
         os.makedirs(os.path.dirname(self.config.db_path), exist_ok=True)
         self.engine = create_engine(f"sqlite:///{self.config.db_path}")
-
-    def update_storage(self) -> bool:
-        """Migrates a copy of the database to the current scheme version.
-
-        Returns:
-            True if successful, False otherwise.
-        """
-        raise NotImplementedError
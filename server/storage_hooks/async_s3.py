@@ -0,0 +1,240 @@
+"""S3 hook with asyncio batch operations, for many concurrent requests
+
+Requests are made by one aiobotocore client on a background event loop, so
+hundreds can be in flight from a single thread over a shared connection pool,
+bounded by ``AWSS3.async_concurrency``. Both sync code (``fetch_many``,
+``delete_many``) and coroutines on any event loop (``afetch`` etc.) may use it.
+Single sync operations are inherited from ``AWSS3Hook``.
+
+Requires the optional aiobotocore package.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import threading
+from typing import Any, Awaitable, Coroutine, Iterable, TypeVar
+
+import botocore.exceptions
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+
+from app_logging import LOGGER
+from storage_hooks.AWS import AWSS3Hook, _count_request, _error_code
+
+T = TypeVar("T")
+
+
+class AsyncS3Hook(AWSS3Hook):
+    """AWSS3Hook whose batch operations run concurrently on an event loop"""
+
+    def __init__(self):
+        super().__init__()
+        self._loop_lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stack: contextlib.AsyncExitStack | None = None
+        self._aclient: Any = None
+        self._semaphore: asyncio.Semaphore | None = None
+
+    def _start_loop(self) -> asyncio.AbstractEventLoop:
+        """Returns the background loop, starting it and its client on first use"""
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="async-s3", daemon=True
+                ).start()
+                asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+                self._loop = loop
+        return self._loop
+
+    async def _open(self):
+        config = self.config
+        self._stack = contextlib.AsyncExitStack()
+        self._aclient = await self._stack.enter_async_context(
+            get_session().create_client(
+                "s3",
+                endpoint_url=config.endpoint_url,
+                aws_access_key_id=config.access_key_id,
+                aws_secret_access_key=config.secret_access_key,
+                config=AioConfig(
+                    max_pool_connections=config.max_pool_connections,
+                    connect_timeout=config.connect_timeout,
+                    read_timeout=config.read_timeout,
+                    retries={"mode": "standard", "max_attempts": config.max_attempts},
+                    tcp_keepalive=True,
+                ),
+            )
+        )
+        self._aclient.meta.events.register("response-received.s3", _count_request)
+        self._semaphore = asyncio.Semaphore(config.async_concurrency)
+
+    def close(self):
+        """Closes the client and stops the background loop, if started"""
+        with self._loop_lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stack.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    def after_fork(self):
+        super().after_fork()
+        # The loop's thread and connections belong to the parent
+        self._loop_lock = threading.Lock()
+        self._loop = self._stack = self._aclient = self._semaphore = None
+
+    def _submit(self, coro: Coroutine[Any, Any, T]) -> concurrent.futures.Future[T]:
+        return asyncio.run_coroutine_threadsafe(coro, self._start_loop())
+
+    async def _on_loop(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Awaits coro on the background loop from whichever loop is running"""
+        loop = self._start_loop()
+        if asyncio.get_running_loop() is loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    async def _request(self, operation: str, **kwargs) -> dict:
+        async with self._semaphore:
+            return await getattr(self._aclient, operation)(
+                Bucket=self.bucket_name, **kwargs
+            )
+
+    async def _fetch(self, location: str) -> bytes:
+        async with self._semaphore:
+            try:
+                obj = await self._aclient.get_object(
+                    Bucket=self.bucket_name, Key=location
+                )
+            except botocore.exceptions.ClientError as e:
+                if _error_code(e) == "NoSuchKey":
+                    self._remember(location, None)
+                    raise FileNotFoundError(location)
+                raise
+            # The body holds a pooled connection until read, so read it in the slot
+            async with obj["Body"] as stream:
+                image = await stream.read()
+        self._remember(location, obj["ETag"])
+        return image
+
+    async def _save(self, image: bytes, original_name: str) -> str:
+        key = self._make_key(original_name, image)
+        extra = {"IfNoneMatch": "*"} if self.content_addressed else {}
+        try:
+            r = await self._request("put_object", Key=key, Body=image, **extra)
+        except botocore.exceptions.ClientError as e:
+            if self.content_addressed and _error_code(e) in (
+                "PreconditionFailed",
+                "412",
+            ):
+                # Already stored by an identical upload, see AWSS3Hook._touch
+                try:
+                    r = await self._request(
+                        "copy_object",
+                        Key=key,
+                        CopySource={"Bucket": self.bucket_name, "Key": key},
+                        MetadataDirective="REPLACE",
+                    )
+                except botocore.exceptions.ClientError as copy_error:
+                    if _error_code(copy_error) not in ("NoSuchKey", "404"):
+                        raise
+                    return await self._save(image, original_name)  # Deleted since
+                self._remember(key, r["CopyObjectResult"]["ETag"])
+                return key
+            raise
+        self._remember(key, r["ETag"])
+        return key
+
+    async def _conditional_async(self, operation: str, location: str, **kwargs):
+        """Async version of AWSS3Hook._conditional"""
+        if (etag := self._etag(location)) is not None:
+            try:
+                return await self._request(
+                    operation, Key=location, IfMatch=etag, **kwargs
+                )
+            except botocore.exceptions.ClientError as e:
+                code = _error_code(e)
+                if code in ("NoSuchKey", "404"):
+                    self._remember(location, None)
+                    raise FileNotFoundError(location)
+                if code not in ("PreconditionFailed", "412"):
+                    raise
+        else:
+            try:
+                r = await self._request("head_object", Key=location)
+            except botocore.exceptions.ClientError as e:
+                if _error_code(e) in ("404", "NoSuchKey"):
+                    raise FileNotFoundError(location)
+                raise
+            self._remember(location, r["ETag"])
+        return await self._request(operation, Key=location, **kwargs)
+
+    async def _replace(self, location: str, image: bytes):
+        r = await self._conditional_async("put_object", location, Body=image)
+        self._remember(location, r["ETag"])
+
+    async def _delete(self, location: str):
+        await self._conditional_async("delete_object", location)
+        self._remember(location, None)
+
+    async def _fetch_many(self, locations: Iterable[str]) -> dict[str, bytes]:
+        locations = list(dict.fromkeys(locations))
+        results = await asyncio.gather(
+            *(self._fetch(location) for location in locations),
+            return_exceptions=True,
+        )
+        images = {}
+        for location, result in zip(locations, results):
+            if isinstance(result, FileNotFoundError):
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            images[location] = result
+        return images
+
+    async def _delete_many(self, locations: Iterable[str]):
+        locations = list(locations)
+        responses = await asyncio.gather(
+            *(
+                self._request(
+                    "delete_objects",
+                    Delete={
+                        "Objects": [{"Key": key} for key in locations[i : i + 1000]],
+                        "Quiet": True,
+                    },
+                )
+                for i in range(0, len(locations), 1000)  # The request's limit
+            )
+        )
+        for location in locations:
+            self._remember(location, None)
+        for r in responses:
+            for error in r.get("Errors", []):
+                LOGGER.warning(
+                    "Could not delete %s: %s", error["Key"], error.get("Message")
+                )
+
+    # Coroutines, usable from any event loop
+
+    def afetch(self, location: str) -> Awaitable[bytes]:
+        return self._on_loop(self._fetch(location))
+
+    def asave(self, image: bytes, original_name: str) -> Awaitable[str]:
+        return self._on_loop(self._save(image, original_name))
+
+    def areplace(self, location: str, image: bytes) -> Awaitable[None]:
+        return self._on_loop(self._replace(location, image))
+
+    def adelete(self, location: str) -> Awaitable[None]:
+        return self._on_loop(self._delete(location))
+
+    def afetch_many(self, locations: Iterable[str]) -> Awaitable[dict[str, bytes]]:
+        return self._on_loop(self._fetch_many(locations))
+
+    # Sync batch operations
+
+    def fetch_many(self, locations: Iterable[str]) -> dict[str, bytes]:
+        return self._submit(self._fetch_many(locations)).result()
+
+    def delete_many(self, locations: Iterable[str]):
+        self._submit(self._delete_many(locations)).result()
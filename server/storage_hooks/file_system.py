@@ -1,46 +1,243 @@
+import hashlib
+import mmap
 import os
+import re
+import uuid
+from typing import Iterator, Literal
 
+from app_logging import LOGGER
 from configure import CONFIG
-from storage_hooks.storage_hooks import FileHook
+from storage_hooks.storage_hooks import Buffer, FileHook, UploadOffsetError
+
+Layout = Literal["flat", "sharded"]
+
+# Marker in the root of the store recording which layout it was written with
+LAYOUT_FILE = ".layout"
+LAYOUT_VERSIONS: dict[Layout, int] = {"flat": 1, "sharded": 2}
+
+# The keys FileHook._make_key generates, "<sha256><suffix>" or
+# "<stem> (<UTC time>)<suffix>". Other files (e.g. the SQLite database, which
+# shares the default directory) are never listed, migrated or deleted.
+KEY_PATTERN = re.compile(
+    r"(?:[0-9a-f]{64}|.* \(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\+00:00\))(?:\.[^.]*)?"
+)
+
+
+def _is_shard(name: str) -> bool:
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
 
 
 class FileSystemHook(FileHook):
-    def __init__(self):
+    """Stores images as files below a directory.
+
+    With the ``sharded`` layout, images are fanned out into two levels of
+    directories named after a hash of the key (``ab/cd/<key>``) so no single
+    directory grows too large. Stores written with a different layout are
+    migrated in place when the hook is created.
+
+    Images are written to a temporary file which then replaces the old one, so
+    readers never see a partly written image and memory maps returned by
+    ``fetch_buffer`` stay valid after a replace or delete.
+
+    Uploads are staged in the hidden ``.uploads`` directory of the store, on
+    the same file system, so a finished upload is moved into place rather than
+    copied.
+    """
+
+    def __init__(self, file_path: str | None = None, layout: Layout | None = None):
+        super().__init__()
         config = CONFIG.FileSystem
-        self.file_path = config.file_path
+        self.file_path = file_path if file_path is not None else config.file_path
+        self.layout: Layout = layout if layout is not None else config.layout
+        self.mmap_min_bytes = config.mmap_min_bytes
+        self._check_layout()
+
+    def _path(self, location: str, layout: Layout | None = None) -> str:
+        if (layout or self.layout) == "flat":
+            return os.path.join(self.file_path, location)
+        digest = hashlib.sha1(location.encode()).hexdigest()
+        return os.path.join(self.file_path, digest[:2], digest[2:4], location)
 
-    def save(self, image: bytes, original_name: str) -> str:
-        key = self._make_key(original_name)
-        with open(os.path.join(self.file_path, key), "wb+") as file:
-            file.write(image)
+    def _write(self, location: str, image: Buffer):
+        path = self._path(location)
+        # Hidden, so it is never listed as an image
+        temp_path = os.path.join(os.path.dirname(path), f".{uuid.uuid4().hex}.tmp")
+        try:
+            file = open(temp_path, "xb")
+        except FileNotFoundError:  # First image in this shard
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file = open(temp_path, "xb")
+        try:
+            with file:
+                file.write(image)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def save(self, image: Buffer, original_name: str) -> str:
+        key = self._make_key(original_name, image)
+        if self.content_addressed and self._touch(key):
+            return key  # Already stored by an identical upload
+        self._write(key, image)
         return key
 
-    def replace(self, location: str, image: bytes):
-        r_path = os.path.join(self.file_path, location)
+    def _touch(self, location: str) -> bool:
+        """Sets the modification time of location to now, if it exists"""
+        try:
+            os.utime(self._path(location))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def modified(self, location: str) -> float:
+        return os.stat(self._path(location)).st_mtime
+
+    def replace(self, location: str, image: Buffer):
+        r_path = self._path(location)
 
         if not os.path.exists(r_path):
             raise FileNotFoundError(r_path)
-        with open(r_path, "wb+") as file:
-            file.write(image)
+        self._write(location, image)
 
     def fetch(self, location: str) -> bytes:
-        with open(os.path.join(self.file_path, location), "rb") as file:
+        with open(self._path(location), "rb") as file:
             return file.read()
 
+    def fetch_buffer(self, location: str) -> Buffer:
+        with open(self._path(location), "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            # Mapping costs a few system calls, more than copying small images
+            if self.mmap_min_bytes is None or size < max(self.mmap_min_bytes, 1):
+                return file.read()
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _staging_dir(self) -> str:
+        return os.path.join(self.file_path, ".uploads")
+
+    def finish_upload(self, upload_id: str) -> str:
+        data_path, info = self._staged_info(upload_id)
+        if (key := info.get("key")) is not None:
+            return key
+        with open(data_path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size != info["size"]:
+                raise UploadOffsetError(size)
+            # Hashed without reading the image into memory
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as image:
+                key = self._make_key(info["name"], image)
+        path = self._path(key)
+        # Unless an identical upload is already stored
+        if not (self.content_addressed and self._touch(key)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(data_path, path)
+        return self._finish_staged(upload_id, key)
+
     def delete(self, location: str):
-        r_path = os.path.join(self.file_path, location)
+        r_path = self._path(location)
 
         if not os.path.exists(r_path):
             raise FileNotFoundError(r_path)
         os.remove(r_path)
 
+    @staticmethod
+    def _iter_files(path: str) -> Iterator[os.DirEntry]:
+        with os.scandir(path) as it:
+            for entry in it:
+                if (
+                    entry.is_file()
+                    and not entry.name.startswith(".")
+                    and KEY_PATTERN.fullmatch(entry.name)
+                ):
+                    yield entry
+
+    @staticmethod
+    def _iter_shards(path: str) -> Iterator[os.DirEntry]:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir() and _is_shard(entry.name):
+                    yield entry
+
+    def _iter_entries(self, layout: Layout | None = None) -> Iterator[os.DirEntry]:
+        """Yields a directory entry for each stored image"""
+        if (layout or self.layout) == "flat":
+            yield from self._iter_files(self.file_path)
+            return
+        for outer in self._iter_shards(self.file_path):
+            for inner in self._iter_shards(outer.path):
+                yield from self._iter_files(inner.path)
+
+    def iter_keys(self) -> Iterator[tuple[str, float]]:
+        for entry in self._iter_entries():
+            yield entry.name, entry.stat().st_mtime
+
+    def _read_layout(self) -> Layout:
+        try:
+            with open(os.path.join(self.file_path, LAYOUT_FILE)) as file:
+                version = int(file.read().strip())
+        except FileNotFoundError:
+            return "flat"  # Stores from before layouts existed
+        for layout, layout_version in LAYOUT_VERSIONS.items():
+            if layout_version == version:
+                return layout
+        raise ValueError(f"Unknown file system layout version {version}")
+
+    def _write_layout(self):
+        with open(os.path.join(self.file_path, LAYOUT_FILE), "w") as file:
+            file.write(str(LAYOUT_VERSIONS[self.layout]))
+
+    def _check_layout(self):
+        if not os.path.isdir(self.file_path):
+            return
+        if (current := self._read_layout()) != self.layout:
+            self._migrate(current)
+
+    def _migrate(self, from_layout: Layout):
+        """Moves every image from from_layout into the configured layout
+
+        Only files named like keys are images, see KEY_PATTERN.
+        """
+        LOGGER.info(
+            "Migrating %s from %s to %s layout",
+            self.file_path,
+            from_layout,
+            self.layout,
+        )
+        moved = 0
+        for entry in list(self._iter_entries(from_layout)):
+            new_path = self._path(entry.name)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            try:
+                os.replace(entry.path, new_path)
+            except FileNotFoundError:  # Moved by a concurrent migration
+                continue
+            moved += 1
+        if from_layout == "sharded":
+            self._remove_empty_shards()
+        self._write_layout()
+        LOGGER.info("Migrated %d images in %s", moved, self.file_path)
+
+    def _remove_empty_shards(self):
+        for outer in list(self._iter_shards(self.file_path)):
+            for inner in list(self._iter_shards(outer.path)):
+                try:
+                    os.rmdir(inner.path)
+                except OSError:  # Not empty
+                    pass
+            try:
+                os.rmdir(outer.path)
+            except OSError:
+                pass
+
     def _delete_all(self):
-        for path in os.listdir(self.file_path):
-            full_path = os.path.join(self.file_path, path)
-            if os.path.isfile(full_path) and "receipts.sqlite3" not in path:
-                os.remove(full_path)
+        for entry in list(self._iter_entries()):
+            os.remove(entry.path)
+        self._remove_empty_shards()
 
     def initialize_storage(self, clean: bool = False):
         os.makedirs(self.file_path, exist_ok=True)
+        self._check_layout()
+        if not os.path.exists(os.path.join(self.file_path, LAYOUT_FILE)):
+            self._write_layout()
         if clean:
             self._delete_all()
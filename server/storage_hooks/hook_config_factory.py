@@ -1,23 +1,44 @@
-# We may find a better way of doing this that is more scalable
-# however we have very few cases to deal with anyway
-from storage_hooks.AWS import AWSS3Hook
-from storage_hooks.RemoteSQL import RemoteSQL
-from storage_hooks.SQLite3 import SQLite3
-from storage_hooks.file_system import FileSystemHook
+"""Creates storage hooks from their names in the config
+
+Hooks are imported only when selected, so e.g. boto3 is never loaded for a
+file system deployment. Third party hooks can be added through the
+``receipt_database.file_hooks`` and ``receipt_database.meta_hooks`` entry point
+groups, with the entry point name used in the config.
+"""
+
+import importlib
+from importlib.metadata import entry_points
+
 from storage_hooks.storage_hooks import DatabaseHook, FileHook
 
+# Hook name -> "module:Class"
+FILE_HOOKS = {
+    "FS": "storage_hooks.file_system:FileSystemHook",
+    "AWS": "storage_hooks.AWS:AWSS3Hook",
+    "AsyncAWS": "storage_hooks.async_s3:AsyncS3Hook",
+    "Tiered": "storage_hooks.tiered:TieredHook",
+}
+META_HOOKS = {
+    "SQLite3": "storage_hooks.SQLite3:SQLite3",
+    "RemoteSQL": "storage_hooks.RemoteSQL:RemoteSQL",
+}
+
+
+def _load(name: str, registry: dict[str, str], group: str) -> type:
+    if (target := registry.get(name)) is not None:
+        module, _, attr = target.partition(":")
+        return getattr(importlib.import_module(module), attr)
+    for entry_point in entry_points(group=group, name=name):
+        return entry_point.load()
+    raise ValueError(
+        f"Unknown storage hook {name!r}, expected one of {', '.join(registry)}"
+        f" or a {group} entry point"
+    )
+
 
-def get_file_hook(file_hook_str) -> FileHook:
-    match file_hook_str:
-        case "FS":
-            return FileSystemHook()
-        case "AWS":
-            return AWSS3Hook()
+def get_file_hook(file_hook_str: str) -> FileHook:
+    return _load(file_hook_str, FILE_HOOKS, "receipt_database.file_hooks")()
 
 
-def get_meta_hook(meta_hook_str) -> DatabaseHook:
-    match meta_hook_str:
-        case "SQLite3":
-            return SQLite3()
-        case "RemoteSQL":
-            return RemoteSQL()
+def get_meta_hook(meta_hook_str: str) -> DatabaseHook:
+    return _load(meta_hook_str, META_HOOKS, "receipt_database.meta_hooks")()
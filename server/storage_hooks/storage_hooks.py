@@ -1,16 +1,261 @@
 import abc
+import collections
+import contextlib
+import contextvars
 import datetime as dt
 import enum
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
 from pathlib import Path
-from typing import Iterable, Optional, Sequence
+from typing import Callable, Iterable, Iterator, Optional, Sequence
 
-from sqlalchemy import Engine, asc, delete, desc, select
+from sqlalchemy import (
+    Engine,
+    Select,
+    String,
+    asc,
+    cast,
+    delete,
+    desc,
+    func,
+    insert,
+    inspect,
+    literal,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session, selectinload
 
-from receipt import Base, Receipt, Tag
+import metrics
+import resilience
+from app_logging import LOGGER
+from configure import CONFIG
+from receipt import Base, Change, ChangeSet, Receipt, ReceiptRow, Tag, receipt_tag
 
 UTC = dt.timezone.utc
 
+# Images may be passed as, and fetched as, any of these (see fetch_buffer)
+Buffer = bytes | bytearray | memoryview | mmap.mmap
+
+
+class UploadOffsetError(ValueError):
+    """A chunk of a staged upload does not continue from what was received
+
+    Attributes:
+        offset: The length received so far, where the next chunk must start
+    """
+
+    def __init__(self, offset: int):
+        super().__init__(f"The upload continues at offset {offset}")
+        self.offset = offset
+
+
+class InvalidUploadError(ValueError):
+    """An upload id was not issued by the hook, e.g. a client changed it"""
+
+    def __init__(self, upload_id: str):
+        super().__init__(f"Invalid upload id {upload_id!r}")
+
+
+# Spellings of the same file type, so content addressed keys of the same image
+# uploaded as e.g. ".jpeg" and ".JPG" are equal
+SUFFIX_ALIASES = {".jpeg": ".jpg", ".jpe": ".jpg", ".jfif": ".jpg", ".tif": ".tiff"}
+
+
+def key_suffix(original_name: str) -> str:
+    """The normalised suffix of a filename, for content addressed keys"""
+    suffix = Path(original_name).suffix.lower()
+    return SUFFIX_ALIASES.get(suffix, suffix)
+
+
+def check_chunk(offset: int, length: int, size: int, chunk_size: int):
+    """Raises ValueError unless a chunk fits in an upload of size
+
+    Chunks must start at a multiple of chunk_size and, unless they are the
+    last, be a multiple of it long.
+    """
+    if offset < 0 or offset + length > size:
+        raise ValueError(f"A chunk at {offset} of {length} bytes exceeds {size}")
+    if offset % chunk_size or (length % chunk_size and offset + length != size):
+        raise ValueError(f"Chunks must be multiples of {chunk_size} bytes")
+
+
+class WriteGenerations:
+    """Counts the committed writes to each table, e.g. to validate caches
+
+    The counters are in shared memory, so worker processes forked after the
+    hook was created see each other's writes. Writes made by other hosts (or
+    scripts) are not counted.
+    """
+
+    TABLES = ("receipt", "tag")
+
+    def __init__(self):
+        self._counters = multiprocessing.Array("Q", len(self.TABLES))
+
+    def bump(self, *tables: str):
+        with self._counters.get_lock():
+            for table in tables:
+                self._counters[self.TABLES.index(table)] += 1
+
+    def get(self, *tables: str) -> tuple[int, ...]:
+        """The current generation of each table"""
+        with self._counters.get_lock():
+            return tuple(self._counters[self.TABLES.index(t)] for t in tables)
+
+
+class UnitOfWork:
+    """One session, and transaction, shared by a hook's calls (e.g. a request's)
+
+    Started by ``DatabaseHook.begin``. The session is opened on the primary the
+    first time a hook method needs it, so reads see the unit's earlier writes
+    and objects stay in one identity map. Methods flush rather than commit;
+    ``finish`` commits or rolls back all of the work at once.
+    """
+
+    def __init__(self, hook: "DatabaseHook"):
+        self.hook = hook
+        self._session: Session | None = None
+        self._token: contextvars.Token | None = None
+        # A call abandoned by a timeout (see resilience.py) may still be using
+        # the session on another thread when the unit finishes
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._abandoned = False
+
+    @contextlib.contextmanager
+    def use(self) -> Iterator[Session]:
+        with self._lock:
+            if self._session is None:
+                self._session = Session(
+                    self.hook.engine,
+                    expire_on_commit=False,  # Results are still used after finish
+                    info={"unit_of_work": True},
+                )
+            self._depth += 1
+            try:
+                yield self._session
+            finally:
+                self._depth -= 1
+                if self._abandoned and not self._depth:
+                    self._close(commit=False)
+
+    def commit(self):
+        """Commits the work so far, leaving the unit open"""
+        with self._lock:
+            if self._session is not None:
+                self._session.commit()
+                self.hook._committed(self._session)
+
+    def finish(self, commit: bool = True):
+        """Commits (or rolls back) the work, and stops sharing the session
+
+        Must be called in the context ``begin`` was called in.
+        """
+        if self._token is not None:
+            _unit_of_work.reset(self._token)
+            self._token = None
+        self._abandoned = True
+        if not self._lock.acquire(blocking=False):
+            return  # Rolled back by the abandoned call once it is done
+        try:
+            self._close(commit)
+        finally:
+            self._lock.release()
+
+    def _close(self, commit: bool):
+        if (session := self._session) is None:
+            return
+        self._session = None
+        try:
+            if commit:
+                session.commit()
+                self.hook._committed(session)
+            else:
+                session.rollback()
+        finally:
+            session.close()
+
+
+_unit_of_work: contextvars.ContextVar[UnitOfWork | None] = contextvars.ContextVar(
+    "unit_of_work", default=None
+)
+
+
+class ClientWrites:
+    """When one client (e.g. of the HTTP API) last wrote, see ``track_client``
+
+    Hooks with read replicas send the client's reads to the primary for a while
+    after its writes, so it reads its own writes. The state is kept per client
+    rather than per process, as its next request may reach another process.
+
+    Attributes:
+        last_write: POSIX time of the client's last committed write, 0 if none
+    """
+
+    __slots__ = ("last_write",)
+
+    def __init__(self, last_write: float = 0.0):
+        self.last_write = last_write
+
+
+# A mutable object, so writes made in a copied context (see resilience.py) count
+_client: contextvars.ContextVar[ClientWrites | None] = contextvars.ContextVar(
+    "client_writes", default=None
+)
+
+
+def track_client(last_write: float = 0.0) -> tuple[ClientWrites, contextvars.Token]:
+    """Attributes the current context's writes to a client
+
+    Args:
+        last_write: When the client last wrote, as it reported
+
+    Returns:
+        The client's state, updated by committed writes, and a token to reset
+        the context with once done
+    """
+    client = ClientWrites(last_write)
+    return client, _client.set(client)
+
+
+def current_client() -> ClientWrites | None:
+    return _client.get()
+
+
+def untrack_client(token: contextvars.Token):
+    _client.reset(token)
+
+
+# Set while reads must see every committed write, see read_primary
+_read_primary: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "read_primary", default=False
+)
+
+
+@contextlib.contextmanager
+def read_primary() -> Iterator[None]:
+    """Sends the block's reads to the primary, rather than a lagging replica
+
+    For results kept longer than replicas lag behind, e.g. cached responses
+    """
+    token = _read_primary.set(True)
+    try:
+        yield
+    finally:
+        _read_primary.reset(token)
+
 
 class ReceiptSort(enum.Enum):
     """Represents different methods to sort data."""
@@ -21,36 +266,208 @@ class ReceiptSort(enum.Enum):
 
 class DatabaseHook(abc.ABC):
     storage_version = "0.2.0"
+    # Reached over the network, so operations get timeouts (see resilience.py)
+    remote = False
+    # Seconds a client's reads go to the primary after its writes, 0 when the
+    # hook has no replicas (see ClientWrites)
+    sticky_seconds: float = 0
+    # Methods that only read, which may be served by a replica
+    read_operations = (
+        "fetch_receipt",
+        "fetch_receipts",
+        "fetch_receipt_rows",
+        "count_references",
+        "fetch_tag",
+        "fetch_tags",
+    )
+    # Methods whose latency is recorded in metrics and which are guarded by
+    # resilience.py, including overrides
+    timed_operations = (
+        "create_receipt",
+        "fetch_receipt",
+        "fetch_receipts",
+        "fetch_receipt_rows",
+        "update_receipt",
+        "delete_receipt",
+        "count_references",
+        "create_tag",
+        "fetch_tag",
+        "fetch_tags",
+        "update_tag",
+        "delete_tag",
+        "fetch_changes",
+    )
+    hedged_operations: tuple[str, ...] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        resilience.instrument(cls, cls.timed_operations, cls.hedged_operations)
+        metrics.instrument(cls, cls.timed_operations)
 
     def __init__(self):
         self.engine: Engine = NotImplemented
+        self.generations = WriteGenerations()
+        # Called with (kind, action, id) of each record changed by a write, once
+        # committed. Actions are "created", "updated" and "deleted".
+        self.change_listeners: list[Callable[[str, str, int], None]] = []
+
+    @property
+    def engines(self) -> list[Engine]:
+        """Every engine the hook connects with"""
+        return [self.engine]
+
+    def _read_engine(self) -> Engine:
+        """The engine used by read only methods, e.g. a replica"""
+        return self.engine
+
+    def begin(self) -> UnitOfWork:
+        """Shares one session between this hook's calls in the current context
+
+        Returns:
+            The unit of work, which must be finished
+        """
+        unit = UnitOfWork(self)
+        unit._token = _unit_of_work.set(unit)
+        return unit
+
+    @contextlib.contextmanager
+    def unit_of_work(self) -> Iterator[UnitOfWork]:
+        """Runs the block as one unit of work, rolled back if it raises"""
+        unit = self.begin()
+        try:
+            yield unit
+        except BaseException:
+            unit.finish(commit=False)
+            raise
+        unit.finish()
+
+    def commit(self):
+        """Commits the current unit of work so far, e.g. before deleting files
+        that must only go once the receipts using them are gone"""
+        if (unit := _unit_of_work.get()) is not None and unit.hook is self:
+            unit.commit()
+
+    @contextlib.contextmanager
+    def _session(self, read: bool = False) -> Iterator[Session]:
+        """The current unit of work's session, or a new one for this call
+
+        Args:
+            read: Only reads, so may use a replica when outside a unit of work
+        """
+        if (unit := _unit_of_work.get()) is not None and unit.hook is self:
+            with unit.use() as session:
+                yield session
+            return
+        replica = read and not _read_primary.get()
+        with Session(self._read_engine() if replica else self.engine) as session:
+            yield session
+
+    def _commit(self, session: Session, *tables: str):
+        """Commits (or flushes, in a unit of work) writes to tables
+
+        Args:
+            tables: Whose generations are bumped once committed, default all
+        """
+        written = session.info.setdefault("written", set())
+        written.update(tables or WriteGenerations.TABLES)
+        if session.info.get("unit_of_work"):
+            session.flush()  # Committed when the unit of work finishes
+        else:
+            session.commit()
+            self._committed(session)
+
+    def _committed(self, session: Session):
+        if (client := _client.get()) is not None:
+            client.last_write = time.time()
+        if written := session.info.pop("written", None):
+            self.generations.bump(*written)
+        for change in session.info.pop("changes", ()):
+            for listener in self.change_listeners:
+                try:
+                    listener(*change)
+                except Exception:
+                    # The write has happened regardless
+                    LOGGER.exception("Change listener %r failed", listener)
+
+    @staticmethod
+    def _record_changes(
+        session: Session, kind: str, ids: Iterable[int], action: str = "updated"
+    ):
+        """Replaces the recorded changes of records with one for this write
+
+        Args:
+            kind: The records' table, "receipt" or "tag"
+            ids: The records' ids
+            action: "created", "updated", or "deleted" to record a tombstone
+        """
+        if not (ids := list(ids)):
+            return
+        deleted = action == "deleted"
+        session.execute(
+            delete(Change).where(Change.kind == kind, Change.record_id.in_(ids))
+        )
+        session.execute(
+            insert(Change),
+            [
+                {"kind": kind, "record_id": id_, "deleted": deleted, "action": action}
+                for id_ in ids
+            ],
+        )
+        # For the change listeners, once committed
+        session.info.setdefault("changes", []).extend(
+            (kind, action, id_) for id_ in ids
+        )
+
+    @classmethod
+    def _record_objects(cls, session: Session, objects: Iterable[Base], action: str):
+        for kind, model in (("receipt", Receipt), ("tag", Tag)):
+            # The identity is known without loading, even for detached objects
+            ids = [inspect(o).identity[0] for o in objects if isinstance(o, model)]
+            cls._record_changes(session, kind, ids, action)
 
     def save_objects(self, *objects: Base):
-        with Session(self.engine) as session:
+        with self._session() as session:
+            new = {id(obj) for obj in objects if inspect(obj).identity is None}
             session.add_all(objects)
-            session.commit()
+            session.flush()
+            for action, is_new in (("created", True), ("updated", False)):
+                changed = [obj for obj in objects if (id(obj) in new) == is_new]
+                self._record_objects(session, changed, action)
+            self._commit(session)
 
     def delete_objects(self, *objects: Base):
-        with Session(self.engine) as session:
+        with self._session() as session:
+            self._record_objects(session, objects, "deleted")
             for obj in objects:
                 session.delete(obj)
-            session.commit()
+            self._commit(session)
 
     def create_receipt(self, receipt: Receipt) -> Receipt:
-        with Session(self.engine) as session:
+        with self._session() as session:
             session.add(receipt)
-            session.commit()
+            session.flush()
+            self._record_changes(session, "receipt", [receipt.id], "created")
+            self._commit(session, "receipt")
             full_receipt = self.fetch_receipt(receipt.id)
             if full_receipt is None:
                 raise RuntimeError
             return full_receipt
 
     def fetch_receipt(self, id_: int) -> Optional[Receipt]:
+        with self._session(read=True) as session:
+            # Without a query when the unit of work already has the receipt
+            return session.get(Receipt, id_, options=[selectinload(Receipt.tags)])
+
+    def fetch_receipt_by_upload(self, upload_id: str) -> Optional[Receipt]:
+        """The receipt created from a resumable upload, if it was committed"""
         stmt = (
-            select(Receipt).options(selectinload(Receipt.tags)).where(Receipt.id == id_)
+            select(Receipt)
+            .where(Receipt.upload_id == upload_id)
+            .options(selectinload(Receipt.tags))
         )
-        with Session(self.engine) as session:
-            return session.scalar(stmt)
+        # Not from a replica, which may not have the receipt yet
+        with self._session() as session:
+            return session.scalars(stmt).one_or_none()
 
     def fetch_receipts(
         self,
@@ -61,21 +478,91 @@ class DatabaseHook(abc.ABC):
         limit: Optional[int] = None,
         sort: ReceiptSort = ReceiptSort.newest,
     ) -> Sequence[Receipt]:
-        stmt = select(Receipt).options(selectinload(Receipt.tags)).order_by(sort.value)
+        stmt = select(Receipt).options(selectinload(Receipt.tags))
+        stmt = self._filter_receipts(
+            stmt, after, before, tags, match_all_tags, limit, sort
+        )
+        with self._session(read=True) as session:
+            return session.scalars(stmt).all()
+
+    def fetch_receipt_rows(
+        self,
+        after: Optional[dt.datetime] = None,
+        before: Optional[dt.datetime] = None,
+        tags: Optional[list[Tag]] = None,
+        match_all_tags: bool = False,
+        limit: Optional[int] = None,
+        sort: ReceiptSort = ReceiptSort.newest,
+    ) -> list[ReceiptRow]:
+        """Like fetch_receipts, but only the columns needed to list receipts
+
+        One statement selects the columns and aggregates each receipt's tag ids,
+        without creating ORM objects, which is much cheaper for long lists.
+        """
+        stmt = self._filter_receipts(
+            self._select_receipt_rows(),
+            after,
+            before,
+            tags,
+            match_all_tags,
+            limit,
+            sort,
+        )
+        with self._session(read=True) as session:
+            return self._receipt_rows(session, stmt)
+
+    def _select_receipt_rows(self) -> Select:
+        tag_id = receipt_tag.c.tag_id
+        if self.engine.dialect.name in ("postgresql", "mssql"):
+            tag_ids = func.string_agg(cast(tag_id, String), literal(","))
+        else:  # SQLite, MySQL and MariaDB
+            tag_ids = func.group_concat(tag_id)
+        columns = (Receipt.id, Receipt.name, Receipt.storage_key, Receipt.upload_dt)
+        return (
+            select(*columns, tag_ids).outerjoin(
+                receipt_tag, receipt_tag.c.receipt_key == Receipt.id
+            )
+            # Every selected column, which SQL Server requires (others accept
+            # columns depending on the grouped primary key)
+            .group_by(*columns)
+        )
+
+    @staticmethod
+    def _receipt_rows(session: Session, stmt: Select) -> list[ReceiptRow]:
+        return [
+            ReceiptRow(
+                id_,
+                name,
+                storage_key,
+                upload_dt,
+                sorted(map(int, ids.split(","))) if ids else [],
+            )
+            for id_, name, storage_key, upload_dt, ids in session.execute(stmt)
+        ]
+
+    @staticmethod
+    def _filter_receipts(
+        stmt: Select,
+        after: Optional[dt.datetime],
+        before: Optional[dt.datetime],
+        tags: Optional[list[Tag]],
+        match_all_tags: bool,
+        limit: Optional[int],
+        sort: ReceiptSort,
+    ) -> Select:
+        stmt = stmt.order_by(sort.value)
         if after is not None:
             stmt = stmt.where(after < Receipt.upload_dt)
         if before is not None:
             stmt = stmt.where(before > Receipt.upload_dt)
         if tags is not None:
             if match_all_tags:
-                stmt = stmt.where(Receipt.tags.all(Tag.id.in_(tags)))
+                stmt = stmt.where(*(Receipt.tags.any(Tag.id == tag) for tag in tags))
             else:
                 stmt = stmt.where(Receipt.tags.any(Tag.id.in_(tags)))
         if limit is not None:
             stmt = stmt.limit(limit)
-
-        with Session(self.engine) as session:
-            return session.scalars(stmt).all()
+        return stmt
 
     def update_receipt(
         self,
@@ -84,11 +571,17 @@ class DatabaseHook(abc.ABC):
         set_tags: Iterable[int] | None = None,
         add_tags: Iterable[int] | None = None,
         remove_tags: Iterable[int] | None = None,
+        storage_key: str | None = None,
+        original_key: str | None = None,
     ) -> Receipt:
-        with Session(self.engine) as session:
+        with self._session() as session:
             receipt = session.get_one(Receipt, receipt_id)
             if name is not None:
                 receipt.name = name
+            if storage_key is not None:
+                receipt.storage_key = storage_key
+            if original_key is not None:  # An empty string removes the original
+                receipt.original_key = original_key or None
 
             if set_tags is not None:
                 tag_ids = set_tags
@@ -103,24 +596,85 @@ class DatabaseHook(abc.ABC):
             receipt.tags = session.scalars(
                 select(Tag).filter(Tag.id.in_(tag_ids))
             ).all()
+            # Set even if only the tags changed, which onupdate would miss
+            receipt.updated_at = dt.datetime.now(UTC)
 
-            session.commit()
+            self._record_changes(session, "receipt", [receipt_id])
+            self._commit(session, "receipt")
         return self.fetch_receipt(receipt_id)
 
     def delete_receipt(self, id_: int):
-        with Session(self.engine) as session:
+        with self._session() as session:
+            session.execute(delete(receipt_tag).where(receipt_tag.c.receipt_key == id_))
             stmt = delete(Receipt).where(
                 Receipt.id == id_
             )  # .returning(Receipt.storage_key)
             # key = session.execute(stmt).one()[0]
             session.execute(stmt)
-            session.commit()
+            self._record_changes(session, "receipt", [id_], "deleted")
+            self._commit(session, "receipt")
             # return key
 
-    def create_tag(self, tag: Tag) -> Tag:
+    def count_references(self, storage_key: str) -> int:
+        """Counts the receipts that reference a stored image
+
+        Args:
+            storage_key: The location of the image
+
+        Returns:
+            The number of receipts using storage_key
+        """
+        stmt = select(func.count()).where(
+            or_(Receipt.storage_key == storage_key, Receipt.original_key == storage_key)
+        )
+        with self._session(read=True) as session:
+            return session.scalar(stmt) or 0
+
+    def iter_storage_keys(
+        self, batch_size: int = 1000
+    ) -> Iterator[tuple[str, dt.datetime]]:
+        """Streams every image key referenced by a receipt
+
+        Keys are read from the primary in batches of batch_size, so all of them
+        are never held in memory. A key shared by several receipts is repeated.
+
+        Yields:
+            The storage (or original) key and upload time of each receipt
+        """
         with Session(self.engine) as session:
+            for column in (Receipt.storage_key, Receipt.original_key):
+                stmt = (
+                    select(column, Receipt.upload_dt)
+                    .where(column.is_not(None))
+                    .execution_options(yield_per=batch_size)
+                )
+                for key, uploaded in session.execute(stmt):
+                    yield key, uploaded
+
+    def referenced_keys(self, keys: Iterable[str]) -> set[str]:
+        """Returns which of keys are referenced by a receipt"""
+        keys = list(keys)
+        with self._session() as session:
+            found = set(
+                session.scalars(
+                    select(Receipt.storage_key).where(Receipt.storage_key.in_(keys))
+                )
+            )
+            found.update(
+                session.scalars(
+                    select(Receipt.original_key).where(Receipt.original_key.in_(keys))
+                )
+            )
+        return found
+
+    def create_tag(self, tag: Tag) -> Tag:
+        with self._session() as session:
+            # Also used by update_tag, with a tag that already exists
+            action = "created" if inspect(tag).identity is None else "updated"
             session.add(tag)
-            session.commit()
+            session.flush()
+            self._record_changes(session, "tag", [tag.id], action)
+            self._commit(session, "tag")
             full_tag = self.fetch_tag(tag.id)
             if full_tag is None:
                 raise RuntimeError
@@ -128,11 +682,11 @@ class DatabaseHook(abc.ABC):
 
     def fetch_tag(self, tag_id: int) -> Optional[Tag]:
         stmt = select(Tag).where(Tag.id == tag_id)
-        with Session(self.engine) as session:
+        with self._session(read=True) as session:
             return session.scalar(stmt)
 
     def fetch_tags(self, tag_ids: Optional[list[int]] = None) -> Sequence[Tag]:
-        with Session(self.engine) as session:
+        with self._session(read=True) as session:
             stmt = select(Tag)
             if tag_ids is not None:
                 stmt = stmt.filter(Tag.id.in_(tag_ids))
@@ -142,10 +696,117 @@ class DatabaseHook(abc.ABC):
         return self.create_tag(updated_tag)
 
     def delete_tag(self, tag_id: int) -> None:
-        with Session(self.engine) as session:
+        with self._session() as session:
+            # Remove it from receipts first, which counts as changing them
+            link = receipt_tag.c.tag_id == tag_id
+            receipt_ids = session.scalars(select(receipt_tag.c.receipt_key).where(link))
+            if receipt_ids := receipt_ids.all():
+                session.execute(delete(receipt_tag).where(link))
+                session.execute(
+                    update(Receipt)
+                    .where(Receipt.id.in_(receipt_ids))
+                    .values(updated_at=dt.datetime.now(UTC))
+                )
+                self._record_changes(session, "receipt", receipt_ids)
             stmt = delete(Tag).where(Tag.id == tag_id)
             session.execute(stmt)
-            session.commit()
+            self._record_changes(session, "tag", [tag_id], "deleted")
+            self._commit(session, "tag", "receipt")
+
+    def fetch_changes(
+        self, since: int = 0, limit: int = 1000, settle_seconds: float = 10
+    ) -> ChangeSet:
+        """The receipts and tags changed or deleted since a sync token
+
+        Sequence numbers are handed out when a change is written, not when it
+        is committed, so a slow transaction may commit a change numbered below
+        one already seen. The returned token therefore stops before changes
+        younger than settle_seconds; they are returned again by the next sync.
+
+        Args:
+            since: The token returned by the previous sync, 0 for everything
+            limit: Changes returned at most, the rest follow from the token
+            settle_seconds: Longer than any transaction writing changes takes
+
+        Returns:
+            The changed records, tombstones and the token to sync from next
+        """
+        settled = dt.datetime.now(UTC) - dt.timedelta(seconds=settle_seconds)
+        stmt = (
+            select(
+                Change.seq,
+                Change.kind,
+                Change.record_id,
+                Change.deleted,
+                Change.changed_at,
+            )
+            .where(Change.seq > since)
+            .order_by(Change.seq)
+            .limit(limit)
+        )
+        # Not from a replica, whose changes may be further behind than that
+        with self._session() as session:
+            changes = session.execute(stmt).all()
+            token = since
+            for change in changes:
+                if change.changed_at > settled:
+                    break
+                token = change.seq
+
+            ids: dict[tuple[str, bool], list[int]] = collections.defaultdict(list)
+            for change in changes:
+                ids[change.kind, change.deleted].append(change.record_id)
+            receipts = []
+            if changed := ids["receipt", False]:
+                receipts = self._receipt_rows(
+                    session,
+                    self._select_receipt_rows().where(Receipt.id.in_(changed)),
+                )
+            tags = []
+            if changed := ids["tag", False]:
+                tags = session.scalars(select(Tag).where(Tag.id.in_(changed))).all()
+        return ChangeSet(
+            token,
+            receipts,
+            tags,
+            ids["receipt", True],
+            ids["tag", True],
+            more=len(changes) == limit and token > since,
+        )
+
+    def fetch_change_log(self, since: int = 0, limit: int = 1000) -> Sequence[Row]:
+        """The changes written after a sequence number, without their records
+
+        Used for change events (see events.ChangeBroker), which may be sent
+        before the changes settle, unlike fetch_changes.
+
+        Args:
+            since: Changes with a higher sequence number are returned
+            limit: Changes returned at most, the oldest first
+
+        Returns:
+            Rows of seq, kind, record_id, deleted, action and changed_at
+        """
+        stmt = (
+            select(
+                Change.seq,
+                Change.kind,
+                Change.record_id,
+                Change.deleted,
+                Change.action,
+                Change.changed_at,
+            )
+            .where(Change.seq > since)
+            .order_by(Change.seq)
+            .limit(limit)
+        )
+        with self._session() as session:
+            return session.execute(stmt).all()
+
+    def last_change_seq(self) -> int:
+        """The sequence number of the newest change, 0 without any"""
+        with self._session() as session:
+            return session.scalar(select(func.max(Change.seq))) or 0
 
     def initialize_storage(self, clean: bool = True):
         """Initialize storage / database with current scheme.
@@ -155,18 +816,135 @@ class DatabaseHook(abc.ABC):
         """
         if clean:
             Base.metadata.drop_all(self.engine)
-        Base.metadata.create_all(self.engine)
+            Base.metadata.create_all(self.engine)
+        else:
+            self.update_storage()  # Creates missing tables as well
+        self.generations.bump(*WriteGenerations.TABLES)
 
+    def update_storage(self) -> bool:
+        """Migrates the database to the current scheme version.
 
-class FileHook(abc.ABC):
-    """Base class for hooks that store image files."""
+        Only additive changes are supported: missing tables, indexes and
+        nullable (or defaulted) columns are created.
+
+        Returns:
+            True if successful, False otherwise.
+        """
+        inspector = inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                if not inspector.has_table(table.name):
+                    table.create(conn)
+                    if table is Change.__table__:
+                        self._record_existing(conn)
+                    continue
+
+                columns = {c["name"] for c in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in columns:
+                        continue
+                    if not column.nullable and column.server_default is None:
+                        LOGGER.error(
+                            "Cannot add required column %s.%s", table.name, column.name
+                        )
+                        return False
+                    col_type = column.type.compile(dialect=self.engine.dialect)
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE {table.name} "
+                            f"ADD COLUMN {column.name} {col_type}"
+                        )
+                    )
+                    LOGGER.info("Added column %s.%s", table.name, column.name)
+
+                indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+                for index in table.indexes:
+                    if index.name not in indexes:
+                        index.create(conn)
+                        LOGGER.info("Added index %s", index.name)
+        return True
 
     @staticmethod
-    def _make_key(original_name: str):
+    def _record_existing(conn):
+        """Records a change for every receipt and tag, so a first sync has them"""
+        for kind, model in (("receipt", Receipt), ("tag", Tag)):
+            conn.execute(
+                insert(Change).from_select(
+                    ["kind", "record_id", "deleted", "changed_at"],
+                    select(
+                        literal(kind),
+                        model.id,
+                        literal(False),
+                        literal(dt.datetime.now(UTC), Change.changed_at.type),
+                    ),
+                )
+            )
+        LOGGER.info("Recorded changes for existing receipts and tags")
+
+    def after_fork(self):
+        """Resets process specific state in a newly forked worker
+
+        Pooled connections inherited from the parent are dropped without being
+        closed, as they are still in use by the parent.
+        """
+        for engine in self.engines:
+            engine.dispose(close=False)
+
+
+resilience.instrument(DatabaseHook, DatabaseHook.timed_operations)
+metrics.instrument(DatabaseHook, DatabaseHook.timed_operations)
+
+
+class FileHook(abc.ABC):
+    """Base class for hooks that store image files.
+
+    When ``content_addressed`` is set, keys are the SHA-256 of the image, so
+    identical uploads share one stored object. Callers must then only delete an
+    image once no receipt references it (see ``DatabaseHook.count_references``)
+    and must save a new image instead of replacing a shared one. Saving an image
+    that is already stored touches it (see ``modified``), so it is not deleted
+    as unreferenced before the new upload's receipt exists.
+    """
+
+    # Reached over the network, so operations get timeouts and reads are hedged
+    remote = False
+    # Methods whose latency is recorded in metrics and which are guarded by
+    # resilience.py, and those of them which only read
+    timed_operations = (
+        "save",
+        "replace",
+        "fetch",
+        "fetch_buffer",
+        "delete",
+        "begin_upload",
+        "stage_chunk",
+        "upload_progress",
+        "finish_upload",
+        "abort_upload",
+    )
+    hedged_operations = ("fetch", "fetch_buffer")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        resilience.instrument(cls, cls.timed_operations, cls.hedged_operations)
+        metrics.instrument(cls, cls.timed_operations)
+
+    def __init__(self):
+        self.content_addressed: bool = CONFIG.StorageHooks.content_addressed
+
+    def _make_key(self, original_name: str, image: Buffer) -> str:
+        if self.content_addressed:
+            digest = hashlib.sha256(image).hexdigest()
+            return f"{digest}{key_suffix(original_name)}"
         filename = Path(original_name)
         now = dt.datetime.now(UTC).isoformat(timespec="seconds")
         return f"{filename.stem} ({now}){filename.suffix}"
 
+    @property
+    def upload_chunk_size(self) -> int:
+        """Chunks of staged uploads are multiples of this, except the last"""
+        return CONFIG.Uploads.chunk_bytes
+
     @abc.abstractmethod
     def save(self, image: bytes, original_name: str) -> str:
         """Saves an image
@@ -204,6 +982,30 @@ class FileHook(abc.ABC):
             FileNotFoundError: When the location doesn't exist
         """
 
+    def modified(self, location: str) -> float | None:
+        """When the image at location was last saved, replaced or touched
+
+        Returns:
+            A POSIX timestamp, or None when the hook can't tell
+
+        Raises:
+            FileNotFoundError: When the location doesn't exist
+        """
+        return None
+
+    def fetch_buffer(self, location: str) -> Buffer:
+        """Fetches image from location without copying it where possible
+
+        The result supports the buffer protocol, so it can be hashed, sliced
+        through a memoryview or sent without making a ``bytes`` copy. Hooks
+        may return a read only memory map of the stored file, which should be
+        closed (or released) once done with.
+
+        Raises:
+            FileNotFoundError: When the location doesn't exist
+        """
+        return self.fetch(location)
+
     @abc.abstractmethod
     def delete(self, location: str):
         """Deletes the image at location
@@ -222,3 +1024,200 @@ class FileHook(abc.ABC):
         Args:
             clean: Delete any existing data that may be present
         """
+
+    def fetch_many(self, locations: Iterable[str]) -> dict[str, bytes]:
+        """Fetches several images, which hooks may do concurrently
+
+        Returns:
+            Each location and its image, omitting those that do not exist
+        """
+        images = {}
+        for location in locations:
+            try:
+                images[location] = self.fetch(location)
+            except FileNotFoundError:
+                pass
+        return images
+
+    @abc.abstractmethod
+    def iter_keys(self) -> Iterator[tuple[str, float]]:
+        """Streams the location of every stored image, e.g. for reconcile.py
+
+        Only images are listed, never the hook's own files (staged uploads etc.)
+
+        Yields:
+            Each location and its last modification time as a POSIX timestamp
+        """
+
+    def delete_many(self, locations: Iterable[str]):
+        """Deletes images, ignoring any that do not exist"""
+        for location in locations:
+            try:
+                self.delete(location)
+            except FileNotFoundError:
+                pass
+
+    # Staged uploads, received in chunks. By default these are staged as files
+    # in Uploads.staging_dir and saved once complete.
+
+    def _staging_dir(self) -> str:
+        return CONFIG.Uploads.staging_dir or os.path.join(
+            tempfile.gettempdir(), "receipt-uploads"
+        )
+
+    def _staged_paths(self, upload_id: str) -> tuple[str, str]:
+        """The paths of an upload's data and its description"""
+        # Ids come from clients, so must not be able to name other files
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+            raise FileNotFoundError(upload_id)
+        path = os.path.join(self._staging_dir(), upload_id)
+        return f"{path}.part", f"{path}.json"
+
+    def _staged_info(self, upload_id: str) -> tuple[str, dict]:
+        data_path, info_path = self._staged_paths(upload_id)
+        with open(info_path) as file:
+            return data_path, json.load(file)
+
+    def _finish_staged(self, upload_id: str, key: str) -> str:
+        """Remembers the key a staged upload was saved as, for finishing again"""
+        data_path, info = self._staged_info(upload_id)
+        _, info_path = self._staged_paths(upload_id)
+        with open(f"{info_path}.tmp", "w") as file:
+            json.dump({**info, "key": key}, file)
+        os.replace(f"{info_path}.tmp", info_path)
+        try:
+            os.remove(data_path)
+        except FileNotFoundError:  # Moved to the key
+            pass
+        return key
+
+    def _expire_staged(self, staging_dir: str):
+        """Removes uploads that have received nothing for Uploads.expire_hours
+
+        Finished uploads are forgotten then as well, if the app did not already.
+        """
+        cutoff = time.time() - CONFIG.Uploads.expire_hours * 3600
+        with os.scandir(staging_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                upload_id = entry.name.removesuffix(".json")
+                data_path, _ = self._staged_paths(upload_id)
+                try:
+                    modified = max(entry.stat().st_mtime, os.stat(data_path).st_mtime)
+                except FileNotFoundError:  # Finished
+                    modified = entry.stat().st_mtime
+                if modified < cutoff:
+                    try:
+                        self.abort_upload(upload_id)
+                    except FileNotFoundError:  # Expired by another worker
+                        pass
+
+    def begin_upload(self, original_name: str, size: int) -> str:
+        """Starts staging an image that will be received in chunks
+
+        Args:
+            original_name: Filename of the uploaded image to generate a key from
+            size: Length of the complete image in bytes
+
+        Returns:
+            The id of the upload, for the other upload methods
+
+        Raises:
+            ValueError: When size is not positive
+        """
+        if size < 1:
+            raise ValueError("An upload must not be empty")
+        staging_dir = self._staging_dir()
+        os.makedirs(staging_dir, exist_ok=True)
+        self._expire_staged(staging_dir)
+        upload_id = uuid.uuid4().hex
+        data_path, info_path = self._staged_paths(upload_id)
+        open(data_path, "xb").close()
+        with open(info_path, "x") as file:
+            json.dump({"name": original_name, "size": size}, file)
+        return upload_id
+
+    def stage_chunk(self, upload_id: str, offset: int, chunk: bytes) -> int:
+        """Stores a chunk of a staged upload
+
+        A chunk may be sent again, e.g. when its response was lost.
+
+        Args:
+            upload_id: The id returned by begin_upload
+            offset: Position of the chunk in the image, see check_chunk
+            chunk: The received bytes
+
+        Returns:
+            Where the next chunk continues
+
+        Raises:
+            FileNotFoundError: When the upload doesn't exist
+            UploadOffsetError: When the chunk would leave a gap (hooks
+                accepting chunks in any order check this in finish_upload)
+            ValueError: When the chunk does not fit the upload
+        """
+        data_path, info = self._staged_info(upload_id)
+        check_chunk(offset, len(chunk), info["size"], self.upload_chunk_size)
+        with open(data_path, "r+b") as file:
+            received = os.fstat(file.fileno()).st_size
+            if offset > received:
+                raise UploadOffsetError(received)
+            # Writing at the offset, rather than appending, keeps resent
+            # chunks (even concurrent ones) from being stored twice
+            file.seek(offset)
+            file.write(chunk)
+        return max(received, offset + len(chunk))
+
+    def upload_progress(self, upload_id: str) -> tuple[int, int]:
+        """How much of a staged upload has been received
+
+        Returns:
+            The length received so far, where the upload continues, and the
+            length of the complete image
+
+        Raises:
+            FileNotFoundError: When the upload doesn't exist
+        """
+        data_path, info = self._staged_info(upload_id)
+        return os.stat(data_path).st_size, info["size"]
+
+    def finish_upload(self, upload_id: str) -> str:
+        """Saves a completely received upload as an image
+
+        Finishing again, e.g. when a request creating its receipt failed,
+        returns the same location until abort_upload forgets the upload.
+
+        Returns:
+            The string location to fetch the image later
+
+        Raises:
+            FileNotFoundError: When the upload doesn't exist
+            UploadOffsetError: When the upload is not complete yet
+        """
+        data_path, info = self._staged_info(upload_id)
+        if (key := info.get("key")) is not None:
+            return key
+        with open(data_path, "rb") as file:
+            image = file.read()
+        if len(image) != info["size"]:
+            raise UploadOffsetError(len(image))
+        return self._finish_staged(upload_id, self.save(image, info["name"]))
+
+    def abort_upload(self, upload_id: str):
+        """Discards a staged upload and what it received, or forgets a finished
+        one (keeping the image it was saved as)
+
+        Raises:
+            FileNotFoundError: When the upload doesn't exist
+        """
+        data_path, info_path = self._staged_paths(upload_id)
+        os.remove(info_path)
+        try:
+            os.remove(data_path)
+        except FileNotFoundError:  # Finished
+            pass
+
+    def after_fork(self):
+        """Resets process specific state (e.g. client connections) in a newly
+        forked worker"""
@@ -0,0 +1,309 @@
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+import metrics
+from app_logging import LOGGER
+from configure import CONFIG
+from storage_hooks.file_system import FileSystemHook
+from storage_hooks.storage_hooks import Buffer, FileHook
+
+Locations = Iterable[str] | Callable[[], Iterable[str]]
+WARM_BATCH = 64  # Images pre-fetched from the cold hook at a time
+FILL_STRIPES = 64  # Locks (and generations) shared by the locations hashed to them
+
+
+class TieredHook(FileHook):
+    """Write-through cold storage with a local disk cache for the hot set.
+
+    Every write goes to the cold hook first (the source of truth), then a copy is
+    kept in a ``FileSystemHook`` cache. The cache is bounded by ``max_bytes`` with
+    least recently used demotion, and images not read for ``max_age_days`` are
+    demoted by a background thread that also pre-fetches ("warms") images.
+
+    Writes bump the generation of the location's stripe. Images read from the
+    cold hook are only cached when that generation is unchanged since before the
+    read, so a fetch overlapping a replace cannot cache the old image.
+    """
+
+    def __init__(self, hot: FileSystemHook | None = None, cold: FileHook | None = None):
+        super().__init__()
+        self.config = CONFIG.Tiered
+
+        if cold is None:
+            from storage_hooks.hook_config_factory import get_file_hook
+
+            cold = get_file_hook(self.config.cold_hook)
+        self.hot = hot if hot is not None else FileSystemHook(self.config.cache_path)
+        self.cold = cold
+        self.content_addressed = cold.content_addressed
+        self.max_bytes = self.config.max_bytes
+        self.max_age = self.config.max_age_days * 24 * 60 * 60
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._fill_locks = [threading.Lock() for _ in range(FILL_STRIPES)]
+        self._generations = [0] * FILL_STRIPES
+        # location -> (size, last access), least recently used first
+        self._entries: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        self._size = 0
+        self._jobs: queue.SimpleQueue[Locations] = queue.SimpleQueue()
+        self._warmer: threading.Thread | None = None
+
+        os.makedirs(self.hot.file_path, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Rebuilds the LRU index from the cache directory"""
+        found = []
+        for entry in self.hot._iter_entries():
+            stat = entry.stat()
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            for mtime, name, size in sorted(found):
+                self._entries[name] = (size, mtime)
+                self._size += size
+        self._shrink()
+
+    @staticmethod
+    def _stripe(location: str) -> int:
+        return hash(location) % FILL_STRIPES
+
+    def _generation(self, location: str) -> int:
+        """Taken before reading location from the cold hook, see _cache"""
+        return self._generations[self._stripe(location)]
+
+    def _cache(self, location: str, image: Buffer, generation: int | None = None):
+        """Caches an image that was written, or read when generation is given
+
+        Args:
+            location: The location of the image
+            image: The image
+            generation: _generation(location) from before the image was read. When
+                location has been written since, the image may be stale and is
+                not cached.
+        """
+        stripe = self._stripe(location)
+        with self._fill_locks[stripe]:
+            if generation is None:
+                self._generations[stripe] += 1
+            elif generation != self._generations[stripe]:
+                return
+            if len(image) > self.max_bytes:
+                self._evict(location)  # Any cached copy is outdated
+                return
+            self.hot._write(location, image)
+            with self._lock:
+                old_size, _ = self._entries.pop(location, (0, 0))
+                self._entries[location] = (len(image), time.time())
+                self._size += len(image) - old_size
+        self._shrink()
+
+    def _invalidate(self, location: str):
+        """Evicts a location that was deleted, so reads in flight don't cache it"""
+        stripe = self._stripe(location)
+        with self._fill_locks[stripe]:
+            self._generations[stripe] += 1
+            self._evict(location)
+
+    def _shrink(self):
+        """Demotes least recently used images until the cache fits its budget"""
+        victims = []
+        with self._lock:
+            while self._size > self.max_bytes and self._entries:
+                location, (size, _) = self._entries.popitem(last=False)
+                self._size -= size
+                victims.append(location)
+        self._remove(victims)
+
+    def _remove(self, locations: Iterable[str]):
+        for location in locations:
+            try:
+                self.hot.delete(location)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, location: str):
+        with self._lock:
+            size, _ = self._entries.pop(location, (0, 0))
+            self._size -= size
+        self._remove([location])
+
+    def sweep(self):
+        """Demotes cached images that have not been read within max_age_days"""
+        cutoff = time.time() - self.max_age
+        victims = []
+        with self._lock:
+            # Entries are ordered by last access, so stop at the first fresh one
+            while self._entries:
+                location, (size, accessed) = next(iter(self._entries.items()))
+                if accessed >= cutoff:
+                    break
+                del self._entries[location]
+                self._size -= size
+                victims.append(location)
+        self._remove(victims)
+        if victims:
+            LOGGER.info("Tiered cache demoted %d aged images", len(victims))
+
+    def warm(self, locations: Locations):
+        """Pre-fetch images into the cache from a background thread
+
+        Args:
+            locations: Locations to fetch, or a callable returning them.
+                A callable is only evaluated on the background thread.
+        """
+        self._jobs.put(locations)
+        self._start_warmer()
+
+    def _start_warmer(self):
+        with self._lock:
+            if self._warmer is not None and self._warmer.is_alive():
+                return
+            self._warmer = threading.Thread(
+                target=self._run_warmer, name="tiered-cache-warmer", daemon=True
+            )
+            self._warmer.start()
+
+    def _run_warmer(self):
+        while True:
+            try:
+                job = self._jobs.get(timeout=self.config.sweep_interval)
+            except queue.Empty:
+                self.sweep()
+                continue
+            try:
+                locations = job() if callable(job) else job
+                missing = (loc for loc in locations if loc not in self._entries)
+                # In batches, which some cold hooks fetch concurrently
+                for batch in iter(lambda: list(islice(missing, WARM_BATCH)), []):
+                    generations = {loc: self._generation(loc) for loc in batch}
+                    for location, image in self.cold.fetch_many(batch).items():
+                        self._cache(location, image, generations[location])
+            except Exception:
+                LOGGER.exception("Tiered cache failed to warm images")
+
+    def after_fork(self):
+        self.hot.after_fork()
+        self.cold.after_fork()
+        # The parent's threads do not exist here and its lock may have been held
+        self._lock = threading.Lock()
+        self._fill_locks = [threading.Lock() for _ in range(FILL_STRIPES)]
+        if self._warmer is not None:
+            self._warmer = None
+            self._start_warmer()
+
+    def save(self, image: bytes, original_name: str) -> str:
+        key = self.cold.save(image, original_name)
+        self._cache(key, image)
+        return key
+
+    def replace(self, location: str, image: bytes):
+        self.cold.replace(location, image)
+        self._cache(location, image)
+
+    def modified(self, location: str) -> float | None:
+        return self.cold.modified(location)
+
+    def fetch(self, location: str) -> bytes:
+        return self._fetch(location, self.hot.fetch)
+
+    def fetch_buffer(self, location: str) -> Buffer:
+        return self._fetch(location, self.hot.fetch_buffer)
+
+    def _fetch(self, location: str, read_hot: Callable[[str], Buffer]) -> Buffer:
+        with self._lock:
+            entry = self._entries.get(location)
+            if entry is not None:
+                self._entries[location] = (entry[0], time.time())
+                self._entries.move_to_end(location)
+        if entry is not None:
+            try:
+                image = read_hot(location)
+                with self._lock:
+                    self.hits += 1
+                metrics.CACHE_REQUESTS.inc("tiered", "hit")
+                return image
+            except FileNotFoundError:  # Removed from disk behind our back
+                self._evict(location)
+
+        with self._lock:
+            self.misses += 1
+        metrics.CACHE_REQUESTS.inc("tiered", "miss")
+        generation = self._generation(location)
+        image = self.cold.fetch(location)
+        self._cache(location, image, generation)
+        return image
+
+    def fetch_many(self, locations: Iterable[str]) -> dict[str, bytes]:
+        images = {}
+        misses = []
+        for location in locations:
+            if location not in self._entries:
+                misses.append(location)
+                continue
+            try:
+                # Not self.fetch, which wrappers (metrics, resilience) count again
+                images[location] = self._fetch(location, self.hot.fetch)
+            except FileNotFoundError:
+                pass
+        if misses:
+            with self._lock:
+                self.misses += len(misses)
+            metrics.CACHE_REQUESTS.inc("tiered", "miss", amount=len(misses))
+            generations = {location: self._generation(location) for location in misses}
+            for location, image in self.cold.fetch_many(misses).items():
+                self._cache(location, image, generations[location])
+                images[location] = image
+        return images
+
+    def delete(self, location: str):
+        try:
+            self.cold.delete(location)
+        finally:
+            self._invalidate(location)
+
+    def iter_keys(self) -> Iterator[tuple[str, float]]:
+        return self.cold.iter_keys()
+
+    def delete_many(self, locations: Iterable[str]):
+        locations = list(locations)
+        try:
+            self.cold.delete_many(locations)
+        finally:
+            for location in locations:
+                self._invalidate(location)
+
+    # Uploads are staged by the cold hook, and only cached once read
+    @property
+    def upload_chunk_size(self) -> int:
+        return self.cold.upload_chunk_size
+
+    def begin_upload(self, original_name: str, size: int) -> str:
+        return self.cold.begin_upload(original_name, size)
+
+    def stage_chunk(self, upload_id: str, offset: int, chunk: bytes) -> int:
+        return self.cold.stage_chunk(upload_id, offset, chunk)
+
+    def upload_progress(self, upload_id: str) -> tuple[int, int]:
+        return self.cold.upload_progress(upload_id)
+
+    def finish_upload(self, upload_id: str) -> str:
+        return self.cold.finish_upload(upload_id)
+
+    def abort_upload(self, upload_id: str):
+        self.cold.abort_upload(upload_id)
+
+    def initialize_storage(self, clean: bool = False):
+        self.cold.initialize_storage(clean)
+        self.hot.initialize_storage(clean)
+        if clean:
+            self._load_index()
@@ -0,0 +1,228 @@
+"""Generates large synthetic datasets for load testing
+
+Receipts are bulk inserted with SQLAlchemy Core in batches, their ids assigned
+by the database and returned (INSERT ... RETURNING) for inserting tag links
+alongside them. Each receipt gets a tiny, unique placeholder PNG written through
+the file hook by a thread pool.
+"""
+
+import random
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+
+from app_logging import LOGGER
+from receipt import Change, Receipt, Tag, receipt_tag
+from storage_hooks.storage_hooks import DatabaseHook, FileHook
+
+UTC = timezone.utc
+
+# Ordered from most to least common, see _tag_weights
+TAG_NAMES = (
+    "Groceries",
+    "Dining",
+    "Gas",
+    "Household",
+    "Coffee",
+    "Pharmacy",
+    "Clothing",
+    "Utilities",
+    "Electronics",
+    "Entertainment",
+    "Travel",
+    "Office Supplies",
+    "Gifts",
+    "Pets",
+    "Home Improvement",
+    "Medical",
+    "Subscriptions",
+    "Books",
+    "Parking",
+    "Charity",
+)
+STORES = (
+    "Corner Market",
+    "FreshCo",
+    "Fuel Stop",
+    "Main St Diner",
+    "Bean There",
+    "HealthPlus",
+    "Outfitters",
+    "City Power",
+    "Gadget Hub",
+    "Cinema 8",
+    "SkyHigh Air",
+    "Paper & Co",
+    "Hardware Depot",
+    "Pet Pantry",
+)
+# Tags per receipt and how often each count occurs
+TAG_COUNT_WEIGHTS = {0: 15, 1: 45, 2: 25, 3: 10, 4: 5}
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    body = kind + data
+    return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+
+def placeholder_png(seed: int, size: int = 8) -> bytes:
+    """A small solid colour PNG, unique for each seed
+
+    Args:
+        seed: Chooses the colour and is stored in a text chunk
+        size: Width and height in pixels
+    """
+    color = bytes(((seed * 67) % 256, (seed * 151) % 256, (seed * 199) % 256))
+    # Each row starts with filter type 0 (none)
+    pixels = (b"\x00" + color * size) * size
+    return b"".join(
+        (
+            b"\x89PNG\r\n\x1a\n",
+            _chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)),
+            _chunk(b"tEXt", b"Comment\x00synthetic %d" % seed),
+            _chunk(b"IDAT", zlib.compress(pixels)),
+            _chunk(b"IEND", b""),
+        )
+    )
+
+
+def _tag_weights(count: int) -> list[float]:
+    # Roughly Zipf distributed, a few tags are used on most receipts
+    return [1 / rank for rank in range(1, count + 1)]
+
+
+def _ensure_tags(session: Session, names: tuple[str, ...]) -> list[int]:
+    """Returns the ids of tags with the given names, creating missing ones"""
+    existing = dict(
+        session.execute(select(Tag.name, Tag.id).where(Tag.name.in_(names))).all()
+    )
+    missing = [name for name in names if name not in existing]
+    if missing:
+        session.execute(insert(Tag), [{"name": name} for name in missing])
+        created = dict(
+            session.execute(select(Tag.name, Tag.id).where(Tag.name.in_(missing))).all()
+        )
+        session.execute(
+            insert(Change),
+            [{"kind": "tag", "record_id": id_} for id_ in created.values()],
+        )
+        existing.update(created)
+    return [existing[name] for name in names]
+
+
+def generate(
+    meta_hook: DatabaseHook,
+    file_hook: FileHook,
+    count: int,
+    *,
+    years: float = 3,
+    images: Optional[int] = None,
+    batch_size: int = 10_000,
+    workers: int = 16,
+    seed: int = 0,
+    progress: Optional[Callable[[int], None]] = None,
+) -> list[int]:
+    """Adds count synthetic receipts to the hooks' storage
+
+    Args:
+        meta_hook: Where receipts are inserted
+        file_hook: Where placeholder images are saved
+        count: Number of receipts to add
+        years: Upload times are spread over this many years before now
+        images: Number of distinct images, shared round robin between the
+            receipts. Defaults to one image per receipt
+        batch_size: Receipts inserted per transaction
+        workers: Threads saving images in parallel
+        seed: Seed for the random choices, the same seed gives the same data
+        progress: Called with the number of receipts added after each batch
+
+    Returns:
+        The ids of the new receipts, in upload order
+    """
+    rng = random.Random(seed)
+    image_count = count if images is None else max(1, min(images, count))
+    now = datetime.now(UTC)
+    span = timedelta(days=365.25 * years).total_seconds()
+    # Ascending upload times so that ids and upload order agree
+    offsets = sorted(rng.uniform(0, span) for _ in range(count))
+    tag_counts = rng.choices(
+        list(TAG_COUNT_WEIGHTS), weights=list(TAG_COUNT_WEIGHTS.values()), k=count
+    )
+
+    with Session(meta_hook.engine) as session:
+        tag_ids = _ensure_tags(session, TAG_NAMES)
+        start = (session.scalar(select(func.max(Receipt.id))) or 0) + 1
+        session.commit()
+    weights = _tag_weights(len(tag_ids))
+    # Numbers the images, and the receipts too where ids must be explicit
+    numbers = range(start, start + count)
+    # Explicit ids would not advance e.g. PostgreSQL's sequences, so later
+    # inserts would reuse them. Without RETURNING for many rows (MySQL), ids
+    # are explicit, which auto increment columns do move past.
+    dialect = meta_hook.engine.dialect
+    returning = dialect.insert_executemany_returning_sort_by_parameter_order
+    ids: list[int] = []
+
+    keys: list[str] = []
+    with ThreadPoolExecutor(workers) as executor:
+        for batch_start in range(0, count, batch_size):
+            batch = range(batch_start, min(batch_start + batch_size, count))
+            new_images = [i for i in batch if i < image_count]
+            keys.extend(
+                executor.map(
+                    lambda i: file_hook.save(
+                        placeholder_png(numbers[i]), f"receipt_{numbers[i]}.png"
+                    ),
+                    new_images,
+                )
+            )
+
+            receipts = []
+            chosen_tags = []
+            for i in batch:
+                receipts.append(
+                    {
+                        "name": f"{rng.choice(STORES)} #{rng.randint(1000, 9999)}",
+                        "storage_key": keys[i % image_count],
+                        "upload_dt": now - timedelta(seconds=span - offsets[i]),
+                    }
+                )
+                if not returning:
+                    receipts[-1]["id"] = numbers[i]
+                # Weighted sampling without replacement
+                chosen: set[int] = set()
+                while len(chosen) < tag_counts[i]:
+                    chosen.add(rng.choices(tag_ids, weights=weights)[0])
+                chosen_tags.append(chosen)
+
+            with Session(meta_hook.engine) as session:
+                if returning:
+                    stmt = insert(Receipt).returning(
+                        Receipt.id, sort_by_parameter_order=True
+                    )
+                    batch_ids = list(session.scalars(stmt, receipts))
+                else:
+                    session.execute(insert(Receipt), receipts)
+                    batch_ids = [receipt["id"] for receipt in receipts]
+                session.execute(
+                    insert(Change),
+                    [{"kind": "receipt", "record_id": id_} for id_ in batch_ids],
+                )
+                links = [
+                    {"tag_id": tag_id, "receipt_key": receipt_id}
+                    for receipt_id, chosen in zip(batch_ids, chosen_tags)
+                    for tag_id in chosen
+                ]
+                if links:
+                    session.execute(insert(receipt_tag), links)
+                session.commit()
+            ids.extend(batch_ids)
+            LOGGER.debug("Generated receipts %d-%d", batch_ids[0], batch_ids[-1])
+            if progress is not None:
+                progress(batch[-1] + 1)
+    return ids
@@ -7,6 +7,7 @@ from storage_hooks.AWS import AWSS3Hook
 from storage_hooks.SQLite3 import SQLite3
 from storage_hooks.file_system import FileSystemHook
 from storage_hooks.storage_hooks import DatabaseHook
+from storage_hooks.tiered import TieredHook
 
 
 class MemorySQLite3(DatabaseHook):
@@ -37,3 +38,13 @@ def aws_s3() -> AWSS3Hook:
     hook = AWSS3Hook()
     hook.bucket_name = "cs425-3-test-bucket2"
     return hook
+
+
+def tiered() -> TieredHook:
+    """Use two filesystem locations at a runtime dir as the hot and cold tiers."""
+    runtime_dir = DIRS.user_runtime_dir
+    hot = FileSystemHook(os.path.join(runtime_dir, "hot"))
+    cold = FileSystemHook(os.path.join(runtime_dir, "cold"))
+    hook = TieredHook(hot, cold)
+    hook.initialize_storage()
+    return hook
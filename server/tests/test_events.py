@@ -0,0 +1,159 @@
+import json
+import threading
+
+import pytest
+from flask import Flask
+from sqlalchemy import delete, insert, select
+
+from configure import CONFIG
+from events import ChangeBroker, LocalBroker
+from receipt import Change, Tag
+from tests.temp_hooks import MemorySQLite3, file_system, sqlite3
+
+
+class TestLocalBroker:
+    def test_publish(self):
+        broker = LocalBroker(replay_size=10)
+        subscription = broker.subscribe()
+        broker.publish("tag", {"action": "created", "id": 1})
+        [event] = subscription.get(timeout=0)
+        assert (event.kind, event.data) == ("tag", {"action": "created", "id": 1})
+        assert subscription.get(timeout=0) == []
+
+    def test_waits_for_events(self):
+        broker = LocalBroker(replay_size=10)
+        subscription = broker.subscribe()
+        threading.Timer(0.05, broker.publish, ("tag", {})).start()
+        assert len(subscription.get(timeout=5)) == 1
+
+    def test_replay(self):
+        broker = LocalBroker(replay_size=10)
+        broker.publish("tag", {"id": 1})
+        last_seen = broker.subscribe()
+        broker.publish("tag", {"id": 2})
+        broker.publish("tag", {"id": 3})
+        [first, *_] = last_seen.get(timeout=0)
+
+        replayed = broker.subscribe(first.id).get(timeout=0)
+        assert [e.data["id"] for e in replayed] == [3]
+
+    @pytest.mark.parametrize("last_id", ["elsewhere-1", "garbage", None])
+    def test_reset(self, last_id):
+        broker = LocalBroker(replay_size=2)
+        old = broker.subscribe()
+        for i in range(3):
+            broker.publish("tag", {"id": i})
+        if last_id is None:  # Missed more events than are kept
+            last_id = f"{broker.epoch}-0"
+        assert [e.kind for e in broker.subscribe(last_id).get(timeout=0)] == ["reset"]
+        assert [e.kind for e in old.get(timeout=0)] == ["reset"]
+
+
+def test_changes_published_after_commit():
+    hook = MemorySQLite3()
+    hook.initialize_storage()
+    changes = []
+    hook.change_listeners.append(lambda *change: changes.append(change))
+
+    with pytest.raises(RuntimeError):
+        with hook.unit_of_work():
+            hook.create_tag(Tag(name="rolled back"))
+            raise RuntimeError
+    assert changes == []
+
+    with hook.unit_of_work():
+        tag = hook.create_tag(Tag(name="kept"))
+        assert changes == []
+    hook.update_tag(tag)
+    hook.delete_tag(tag.id)
+    assert changes == [
+        ("tag", "created", tag.id),
+        ("tag", "updated", tag.id),
+        ("tag", "deleted", tag.id),
+    ]
+
+
+def test_event_stream(mocker):
+    from app import create_app
+
+    mocker.patch.object(CONFIG.Events, "stream_seconds", 0.2)
+    mocker.patch.object(CONFIG.Events, "heartbeat_seconds", 0.05)
+    meta_hook = MemorySQLite3()
+    meta_hook.initialize_storage()
+    app: Flask = create_app(file_system(), meta_hook)
+    client = app.test_client()
+
+    stream = client.get("/api/events", buffered=False)
+    assert stream.mimetype == "text/event-stream"
+    tag_id = int(client.post("/api/tag/", data={"name": "pushed"}).data)
+    body = b"".join(stream.response).decode()
+    stream.close()
+
+    [message] = [m for m in body.split("\n\n") if m.startswith("id:")]
+    fields = dict(line.split(": ", 1) for line in message.splitlines())
+    assert fields["event"] == "tag"
+    assert json.loads(fields["data"]) == {"action": "created", "id": tag_id}
+    assert ": keepalive" in body
+
+
+def test_stream_limit(mocker):
+    from app import create_app
+
+    mocker.patch.object(CONFIG.Events, "max_streams", 1)
+    app = create_app(file_system(), MemorySQLite3())
+    client = app.test_client()
+
+    first = client.get("/api/events", buffered=False)
+    assert client.get("/api/events").status_code == 503
+    first.close()
+    second = client.get("/api/events", buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+
+class TestChangeBroker:
+    @pytest.fixture
+    def hook(self):
+        # Shared between threads, unlike an in memory database
+        hook = sqlite3()
+        hook.initialize_storage()
+        return hook
+
+    def test_every_worker(self, hook):
+        workers = [ChangeBroker(hook, poll_seconds=0.01) for _ in range(2)]
+        subscriptions = [broker.subscribe() for broker in workers]
+        tag = hook.create_tag(Tag(name="shared"))
+        for subscription in subscriptions:
+            [event] = subscription.get(timeout=5)
+            assert (event.kind, event.data) == (
+                "tag",
+                {"action": "created", "id": tag.id},
+            )
+        hook.delete_tag(tag.id)
+        [deleted] = subscriptions[0].get(timeout=5)
+        assert deleted.data == {"action": "deleted", "id": tag.id}
+
+        # Ids are change sequence numbers, so known to the other worker
+        resumed = workers[1].subscribe(event.id).get(timeout=5)
+        assert resumed == [deleted]
+        assert workers[1].subscribe("1234").get(timeout=0)[0].kind == "reset"
+
+    def test_late_commit(self, hook):
+        broker = ChangeBroker(hook, poll_seconds=60, settle_seconds=60)
+        subscription = broker.subscribe()
+        first = hook.create_tag(Tag(name="first"))
+        second = hook.create_tag(Tag(name="second"))
+        with hook.engine.begin() as conn:
+            # As if the first commit was slower than the second
+            late = conn.execute(select(Change).where(Change.record_id == first.id))
+            late = late.mappings().one()
+            conn.execute(delete(Change).where(Change.record_id == first.id))
+        broker.poll()
+        assert [e.data["id"] for e in subscription.get(timeout=0)] == [second.id]
+
+        with hook.engine.begin() as conn:
+            conn.execute(insert(Change), [dict(late)])
+        broker.poll()
+        broker.poll()  # Unsettled changes are not published twice
+        events = subscription.get(timeout=0)
+        assert [(e.id, e.data["id"]) for e in events] == [(str(late.seq), first.id)]
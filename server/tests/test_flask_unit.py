@@ -1,4 +1,7 @@
+import datetime
+import gzip
 import io
+import json
 from typing import Any, cast
 
 import pytest
@@ -6,7 +9,9 @@ from flask import Flask
 from flask.testing import FlaskClient
 from pytest_mock import MockerFixture
 
+from configure import CONFIG
 from receipt import Receipt, Tag
+from storage_hooks.storage_hooks import InvalidUploadError
 from tests.temp_hooks import MemorySQLite3, file_system
 
 
@@ -102,7 +107,7 @@ def test_view_receipt(test_client: FlaskClient, mocker):
         return_value=test_receipt,
     )
     fetch_mock = mocker.patch(
-        "storage_hooks.file_system.FileSystemHook.fetch",
+        "storage_hooks.file_system.FileSystemHook.fetch_buffer",
         return_value=test_image,
     )
 
@@ -116,6 +121,24 @@ def test_view_receipt(test_client: FlaskClient, mocker):
     fetch_mock.assert_called_once_with("~/test/test.jpg")
 
 
+def test_view_large_receipt(app: Flask, test_client: FlaskClient, mocker):
+    file_hook = app.extensions["receipt_database"]["file_hook"]
+    image = bytes(range(256)) * 1024  # Large enough to be memory mapped
+    assert file_hook.mmap_min_bytes <= len(image)
+    key = file_hook.save(image, "large.png")
+    mocker.patch(
+        "storage_hooks.storage_hooks.DatabaseHook.fetch_receipt",
+        return_value=Receipt(id=1, name="Large", storage_key=key, upload_dt="Now"),
+    )
+
+    response = test_client.get("/api/receipt/1/image")
+
+    assert response.status_code == 200
+    assert response.content_length == len(image)
+    assert response.data == image
+    file_hook.delete(key)
+
+
 def test_view_receipt_no_receipt(test_client: FlaskClient, mocker):
     mocker.patch(
         "storage_hooks.storage_hooks.DatabaseHook.fetch_receipt", return_value=None
@@ -235,7 +258,7 @@ def test_fetch_many_keys(test_client: FlaskClient, mocker):
     ]
 
     fetch_receipts_mock = mocker.patch(
-        "storage_hooks.storage_hooks.DatabaseHook.fetch_receipts",
+        "storage_hooks.storage_hooks.DatabaseHook.fetch_receipt_rows",
         return_value=test_receipts,
     )
 
@@ -246,6 +269,196 @@ def test_fetch_many_keys(test_client: FlaskClient, mocker):
     fetch_receipts_mock.assert_called_once()
 
 
+def test_fetch_many_keys_compressed(test_client: FlaskClient, mocker):
+    test_receipts = [
+        Receipt(id=i, name=f"Test{i}", storage_key=f"{i}.png", tags=[])
+        for i in range(100)
+    ]
+    mocker.patch(
+        "storage_hooks.storage_hooks.DatabaseHook.fetch_receipt_rows",
+        return_value=test_receipts,
+    )
+
+    response = test_client.get("/api/receipt/", headers={"Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    body = json.loads(gzip.decompress(response.data))
+    assert body == sorted((r.export() for r in test_receipts), key=lambda r: r["name"])
+
+
+def test_small_response_not_compressed(test_client: FlaskClient, mocker):
+    mocker.patch("storage_hooks.storage_hooks.DatabaseHook.fetch_tags", return_value=[])
+
+    response = test_client.get("/api/tag/", headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.json == []
+
+
+def test_list_response_cached(test_client: FlaskClient, mocker):
+    tags = [Tag(id=i, name=f"Tag{i}") for i in range(100)]
+    fetch_tags_mock = mocker.patch(
+        "storage_hooks.storage_hooks.DatabaseHook.fetch_tags", return_value=tags
+    )
+
+    first = test_client.get("/api/tag/", headers={"Accept-Encoding": "gzip"})
+    second = test_client.get("/api/tag/", headers={"Accept-Encoding": "gzip"})
+    plain = test_client.get("/api/tag/")
+    unchanged = test_client.get(
+        "/api/tag/",
+        headers={"Accept-Encoding": "gzip", "If-None-Match": first.headers["ETag"]},
+    )
+
+    fetch_tags_mock.assert_called_once()
+    assert second.data == first.data
+    assert second.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(second.data)) == plain.json
+    assert plain.headers["ETag"] != first.headers["ETag"]
+    assert unchanged.status_code == 304
+    assert unchanged.data == b""
+
+
+def test_list_cache_invalidated_by_writes(app: Flask, test_client: FlaskClient):
+    app.extensions["receipt_database"]["meta_hook"].initialize_storage()
+
+    assert test_client.get("/api/tag/").json == []
+    test_client.post("/api/tag/", data={"name": "new"})
+    assert [t["name"] for t in test_client.get("/api/tag/").json] == ["new"]
+
+
+def test_sync(app: Flask, test_client: FlaskClient, mocker):
+    mocker.patch.object(CONFIG.Sync, "settle_seconds", 0)
+    app.extensions["receipt_database"]["meta_hook"].initialize_storage()
+    tag_id = int(test_client.post("/api/tag/", data={"name": "new"}).data)
+
+    first = test_client.get("/api/sync").json
+    assert first["tags"] == [{"id": tag_id, "name": "new"}]
+    test_client.delete(f"/api/tag/{tag_id}")
+    second = test_client.get("/api/sync", query_string={"since": first["token"]}).json
+    assert second["tags"] == []
+    assert second["deleted"] == {"receipts": [], "tags": [tag_id]}
+    assert second["token"] > first["token"]
+
+
+def test_sync_invalid_token(test_client: FlaskClient):
+    response = test_client.get("/api/sync?since=yesterday")
+    assert response.status_code == 400
+
+
+def test_resumable_upload(app: Flask, test_client: FlaskClient, mocker):
+    mocker.patch.object(CONFIG.Uploads, "chunk_bytes", 4)
+    app.extensions["receipt_database"]["meta_hook"].initialize_storage()
+    tag_id = int(test_client.post("/api/tag/", data={"name": "scan"}).data)
+
+    begun = test_client.post("/api/upload/", data={"filename": "a.png", "size": 10})
+    assert begun.status_code == 201
+    assert begun.json["chunk_size"] == 4
+    location = begun.headers["Location"]
+
+    first = test_client.patch(location, data=b"0123", headers={"Upload-Offset": "0"})
+    assert (first.status_code, first.headers["Upload-Offset"]) == (204, "4")
+    gap = test_client.patch(location, data=b"89", headers={"Upload-Offset": "8"})
+    assert (gap.status_code, gap.headers["Upload-Offset"]) == (409, "4")
+    status = test_client.get(location)
+    assert status.json == {"offset": 4, "size": 10}
+    assert test_client.post(f"{location}/complete").status_code == 409
+
+    test_client.patch(location, data=b"4567", headers={"Upload-Offset": "4"})
+    test_client.patch(location, data=b"89", headers={"Upload-Offset": "8"})
+    meta_hook = app.extensions["receipt_database"]["meta_hook"]
+    failing = mocker.patch.object(meta_hook, "create_receipt", side_effect=OSError)
+    with pytest.raises(OSError):
+        test_client.post(f"{location}/complete")
+    mocker.stop(failing)
+
+    form = {"name": "Resumed", "tag": tag_id}
+    # The upload is forgotten once the response is closed
+    with test_client.post(f"{location}/complete", data=form) as response:
+        receipt = response.json
+    assert (receipt["name"], receipt["tags"]) == ("Resumed", [tag_id])
+    image = test_client.get(f"/api/receipt/{receipt['id']}/image")
+    assert image.data == b"0123456789"
+    # e.g. the response was lost
+    assert test_client.post(f"{location}/complete", data=form).json == receipt
+    assert test_client.get(location).status_code == 404
+
+
+def test_resumable_upload_limits(test_client: FlaskClient, mocker):
+    mocker.patch.object(CONFIG.Uploads, "max_bytes", 10)
+    too_large = test_client.post("/api/upload/", data={"filename": "a", "size": 11})
+    assert too_large.status_code == 413
+    assert test_client.post("/api/upload/", data={"size": 5}).status_code == 400
+
+    location = test_client.post(
+        "/api/upload/", data={"filename": "a.png", "size": 5}
+    ).headers["Location"]
+    no_offset = test_client.patch(location, data=b"01234")
+    assert no_offset.status_code == 400
+
+    mocker.patch.object(CONFIG.Uploads, "chunk_bytes", 4)
+
+    def send_chunked(body: bytes) -> int:
+        # As servers pass on a chunked body, without a Content-Length
+        return test_client.patch(
+            location,
+            input_stream=io.BytesIO(body),
+            headers={"Upload-Offset": "0", "Transfer-Encoding": "chunked"},
+            environ_overrides={"wsgi.input_terminated": True},
+        ).status_code
+
+    assert send_chunked(b"01234") == 413
+    assert send_chunked(b"0123") == 204
+    assert test_client.delete(location).status_code == 204
+    assert test_client.delete(location).status_code == 404
+
+
+def test_tampered_upload(app: Flask, test_client: FlaskClient, mocker):
+    file_hook = app.extensions["receipt_database"]["file_hook"]
+    error = InvalidUploadError("tampered")
+    mocker.patch.object(file_hook, "upload_progress", side_effect=error)
+    mocker.patch.object(file_hook, "stage_chunk", side_effect=error)
+    response = test_client.get("/api/upload/tampered")
+    assert (response.status_code, response.json["error_name"]) == (
+        400,
+        "Invalid Upload",
+    )
+    chunk = test_client.patch(
+        "/api/upload/tampered", data=b"0", headers={"Upload-Offset": "0"}
+    )
+    assert chunk.status_code == 400
+
+
+def test_fast_json_provider(app: Flask):
+    pytest.importorskip("orjson")
+    from flask.json.provider import DefaultJSONProvider
+
+    from compression import FastJSONProvider
+
+    receipt = Receipt(id=1, name="Test", storage_key="key", tags=[Tag(id=2)])
+    receipt.upload_dt = datetime.datetime.now(datetime.UTC)
+    data = {"receipt": receipt.export(), "when": receipt.upload_dt}
+
+    with app.app_context():
+        fast = FastJSONProvider(app).response(data).get_data()
+        default = DefaultJSONProvider(app).response(data).get_data()
+    assert json.loads(fast) == json.loads(default)
+
+
+def test_metrics(test_client: FlaskClient, mocker):
+    mocker.patch("storage_hooks.storage_hooks.DatabaseHook.fetch_tags", return_value=[])
+    test_client.get("/api/tag/")
+
+    response = test_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    body = response.get_data(as_text=True)
+    assert 'http_requests_total{route="/api/tag/",method="GET",status="200"}' in body
+    assert 'http_request_duration_seconds_count{route="/api/tag/",method="GET"}' in body
+
+
 def test_delete_receipt(test_client: FlaskClient, mocker):
     mocker.patch(
         "storage_hooks.storage_hooks.DatabaseHook.fetch_receipt",
@@ -342,3 +555,17 @@ def test_delete_tag(test_client: FlaskClient, mocker):
 
     assert response.status_code == 204
     delete_tag_mock.assert_called_once_with(1)
+
+
+def test_periodic_reconcile_started_by_request(mocker: MockerFixture, tmp_path):
+    from app import create_app
+
+    mocker.patch.object(CONFIG.Reconcile, "interval_seconds", 3600)
+    mocker.patch.object(CONFIG.Reconcile, "lock_path", str(tmp_path / "lock"))
+    app = create_app(file_system(), MemorySQLite3())
+    periodic = app.extensions["receipt_database"]["periodic_reconcile"]
+    # Not by a preloading master, which forks the workers
+    assert periodic._thread is None
+
+    app.test_client().get("/api/tag/")
+    assert periodic._thread.is_alive()
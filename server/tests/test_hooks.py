@@ -1,14 +1,36 @@
+import asyncio
+import base64
+import dataclasses
+import hashlib
+import json
+import mmap
+import os
+import subprocess
+import sys
+import time
 import warnings
 
 import pytest
+from sqlalchemy import create_engine, create_mock_engine, event, inspect, text
+from sqlalchemy.orm import Session
 
-from receipt import Receipt, Tag
+import metrics
+from configure import CONFIG, ManualRemoteSQLConfig
+from receipt import Base, Receipt, Tag
 from storage_hooks.AWS import AWSS3Hook
-from storage_hooks.RemoteSQL import RemoteSQL, RemoteSQLConfig
+from storage_hooks.RemoteSQL import RemoteSQL, RemoteSQLConfig, ReplicaRouter
 from storage_hooks.SQLite3 import SQLite3
-from storage_hooks.file_system import FileSystemHook
-from storage_hooks.storage_hooks import DatabaseHook, FileHook
-from temp_hooks import aws_s3, file_system, sqlite3
+from storage_hooks.file_system import LAYOUT_FILE, FileSystemHook
+from storage_hooks.hook_config_factory import get_file_hook, get_meta_hook
+from storage_hooks.storage_hooks import (
+    DatabaseHook,
+    FileHook,
+    InvalidUploadError,
+    UploadOffsetError,
+    read_primary,
+)
+from storage_hooks.tiered import TieredHook
+from temp_hooks import aws_s3, file_system, sqlite3, tiered
 
 
 class TestDatabaseHook:
@@ -76,6 +98,31 @@ class TestDatabaseHook:
 
     # fetch_receipts
 
+    def test_fetch_receipt_rows(self, hook, tag_ids, receipt, tag_less_receipt):
+        def exported(receipts) -> list[dict]:
+            return [r.export() for r in receipts]
+
+        assert exported(hook.fetch_receipt_rows()) == exported(hook.fetch_receipts())
+        for match_all_tags in (False, True):
+            assert exported(
+                hook.fetch_receipt_rows(tags=tag_ids, match_all_tags=match_all_tags)
+            ) == exported(
+                hook.fetch_receipts(tags=tag_ids, match_all_tags=match_all_tags)
+            )
+        assert exported(hook.fetch_receipt_rows(limit=1)) == exported(
+            hook.fetch_receipts(limit=1)
+        )
+
+    def test_receipt_rows_grouping(self, hook, monkeypatch):
+        from sqlalchemy.dialects import mssql
+
+        # SQL Server rejects selected columns missing from GROUP BY
+        monkeypatch.setattr(hook, "engine", create_mock_engine("mssql://", None))
+        sql = str(hook._select_receipt_rows().compile(dialect=mssql.dialect()))
+        group_by = sql.split("GROUP BY")[1]
+        for column in ("id", "name", "storage_key", "upload_dt"):
+            assert f"receipt.{column}" in group_by
+
     def test_update_receipt(self, hook, tag_less_receipt, tags):
         receipt = tag_less_receipt
         tag_ids = [tag.id for tag in tags]
@@ -102,6 +149,70 @@ class TestDatabaseHook:
         hook.delete_receipt(receipt.id)
         assert hook.fetch_receipt(receipt.id) is None
 
+    def test_count_references(self, hook, receipt):
+        assert hook.count_references(receipt.storage_key) == 1
+        shared = hook.create_receipt(Receipt(storage_key=receipt.storage_key))
+        assert hook.count_references(receipt.storage_key) == 2
+        hook.delete_receipt(shared.id)
+        assert hook.count_references(receipt.storage_key) == 1
+        assert hook.count_references("nowhere") == 0
+
+    def test_update_storage(self, hook):
+        with hook.engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_receipt_storage_key"))
+
+        assert hook.update_storage()
+        indexes = inspect(hook.engine).get_indexes("receipt")
+        assert "ix_receipt_storage_key" in {i["name"] for i in indexes}
+
+    def test_update_storage_records_changes(self, hook, receipt):
+        with hook.engine.begin() as conn:
+            conn.execute(text("DROP TABLE change"))
+
+        assert hook.update_storage()
+        changes = hook.fetch_changes(settle_seconds=0)
+        assert [r.id for r in changes.receipts] == [receipt.id]
+        assert sorted(t.id for t in changes.tags) == [t.id for t in receipt.tags]
+
+    def test_fetch_changes(self, hook):
+        tag_id = hook.create_tag(Tag(name="synced")).id
+        tag = hook.fetch_tag(tag_id)
+        kept = hook.create_receipt(Receipt(storage_key="kept", tags=[tag]))
+        gone = hook.create_receipt(Receipt(storage_key="gone", tags=[]))
+        first = hook.fetch_changes(settle_seconds=0)
+        assert [r.id for r in first.receipts] == [kept.id, gone.id]
+        assert first.receipts[0].tags == [tag_id]
+
+        hook.delete_receipt(gone.id)
+        hook.delete_tag(tag_id)  # Also changes the receipts using it
+        second = hook.fetch_changes(first.token, settle_seconds=0)
+        assert [(r.id, r.tags) for r in second.receipts] == [(kept.id, [])]
+        assert second.deleted_receipts == [gone.id]
+        assert second.deleted_tags == [tag_id]
+        assert second.tags == []
+        assert hook.fetch_changes(second.token, settle_seconds=0).export() == {
+            "token": second.token,
+            "receipts": [],
+            "tags": [],
+            "deleted": {"receipts": [], "tags": []},
+            "more": False,
+        }
+
+    def test_fetch_changes_pages(self, hook):
+        receipts = [hook.create_receipt(Receipt(storage_key=str(i))) for i in range(3)]
+        page = hook.fetch_changes(limit=2, settle_seconds=0)
+        assert page.more
+        rest = hook.fetch_changes(page.token, limit=2, settle_seconds=0)
+        assert not rest.more
+        assert [r.id for r in page.receipts + rest.receipts] == [r.id for r in receipts]
+
+    def test_unsettled_changes_are_repeated(self, hook):
+        receipt = hook.create_receipt(Receipt(storage_key="new"))
+        changes = hook.fetch_changes(settle_seconds=60)
+        assert [r.id for r in changes.receipts] == [receipt.id]
+        # A change numbered lower may not have been committed yet
+        assert changes.token == 0
+
     def test_fetch_tag(self, hook, tag):
         assert hook.fetch_tag(tag.id) == tag
 
@@ -139,6 +250,52 @@ class TestDatabaseHook:
         )
 
 
+class TestUnitOfWork:
+    @pytest.fixture
+    def hook(self) -> DatabaseHook:
+        hook = sqlite3()
+        hook.initialize_storage()
+        return hook
+
+    def test_shared_session(self, hook):
+        checkouts = []
+        event.listen(hook.engine, "checkout", lambda *_: checkouts.append(None))
+        with hook.unit_of_work():
+            tag = hook.create_tag(Tag(name="shared"))
+            receipt = hook.create_receipt(Receipt(storage_key="key", tags=[tag]))
+            assert hook.fetch_receipt(receipt.id) is receipt  # From the identity map
+            assert [t.id for t in hook.fetch_receipts()[0].tags] == [tag.id]
+        assert len(checkouts) == 1
+        assert hook.fetch_receipt(receipt.id).tags[0].name == "shared"
+
+    def test_rollback(self, hook):
+        with pytest.raises(RuntimeError):
+            with hook.unit_of_work():
+                hook.create_tag(Tag(name="rolled back"))
+                raise RuntimeError
+        assert hook.fetch_tags() == []
+
+    def test_commit(self, hook):
+        unit = hook.begin()
+        tag = hook.create_tag(Tag(name="committed"))
+        hook.commit()
+        tag.name = "rolled back"
+        hook.update_tag(tag)
+        tag_id = tag.id
+        unit.finish(commit=False)
+        assert hook.fetch_tag(tag_id).name == "committed"
+
+    def test_generations(self, hook):
+        before = hook.generations.get("receipt", "tag")
+        with hook.unit_of_work():
+            tag = hook.create_tag(Tag(name="counted"))
+            # Not committed yet, so caches must not see a new generation
+            assert hook.generations.get("receipt", "tag") == before
+        assert hook.generations.get("receipt", "tag") == (before[0], before[1] + 1)
+        hook.delete_tag(tag.id)  # Also removes it from receipts
+        assert hook.generations.get("receipt", "tag") == (before[0] + 1, before[1] + 2)
+
+
 class TestFileHook:
     """Base class for hooks that store image files."""
 
@@ -150,7 +307,7 @@ class TestFileHook:
     def file_system_hook(self) -> FileSystemHook:
         return FileSystemHook()
 
-    @pytest.fixture(params=[file_system, aws_s3])
+    @pytest.fixture(params=[file_system, aws_s3, tiered])
     def hook(self, request) -> FileHook:
         return request.param()
 
@@ -193,3 +350,511 @@ class TestFileHook:
             hook.replace(save_key, test_bytes)
         with pytest.raises(FileNotFoundError):
             hook.delete(save_key)
+
+    def test_iter_keys(self, hook: FileHook, save_file):
+        save_key, _ = save_file
+        keys = dict(hook.iter_keys())
+        assert save_key in keys
+        assert keys[save_key] <= time.time()
+
+    def test_iter_keys_required(self):
+        # Checked when a hook is created, rather than when reconciling
+        assert "iter_keys" in FileHook.__abstractmethods__
+
+    def test_delete_many(self, hook: FileHook, save_file):
+        save_key, _ = save_file
+        hook.delete_many([save_key, "missing.png"])
+        with pytest.raises(FileNotFoundError):
+            hook.fetch(save_key)
+
+
+class TestFileSystemHook:
+    def test_sharded_layout(self, tmp_path):
+        hook = FileSystemHook(str(tmp_path), layout="sharded")
+        hook.initialize_storage()
+        key = hook.save(b"image", "test.png")
+
+        assert not (tmp_path / key).exists()
+        assert os.path.exists(hook._path(key))
+        assert [e.name for e in hook._iter_entries()] == [key]
+        assert hook.fetch(key) == b"image"
+
+    def test_migrate_flat_store(self, tmp_path):
+        flat = FileSystemHook(str(tmp_path), layout="flat")
+        flat.initialize_storage()
+        keys = [flat.save(b"image", f"{i}.png") for i in range(5)]
+        keys.append(flat.save(b"image", "IMG_0001.jpg"))
+        foreign = ["receipts.sqlite3", "custom.db", "custom.db-wal", "notes.txt"]
+        for name in foreign:
+            (tmp_path / name).write_bytes(b"")
+
+        sharded = FileSystemHook(str(tmp_path), layout="sharded")
+
+        for name in foreign:
+            assert (tmp_path / name).exists()
+        assert (tmp_path / LAYOUT_FILE).read_text() == "2"
+        assert sorted(e.name for e in sharded._iter_entries()) == sorted(keys)
+        for key in keys:
+            assert not (tmp_path / key).exists()
+            assert sharded.fetch(key) == b"image"
+
+    def test_content_addressed(self, tmp_path):
+        hook = FileSystemHook(str(tmp_path))
+        hook.content_addressed = True
+        hook.initialize_storage()
+
+        key = hook.save(b"image", "IMG_0001.jpg")
+        assert key == hook.save(b"image", "other.jpg")
+        assert key == hook.save(b"image", "other.JPEG")
+        assert key != hook.save(b"other image", "IMG_0001.jpg")
+        assert key.endswith(".jpg")
+        assert len(list(hook._iter_entries())) == 2
+
+    def test_fetch_buffer(self, tmp_path):
+        hook = FileSystemHook(str(tmp_path))
+        hook.mmap_min_bytes = 1024
+        hook.initialize_storage()
+        small = hook.save(b"small", "small.png")
+        large = hook.save(b"x" * 4096, "large.png")
+
+        assert hook.fetch_buffer(small) == b"small"
+        image = hook.fetch_buffer(large)
+        assert isinstance(image, mmap.mmap)
+        assert hashlib.sha256(image).digest() == hashlib.sha256(b"x" * 4096).digest()
+
+        # Replacing or deleting the file leaves the mapped image intact
+        hook.replace(large, b"y")
+        hook.delete(large)
+        assert memoryview(image)[:3] == b"xxx"
+        image.close()
+        assert [entry.name for entry in hook._iter_entries()] == [small]
+
+    def test_staged_upload(self, tmp_path, mocker):
+        mocker.patch.object(CONFIG.Uploads, "chunk_bytes", 4)
+        hook = FileSystemHook(str(tmp_path))
+        hook.content_addressed = True
+        hook.initialize_storage()
+        upload_id = hook.begin_upload("IMG_0001.jpg", 10)
+
+        assert hook.stage_chunk(upload_id, 0, b"0123") == 4
+        assert hook.stage_chunk(upload_id, 0, b"0123") == 4  # Sent again
+        with pytest.raises(UploadOffsetError) as error:
+            hook.stage_chunk(upload_id, 8, b"89")
+        assert error.value.offset == 4
+        with pytest.raises(ValueError):
+            hook.stage_chunk(upload_id, 4, b"45")  # Not the last chunk
+        assert hook.upload_progress(upload_id) == (4, 10)
+        with pytest.raises(UploadOffsetError):
+            hook.finish_upload(upload_id)
+
+        hook.stage_chunk(upload_id, 4, b"4567")
+        hook.stage_chunk(upload_id, 8, b"89")
+        key = hook.finish_upload(upload_id)
+        assert key == hook.save(b"0123456789", "other.jpg")
+        assert hook.fetch(key) == b"0123456789"
+        with pytest.raises(FileNotFoundError):
+            hook.upload_progress(upload_id)
+        assert hook.finish_upload(upload_id) == key  # e.g. its receipt failed
+        hook.abort_upload(upload_id)  # Forgets it, keeping the image
+        assert os.listdir(tmp_path / ".uploads") == []
+        assert hook.fetch(key) == b"0123456789"
+        with pytest.raises(FileNotFoundError):
+            hook.finish_upload(upload_id)
+
+    def test_aborted_upload(self, tmp_path):
+        hook = FileSystemHook(str(tmp_path))
+        hook.initialize_storage()
+        upload_id = hook.begin_upload("image.png", 10)
+        hook.abort_upload(upload_id)
+        with pytest.raises(FileNotFoundError):
+            hook.stage_chunk(upload_id, 0, b"0")
+        with pytest.raises(FileNotFoundError):
+            hook.upload_progress("../../etc/passwd")
+
+
+class TestTieredHook:
+    @pytest.fixture
+    def hook(self) -> TieredHook:
+        hook = tiered()
+        hook.initialize_storage(clean=True)
+        return hook
+
+    def test_cache_hit(self, hook: TieredHook):
+        key = hook.save(b"image", "test.png")
+        hook.cold.replace(key, b"changed behind the cache")
+
+        assert hook.fetch(key) == b"image"
+        assert hook.hits == 1 and hook.misses == 0
+
+    def test_cache_miss(self, hook: TieredHook):
+        key = hook.cold.save(b"image", "test.png")
+
+        assert hook.fetch(key) == b"image"
+        assert hook.fetch(key) == b"image"
+        assert hook.hits == 1 and hook.misses == 1
+
+    def test_lru_demotion(self, hook: TieredHook):
+        hook.max_bytes = 10
+        first = hook.save(b"aaaa", "first.png")
+        second = hook.save(b"bbbb", "second.png")
+        hook.fetch(first)  # second is now least recently used
+        third = hook.save(b"cccc", "third.png")
+
+        assert set(hook._entries) == {first, third}
+        with pytest.raises(FileNotFoundError):
+            hook.hot.fetch(second)
+        assert hook.fetch(second) == b"bbbb"
+
+    def test_sweep(self, hook: TieredHook):
+        key = hook.save(b"image", "test.png")
+        hook.max_age = -1
+        hook.sweep()
+
+        assert key not in hook._entries
+        assert hook.fetch(key) == b"image"
+
+    def test_miss_overlapping_replace(self, hook: TieredHook, mocker):
+        key = hook.cold.save(b"old", "test.png")
+        cold_fetch = hook.cold.fetch
+
+        def fetch_then_replaced(location):
+            image = cold_fetch(location)
+            hook.replace(location, b"new")  # Before the miss caches what it read
+            return image
+
+        mocker.patch.object(hook.cold, "fetch", fetch_then_replaced)
+        assert hook.fetch(key) == b"old"
+        mocker.stopall()
+        assert hook.fetch(key) == b"new"
+        assert hook.hits == 1
+
+    def test_fetch_many_counts_once(self, hook: TieredHook):
+        cached = hook.save(b"cached", "cached.png")
+        cold = hook.cold.save(b"cold", "cold.png")
+        before = metrics.CACHE_REQUESTS.value("tiered", "hit")
+
+        assert hook.fetch_many([cached, cold]) == {cached: b"cached", cold: b"cold"}
+        assert (hook.hits, hook.misses) == (1, 1)
+        assert metrics.CACHE_REQUESTS.value("tiered", "hit") == before + 1
+
+
+class TestHookFactory:
+    def test_builtin_hooks(self):
+        assert isinstance(get_file_hook("FS"), FileSystemHook)
+        assert isinstance(get_meta_hook("SQLite3"), SQLite3)
+
+    def test_unknown_hook(self):
+        with pytest.raises(ValueError):
+            get_file_hook("Floppy")
+        with pytest.raises(ValueError):
+            get_meta_hook("Spreadsheet")
+
+    def test_entry_point(self, mocker):
+        entry_point = mocker.Mock()
+        entry_point.load.return_value = FileSystemHook
+        entry_points = mocker.patch(
+            "storage_hooks.hook_config_factory.entry_points",
+            return_value=[entry_point],
+        )
+        assert isinstance(get_file_hook("Plugin"), FileSystemHook)
+        entry_points.assert_called_once_with(
+            group="receipt_database.file_hooks", name="Plugin"
+        )
+
+    def test_no_eager_imports(self):
+        # Selecting the file system hook must not pull in boto3
+        code = (
+            "import sys, app; "
+            "from storage_hooks.hook_config_factory import get_file_hook; "
+            "get_file_hook('FS'); "
+            "assert 'boto3' not in sys.modules, 'boto3 imported'"
+        )
+        subprocess.run([sys.executable, "-c", code], check=True)
+
+
+class TestRemoteSQLReplicas:
+    @staticmethod
+    def database(path, tag_name: str) -> str:
+        url = f"sqlite:///{path}"
+        engine = create_engine(url)
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add(Tag(name=tag_name))
+            session.commit()
+        engine.dispose()
+        return url
+
+    @pytest.fixture
+    def hook(self, tmp_path, mocker) -> RemoteSQL:
+        config = ManualRemoteSQLConfig(
+            url=self.database(tmp_path / "primary.sqlite3", "primary"),
+            replicas=[
+                self.database(tmp_path / "replica1.sqlite3", "replica 1"),
+                self.database(tmp_path / "replica2.sqlite3", "replica 2"),
+            ],
+            sticky_seconds=0.2,
+        )
+        mocker.patch.object(CONFIG, "RemoteSQL", config)
+        return RemoteSQL()
+
+    def test_round_robin(self, hook):
+        names = [hook.fetch_tags()[0].name for _ in range(4)]
+        assert names == ["replica 1", "replica 2", "replica 1", "replica 2"]
+
+    def test_read_your_writes(self, hook):
+        hook.create_tag(Tag(name="new"))
+        assert [t.name for t in hook.fetch_tags()] == ["primary", "new"]
+        time.sleep(0.25)
+        assert hook.fetch_tags()[0].name.startswith("replica")
+
+    def test_replica_down(self, hook, tmp_path):
+        # SQLite cannot create a database in a missing directory
+        missing = create_engine(f"sqlite:///{tmp_path / 'missing' / 'r.sqlite3'}")
+        hook.router = ReplicaRouter(
+            hook.engine, [hook.router.replicas[0].engine, missing], 0, 30
+        )
+
+        assert {hook.fetch_tags()[0].name for _ in range(4)} == {"replica 1"}
+        assert hook.router.healthy_count() == 1
+
+    def test_replica_recovers(self, hook):
+        replica = hook.router.replicas[1]
+        hook.router.mark_down(replica)
+        assert {hook.fetch_tags()[0].name for _ in range(4)} == {"replica 1"}
+
+        replica.down_until = 1  # Retry time has passed, probe succeeds
+        assert {hook.fetch_tags()[0].name for _ in range(4)} == {
+            "replica 1",
+            "replica 2",
+        }
+        assert hook.router.healthy_count() == 2
+
+    def test_read_primary(self, hook):
+        with read_primary():
+            assert {hook.fetch_tags()[0].name for _ in range(2)} == {"primary"}
+        assert hook.fetch_tags()[0].name.startswith("replica")
+
+    def test_cached_lists_from_primary(self, hook, mocker):
+        from app import create_app
+
+        mocker.patch.object(CONFIG.Responses, "cache_lists", True)
+        client = create_app(file_system(), hook).test_client()
+        # Cached while the replicas lack the write, served from the cache after
+        client.post("/api/tag/", data={"name": "new"})
+        time.sleep(0.25)
+        for _ in range(2):
+            tags = [t["name"] for t in client.get("/api/tag/").json]
+            assert tags == ["primary", "new"]
+
+    def test_read_your_writes_per_client(self, hook, mocker):
+        from app import create_app
+
+        mocker.patch.object(CONFIG.Responses, "cache_lists", False)
+        mocker.patch.object(CONFIG.Server, "secret_key", "shared by the workers")
+        # Two workers, each with its own router
+        worker_a = create_app(file_system(), hook).test_client()
+        worker_b = create_app(file_system(), RemoteSQL()).test_client()
+
+        def tag_names(client, **kwargs) -> list[str]:
+            return [t["name"] for t in client.get("/api/tag/", **kwargs).json]
+
+        writer = worker_a.post("/api/tag/", data={"name": "new"})
+        last_write = {"Last-Write": writer.headers["Last-Write"]}
+        # The writer reads its write from either worker
+        assert tag_names(worker_a) == ["primary", "new"]  # Cookie
+        assert tag_names(worker_b, headers=last_write) == ["primary", "new"]
+        # Other clients keep reading from replicas, even on the writing worker
+        reader = create_app(file_system(), hook).test_client()
+        assert tag_names(reader)[0].startswith("replica")
+        assert tag_names(worker_b)[0].startswith("replica")
+        forged = {"Last-Write": f"{time.time():.3f}.{'0' * 32}"}
+        assert tag_names(worker_b, headers=forged)[0].startswith("replica")
+
+        time.sleep(0.25)
+        assert tag_names(worker_b, headers=last_write)[0].startswith("replica")
+
+
+class TestAWSS3Requests:
+    """Counts the S3 requests each operation costs, against moto's fake S3"""
+
+    @pytest.fixture
+    def hook(self, monkeypatch) -> AWSS3Hook:
+        moto = pytest.importorskip("moto")
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        with moto.mock_aws():
+            hook = AWSS3Hook()
+            hook.bucket_name = "request-count-bucket"
+            hook.initialize_storage()
+            yield hook
+
+    @staticmethod
+    def requests() -> float:
+        return sum(
+            metrics.S3_REQUESTS.value(operation, status)
+            for operation in ("PutObject", "GetObject", "HeadObject", "DeleteObject")
+            for status in ("200", "204", "404", "412")
+        )
+
+    def test_single_requests(self, hook):
+        before = self.requests()
+        key = hook.save(b"first", "image.png")
+        hook.replace(key, b"second")
+        assert hook.fetch(key) == b"second"
+        hook.delete(key)
+        assert self.requests() - before == 4
+
+    def test_missing(self, hook):
+        key = hook.save(b"first", "image.png")
+        hook.delete(key)
+        with pytest.raises(FileNotFoundError):
+            hook.fetch(key)
+        with pytest.raises(FileNotFoundError):
+            hook.replace(key, b"second")
+        with pytest.raises(FileNotFoundError):
+            hook.delete(key)
+
+    def test_changed_elsewhere(self, hook):
+        key = hook.save(b"first", "image.png")
+        hook.client.put_object(Bucket=hook.bucket_name, Key=key, Body=b"other")
+        hook.replace(key, b"second")  # Stale ETag, retried unconditionally
+        assert hook.fetch(key) == b"second"
+
+    def test_unknown_etag(self, hook):
+        key = hook.save(b"first", "image.png")
+        hook._etags.clear()  # e.g. saved by another worker
+        before = self.requests()
+        hook.delete(key)
+        assert self.requests() - before == 2  # HEAD, then DELETE
+        with pytest.raises(FileNotFoundError):
+            hook.fetch(key)
+
+    @pytest.mark.parametrize("content_addressed", [False, True])
+    def test_multipart_upload(self, hook, content_addressed):
+        hook.content_addressed = content_addressed
+        chunk_size = hook.upload_chunk_size
+        assert chunk_size >= 5 * 1024 * 1024
+        image = os.urandom(chunk_size) + b"end"
+        upload_id = hook.begin_upload("scan.png", len(image))
+
+        assert hook.stage_chunk(upload_id, chunk_size, b"end") == len(image)
+        assert hook.upload_progress(upload_id) == (0, len(image))
+        with pytest.raises(UploadOffsetError) as error:
+            hook.finish_upload(upload_id)
+        assert error.value.offset == 0
+        hook.stage_chunk(upload_id, 0, image[:chunk_size])
+        assert hook.upload_progress(upload_id) == (len(image), len(image))
+
+        key = hook.finish_upload(upload_id)
+        assert hook.fetch(key) == image
+        assert key.endswith(".png")
+        assert hook.finish_upload(upload_id) == key  # e.g. its receipt failed
+        hook.abort_upload(upload_id)  # Forgets it, keeping the image
+        assert hook.fetch(key) == image
+        if content_addressed:
+            assert key == f"{hashlib.sha256(image).hexdigest()}.png"
+            assert [k for k, _ in hook.iter_keys()] == [key]
+            listed = hook.client.list_objects_v2(Bucket=hook.bucket_name)
+            assert [obj["Key"] for obj in listed["Contents"]] == [key]
+            with pytest.raises(FileNotFoundError):
+                hook.finish_upload(upload_id)
+
+    def test_staging_not_listed(self, hook):
+        key = hook.save(b"image", "image.png")
+        hook.client.put_object(
+            Bucket=hook.bucket_name, Key=".uploads/in-flight.png", Body=b"image"
+        )
+        assert [k for k, _ in hook.iter_keys()] == [key]
+
+    def test_aborted_multipart_upload(self, hook):
+        upload_id = hook.begin_upload("scan.png", 10)
+        hook.abort_upload(upload_id)
+        with pytest.raises(FileNotFoundError):
+            hook.upload_progress(upload_id)
+        for invalid in ("not an upload", "ünïcode.ïd"):
+            with pytest.raises(InvalidUploadError):
+                hook.upload_progress(invalid)
+
+    def test_tampered_upload_id(self, hook):
+        upload_id = hook.begin_upload("scan.png", 10)
+        key, multipart_id, size = hook._decode_upload(upload_id)
+        data = json.dumps([key, multipart_id, size * 1000]).encode()
+        payload = base64.urlsafe_b64encode(data).decode().rstrip("=")
+        tampered = f"{payload}.{upload_id.rpartition('.')[2]}"
+        with pytest.raises(InvalidUploadError):
+            hook.upload_progress(tampered)
+        with pytest.raises(InvalidUploadError):
+            hook.stage_chunk(tampered, 0, b"0123456789")
+        assert hook.upload_progress(upload_id) == (0, 10)
+
+
+class TestAsyncS3Hook:
+    """Against a moto server, which aiobotocore reaches over HTTP"""
+
+    @pytest.fixture(scope="class")
+    @staticmethod
+    def endpoint():
+        pytest.importorskip("aiobotocore")
+        server = pytest.importorskip("moto.server").ThreadedMotoServer(port=0)
+        server.start()
+        host, port = server.get_host_and_port()
+        yield f"http://{host}:{port}"
+        server.stop()
+
+    @pytest.fixture
+    def hook(self, endpoint, monkeypatch, mocker):
+        from storage_hooks.async_s3 import AsyncS3Hook
+
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        config = dataclasses.replace(
+            CONFIG.AWSS3, endpoint_url=endpoint, async_concurrency=8
+        )
+        mocker.patch.object(CONFIG, "AWSS3", config)
+        hook = AsyncS3Hook()
+        hook.bucket_name = "async-bucket"
+        hook.initialize_storage(clean=True)
+        yield hook
+        hook.close()
+
+    def test_fetch_many(self, hook):
+        keys = [hook.save(str(i).encode(), f"{i}.png") for i in range(50)]
+        images = hook.fetch_many(keys + ["missing"])
+        assert images == {key: str(i).encode() for i, key in enumerate(keys)}
+        assert hook._semaphore._value == 8  # Every slot released
+
+    def test_delete_many(self, hook):
+        keys = [hook.save(str(i).encode(), f"{i}.png") for i in range(5)]
+        hook.delete_many(keys[:3])
+        assert sorted(hook.fetch_many(keys)) == sorted(keys[3:])
+
+    def test_save_deleted_meanwhile(self, hook, mocker):
+        hook.content_addressed = True
+        key = hook.save(b"image", "first.png")
+        request = hook._request
+
+        async def deleting_first(operation: str, **kwargs) -> dict:
+            if operation == "copy_object":  # By a concurrent request
+                await request("delete_object", Key=key)
+            return await request(operation, **kwargs)
+
+        mocker.patch.object(hook, "_request", side_effect=deleting_first)
+        assert hook.save(b"image", "second.png") == key
+        assert hook.fetch(key) == b"image"
+
+    def test_coroutines(self, hook):
+        async def main():
+            key = await hook.asave(b"first", "image.png")
+            await hook.areplace(key, b"second")
+            assert await hook.afetch(key) == b"second"
+            assert await hook.afetch_many([key]) == {key: b"second"}
+            await hook.adelete(key)
+            with pytest.raises(FileNotFoundError):
+                await hook.afetch(key)
+            with pytest.raises(FileNotFoundError):
+                await hook.adelete(key)
+
+        # From another event loop than the hook's own
+        asyncio.run(main())
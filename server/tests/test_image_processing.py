@@ -0,0 +1,158 @@
+import io
+import random
+import struct
+import zlib
+from io import BytesIO
+
+import pytest
+from flask import Flask
+
+from configure import CONFIG
+from image_processing import ImageOptimizer, optimize_image
+from storage_hooks.file_system import FileSystemHook
+from tests.temp_hooks import MemorySQLite3, file_system
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def make_image(size: tuple[int, int], format_: str, orientation: int = 1) -> bytes:
+    image = Image.new("RGB", size, "white")
+    exif = Image.Exif()
+    exif[0x0112] = orientation  # Orientation
+    exif[0x010F] = "Test Camera"  # Make
+    out = BytesIO()
+    image.save(out, format_, exif=exif)
+    return out.getvalue()
+
+
+def compressed_jpeg() -> bytes:
+    """Noise saved at a low quality, which re-encoding only makes larger"""
+    rng = random.Random(0)
+    image = Image.frombytes("RGB", (200, 200), rng.randbytes(200 * 200 * 3))
+    out = BytesIO()
+    image.save(out, "JPEG", quality=30)
+    return out.getvalue()
+
+
+def truncated_jpeg() -> bytes:
+    image = make_image((400, 300), "JPEG")
+    return image[: len(image) // 2]
+
+
+def png_bomb() -> bytes:
+    """A PNG header claiming far more pixels than Pillow will decode"""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    header = struct.pack(">IIBBBBB", 100_000, 100_000, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IEND", b"")
+
+
+def test_optimize_image():
+    original = make_image((4000, 3000), "JPEG", orientation=6)  # Rotated 90°
+
+    optimized = optimize_image(original, 1000, "WEBP", 80)
+
+    with Image.open(BytesIO(optimized)) as image:
+        assert image.format == "WEBP"
+        assert image.size == (750, 1000)  # Downsized and upright
+        assert not image.getexif()
+
+
+def test_optimize_small_png():
+    original = make_image((100, 50), "PNG")
+
+    optimized = optimize_image(original, 1000, "PNG", 80)
+
+    with Image.open(BytesIO(optimized)) as image:
+        assert image.format == "PNG"
+        assert image.size == (100, 50)  # Never enlarged
+
+
+def test_optimize_not_an_image():
+    assert optimize_image(b"%PDF-1.4", 1000, "WEBP", 80) is None
+
+
+@pytest.mark.parametrize("image", [truncated_jpeg(), png_bomb()])
+def test_optimize_unreadable_image(image):
+    assert optimize_image(image, 1000, "WEBP", 80) is None
+
+
+@pytest.mark.parametrize(
+    "image, filename",
+    [
+        (truncated_jpeg(), "scan.jpg"),
+        (png_bomb(), "bomb.png"),
+        (compressed_jpeg(), "small.jpg"),  # Readable, but would grow
+    ],
+)
+def test_upload_stored_unchanged(mocker, image, filename):
+    from app import create_app
+
+    mocker.patch.object(CONFIG.Ingest, "optimize", True)
+    meta_hook = MemorySQLite3()
+    meta_hook.initialize_storage()
+    app: Flask = create_app(file_system(), meta_hook)
+    client = app.test_client()
+    try:
+        response = client.post(
+            "/api/receipt/", data={"file": (io.BytesIO(image), filename)}
+        )
+        assert response.status_code == 200
+        receipt_id = response.json["id"]
+        stored = client.get(f"/api/receipt/{receipt_id}/image").data
+        assert stored == image  # Stored unchanged
+    finally:
+        app.extensions["receipt_database"]["optimizer"].shutdown()
+
+
+def test_optimize_resumable_upload(mocker, tmp_path):
+    from app import create_app
+
+    mocker.patch.object(CONFIG.Ingest, "optimize", True)
+    mocker.patch.object(CONFIG.Ingest, "keep_original", False)
+    image = make_image((4000, 3000), "JPEG")
+    mocker.patch.object(CONFIG.Uploads, "chunk_bytes", len(image))
+    meta_hook = MemorySQLite3()
+    meta_hook.initialize_storage()
+    file_hook = FileSystemHook(str(tmp_path))
+    app: Flask = create_app(file_hook, meta_hook)
+    client = app.test_client()
+    try:
+        location = client.post(
+            "/api/upload/", data={"filename": "scan.jpg", "size": len(image)}
+        ).headers["Location"]
+        client.patch(location, data=image, headers={"Upload-Offset": "0"})
+        with client.post(f"{location}/complete") as response:
+            receipt = response.json
+        assert receipt["storage_key"].endswith(".webp")
+        # The staged original is deleted once the receipt is committed
+        assert [key for key, _ in file_hook.iter_keys()] == [receipt["storage_key"]]
+    finally:
+        app.extensions["receipt_database"]["optimizer"].shutdown()
+
+
+def test_image_optimizer():
+    optimizer = ImageOptimizer()
+    try:
+        optimized, filename = optimizer.optimize(
+            make_image((10, 10), "PNG"), "IMG_0001.png"
+        )
+    finally:
+        optimizer.shutdown()
+
+    assert filename == "IMG_0001.webp"
+    with Image.open(BytesIO(optimized)) as image:
+        assert image.format == "WEBP"
+
+
+def test_image_optimizer_keeps_smaller_original():
+    original = compressed_jpeg()
+    assert len(optimize_image(original, 1000, "WEBP", 80)) > len(original)
+    optimizer = ImageOptimizer()
+    try:
+        assert optimizer.optimize(original, "small.jpg") is None
+    finally:
+        optimizer.shutdown()
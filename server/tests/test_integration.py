@@ -4,6 +4,7 @@ from typing import Any, List, cast
 import pytest
 from flask import Flask
 from flask.testing import FlaskClient
+from sqlalchemy import event
 from werkzeug.datastructures import MultiDict
 
 from receipt import Receipt, Tag
@@ -256,6 +257,49 @@ def test_fetch_receipt_keys(
     assert j[2]["storage_key"] == receipt3.storage_key
 
 
+def test_fetch_receipt_keys_query_count(
+    tags_db: List[Tag], db_hook: DatabaseHook, client: FlaskClient
+):
+    for i in range(5):
+        db_hook.create_receipt(Receipt(name=f"{i}", storage_key=f"{i}", tags=tags_db))
+
+    response = client.get("/api/receipt/")
+
+    # One statement for the receipts and their tag ids, not one per row
+    assert 'desc="1 queries"' in response.headers["Server-Timing"]
+
+
+def test_upload_receipt_connections(
+    tags_db: List[Tag], db_hook: DatabaseHook, client: FlaskClient
+):
+    checkouts = []
+    event.listen(db_hook.engine, "checkout", lambda *_: checkouts.append(None))
+    data = MultiDict([("name", "One"), ("tag", tags_db[0].id), ("tag", tags_db[1].id)])
+    data["file"] = (io.BytesIO(b"image"), "image.png")
+
+    response = client.post("/api/receipt/", data=data)
+
+    assert response.status_code == 200
+    assert len(checkouts) == 1  # fetch_tags, create_receipt and fetch_receipt
+    assert db_hook.fetch_receipt(cast(Any, response.json)["id"]).name == "One"
+
+
+def test_failed_request_rolls_back(
+    receipt_tag_db: Receipt, db_hook: DatabaseHook, client: FlaskClient, mocker
+):
+    mocker.patch.object(
+        type(client.application.extensions["receipt_database"]["file_hook"]),
+        "replace",
+        side_effect=OSError("disk full"),
+    )
+    data = {"name": "Renamed", "file": (io.BytesIO(b"new image"), "image.png")}
+
+    with pytest.raises(OSError):
+        client.put(f"/api/receipt/{receipt_tag_db.id}", data=data)
+
+    assert db_hook.fetch_receipt(receipt_tag_db.id).name == "Test"
+
+
 def test_delete_receipt(
     receipt_tag_db: Receipt,
     db_hook: DatabaseHook,
@@ -277,6 +321,34 @@ def test_delete_receipt_none(
     assert response.status_code == 404
 
 
+def test_delete_shared_image(
+    app: Flask, db_hook: DatabaseHook, file_hook: FileHook, client: FlaskClient
+):
+    file_hook.content_addressed = True
+    app.extensions["receipt_database"]["deferred_deletes"].delay = 0
+    with open("./tests/test_image1.png", "rb") as file:
+        test_data = file.read()
+
+    ids = []
+    for _ in range(2):
+        response = client.post(
+            "/api/receipt/",
+            data={"file": (io.BytesIO(test_data), "test_image1.png")},
+            content_type="multipart/form-data",
+        )
+        ids.append(cast(Any, response.json)["id"])
+        storage_key = cast(Any, response.json)["storage_key"]
+
+    assert db_hook.count_references(storage_key) == 2
+
+    assert client.delete(f"/api/receipt/{ids[0]}").status_code == 204
+    assert file_hook.fetch(storage_key) == test_data
+
+    assert client.delete(f"/api/receipt/{ids[1]}").status_code == 204
+    with pytest.raises(FileNotFoundError):
+        file_hook.fetch(storage_key)
+
+
 def test_upload_tag(db_hook: DatabaseHook, client: FlaskClient):
     tag_name = "test_tag"
     response = client.post(
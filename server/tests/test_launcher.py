@@ -0,0 +1,92 @@
+import os
+
+import pytest
+from sqlalchemy import text
+
+import metrics
+from configure import CONFIG
+from temp_hooks import sqlite3
+
+pytest.importorskip("gunicorn")
+
+from launcher import Launcher, cpu_count  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def single_process_metrics(monkeypatch):
+    # Launchers with several workers share metrics, which must not outlive a test
+    monkeypatch.setattr(metrics, "_multiprocess_dir", None)
+
+
+def test_settings_from_config(mocker):
+    mocker.patch.object(CONFIG.Server, "workers", 3)
+    mocker.patch.object(CONFIG.Server, "threads", 1)
+    launcher = Launcher()
+    assert launcher.cfg.workers == 3
+    assert launcher.cfg.threads == 1
+    assert launcher.cfg.worker_class_str == "sync"
+    assert launcher.cfg.preload_app
+
+
+def test_options_override_config(mocker):
+    mocker.patch.object(CONFIG.Server, "workers", None)
+    launcher = Launcher({"bind": "0.0.0.0:9000", "workers": None})
+    assert launcher.cfg.bind == ["0.0.0.0:9000"]
+    assert launcher.cfg.workers == cpu_count()
+    assert launcher.cfg.worker_class_str == "gthread"
+
+
+def test_shared_metrics(mocker, tmp_path):
+    mocker.patch.object(CONFIG.Server, "workers", 3)
+    mocker.patch.object(CONFIG.Metrics, "multiprocess_dir", str(tmp_path))
+    (tmp_path / "1-stale.json").write_text("{}")  # From an earlier run
+    Launcher()
+    assert metrics._multiprocess_dir == str(tmp_path)
+    assert not (tmp_path / "1-stale.json").exists()
+
+
+def test_unshared_metrics_warning(mocker):
+    mocker.patch.object(CONFIG.Server, "workers", 3)
+    mocker.patch.object(CONFIG.Metrics, "multiprocess", False)
+    warning = mocker.patch("launcher.LOGGER.warning")
+    Launcher()
+    assert metrics._multiprocess_dir is None
+    assert any("Metrics.multiprocess" in call.args[0] for call in warning.mock_calls)
+
+
+@pytest.mark.parametrize(
+    "workers, broker, expected",
+    [(1, None, None), (3, None, "Changes"), (3, "Local", "Changes"), (3, "X", "X")],
+)
+def test_shared_events(mocker, workers, broker, expected):
+    mocker.patch.object(CONFIG.Server, "workers", workers)
+    mocker.patch.object(CONFIG.Events, "broker", broker)
+    Launcher()
+    assert CONFIG.Events.broker == expected
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Requires fork")
+def test_database_after_fork():
+    hook = sqlite3()
+    hook.initialize_storage()
+    with hook.engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    parent_pool = hook.engine.pool
+
+    pid = os.fork()
+    if pid == 0:  # Child, must exit without returning to pytest
+        code = 1
+        try:
+            hook.after_fork()
+            if hook.engine.pool is not parent_pool:
+                with hook.engine.connect() as conn:
+                    conn.execute(text("SELECT 1"))
+                code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    # The parent's pool is untouched
+    assert hook.engine.pool is parent_pool
+    with hook.engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
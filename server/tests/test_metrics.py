@@ -0,0 +1,114 @@
+import glob
+import os
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch) -> list:
+    registry = []
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    return registry
+
+
+def test_counter(registry):
+    counter = metrics.Counter("requests_total", "Requests", ("route",))
+    counter.inc("/a")
+    counter.inc("/a", amount=2)
+    counter.inc('/"b"')
+
+    assert counter.value("/a") == 3
+    assert metrics.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{route="/a"} 3\n'
+        'requests_total{route="/\\"b\\""} 1\n'
+    )
+
+
+def test_histogram(registry):
+    histogram = metrics.Histogram("latency", "Latency", ("op",), buckets=(0.1, 1))
+    histogram.observe(0.05, "fetch")
+    histogram.observe(0.5, "fetch")
+    histogram.observe(5, "fetch")
+
+    assert histogram.count("fetch") == 3
+    assert metrics.render().splitlines()[2:] == [
+        'latency_bucket{op="fetch",le="0.1"} 1',
+        'latency_bucket{op="fetch",le="1"} 2',
+        'latency_bucket{op="fetch",le="+Inf"} 3',
+        'latency_sum{op="fetch"} 5.55',
+        'latency_count{op="fetch"} 3',
+    ]
+
+
+def test_timed(registry, monkeypatch):
+    latency = metrics.Histogram("latency", "Latency", ("hook", "operation"))
+    errors = metrics.Counter("errors", "Errors", ("hook", "operation", "error"))
+    monkeypatch.setattr(metrics, "HOOK_LATENCY", latency)
+    monkeypatch.setattr(metrics, "HOOK_ERRORS", errors)
+
+    class Hook:
+        def fetch(self, location):
+            if location is None:
+                raise FileNotFoundError
+            return location
+
+    metrics.instrument(Hook, ["fetch"])
+    hook = Hook()
+    assert hook.fetch("key") == "key"
+    with pytest.raises(FileNotFoundError):
+        hook.fetch(None)
+
+    assert latency.count("Hook", "fetch") == 2
+    assert errors.value("Hook", "fetch", "FileNotFoundError") == 1
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Requires fork")
+def test_multiprocess(registry, monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "_multiprocess_dir", None)
+    metrics.enable_multiprocess(str(tmp_path))
+    counter = metrics.Counter("requests_total", "Requests", ("route",))
+    histogram = metrics.Histogram("latency", "Latency", buckets=(1,))
+    gauge = metrics.Gauge("open", "Open")
+    counter.inc("/a", amount=2)
+    histogram.observe(0.5)
+    gauge.set(value=1)
+
+    pid = os.fork()
+    if pid == 0:  # Child, must exit without returning to pytest
+        code = 1
+        try:
+            if counter.value("/a") == 0:  # Counted by the parent
+                counter.inc("/a")
+                counter.inc("/b")
+                histogram.observe(2)
+                gauge.set(value=5)
+                metrics.flush()
+                code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+    def check():
+        lines = metrics.render().splitlines()
+        assert 'requests_total{route="/a"} 3' in lines
+        assert 'requests_total{route="/b"} 1' in lines
+        assert 'latency_bucket{le="1"} 1' in lines
+        assert "latency_count 2" in lines
+        # Gauges are per process, and the child has exited
+        assert [line for line in lines if line.startswith("open")] == [
+            f'open{{pid="{os.getpid()}"}} 1'
+        ]
+
+    check()
+    assert len(glob.glob(str(tmp_path / f"{pid}-*.json"))) == 1
+    metrics.process_exited(pid)
+    assert glob.glob(str(tmp_path / f"{pid}-*.json")) == []
+    assert (tmp_path / metrics.EXITED_SNAPSHOT).exists()
+    check()  # Kept once folded, and not counted twice
+    metrics.process_exited(pid)
+    check()
@@ -0,0 +1,149 @@
+import datetime as dt
+import os
+import time
+
+import pytest
+
+from reconcile import DeferredDeletes, PeriodicReconcile, fcntl, reconcile
+from receipt import Receipt
+from storage_hooks.file_system import FileSystemHook
+from temp_hooks import MemorySQLite3
+
+UTC = dt.timezone.utc
+OLD = time.time() - 2 * 60 * 60
+
+
+@pytest.fixture
+def meta_hook() -> MemorySQLite3:
+    hook = MemorySQLite3()
+    hook.engine.echo = False
+    hook.initialize_storage()
+    return hook
+
+
+@pytest.fixture
+def file_hook(tmp_path) -> FileSystemHook:
+    return FileSystemHook(str(tmp_path))
+
+
+def save_old(file_hook: FileSystemHook, name: str) -> str:
+    key = file_hook.save(name.encode(), name)
+    os.utime(file_hook._path(key), (OLD, OLD))
+    return key
+
+
+@pytest.fixture
+def keys(meta_hook, file_hook) -> dict[str, str]:
+    keys = {
+        "used": save_old(file_hook, "used.png"),
+        "original": save_old(file_hook, "original.png"),
+        "orphan": save_old(file_hook, "orphan.png"),
+        "new orphan": file_hook.save(b"new", "new.png"),
+    }
+    old_upload = dt.datetime.fromtimestamp(OLD, UTC)
+    meta_hook.create_receipt(
+        Receipt(
+            storage_key=keys["used"],
+            original_key=keys["original"],
+            upload_dt=old_upload,
+        )
+    )
+    meta_hook.create_receipt(Receipt(storage_key="gone.png", upload_dt=old_upload))
+    meta_hook.create_receipt(Receipt(storage_key="uploading.png"))
+    return keys
+
+
+def test_report(meta_hook, file_hook, keys):
+    report = reconcile(meta_hook, file_hook, batch_size=2)
+    assert report.images == 4
+    assert report.orphans == 1
+    assert report.orphan_sample == [keys["orphan"]]
+    assert report.deleted == 0
+    assert report.dangling == 1
+    assert report.dangling_sample == ["gone.png"]
+    assert file_hook.fetch(keys["orphan"])
+
+
+def test_delete(meta_hook, file_hook, keys):
+    report = reconcile(meta_hook, file_hook, delete=True, batch_size=2)
+    assert report.deleted == 1
+    with pytest.raises(FileNotFoundError):
+        file_hook.fetch(keys["orphan"])
+    for name in ("used", "original", "new orphan"):
+        assert file_hook.fetch(keys[name])
+
+
+def test_delete_rechecks_references(meta_hook, file_hook, keys, mocker):
+    # The orphan gains a receipt after the keys were compared
+    mocker.patch.object(meta_hook, "referenced_keys", return_value={keys["orphan"]})
+    report = reconcile(meta_hook, file_hook, delete=True)
+    assert report.orphans == 1
+    assert report.deleted == 0
+    assert file_hook.fetch(keys["orphan"])
+
+
+def test_saving_again_touches(meta_hook, file_hook):
+    file_hook.content_addressed = True
+    key = save_old(file_hook, "orphan.png")
+    assert file_hook.save(b"orphan.png", "again.png") == key
+    # The new upload's receipt may not exist yet
+    assert reconcile(meta_hook, file_hook, delete=True).orphans == 0
+
+
+class TestDeferredDeletes:
+    @pytest.fixture
+    def deletes(self, meta_hook, file_hook) -> DeferredDeletes:
+        file_hook.content_addressed = True
+        return DeferredDeletes(meta_hook, file_hook, delay=60)
+
+    def test_deleted_after_delay(self, deletes, file_hook):
+        key = save_old(file_hook, "image.png")
+        deletes.add(key)
+        assert deletes.run_due() == 0
+        assert deletes.run_due(time.monotonic() + 61) == 1
+        with pytest.raises(FileNotFoundError):
+            file_hook.fetch(key)
+
+    def test_referenced_again(self, deletes, meta_hook, file_hook):
+        key = save_old(file_hook, "image.png")
+        deletes.add(key)
+        meta_hook.create_receipt(Receipt(storage_key=key))
+        assert deletes.run_due(float("inf")) == 0
+        assert file_hook.fetch(key)
+
+    def test_saved_again(self, deletes, file_hook):
+        key = save_old(file_hook, "image.png")
+        deletes.add(key)
+        # An upload of the same image, whose receipt is not committed yet
+        assert file_hook.save(b"image.png", "again.png") == key
+        assert deletes.run_due(float("inf")) == 0
+        assert file_hook.fetch(key)
+
+
+class TestPeriodicReconcile:
+    @pytest.fixture
+    def periodic(self, meta_hook, file_hook, tmp_path) -> PeriodicReconcile:
+        lock_path = str(tmp_path / "reconcile.lock")
+        return PeriodicReconcile(meta_hook, file_hook, 60, lock_path, delete=True)
+
+    def test_runs_once_per_interval(self, periodic, file_hook, keys):
+        now = time.time()
+        assert periodic.run_if_due(now).deleted == 1
+        with pytest.raises(FileNotFoundError):
+            file_hook.fetch(keys["orphan"])
+        # Another process sharing the lock file
+        other = PeriodicReconcile(periodic.meta_hook, file_hook, 60, periodic.lock_path)
+        assert other.run_if_due(now + 30) is None
+        assert other.run_if_due(now + 61).orphans == 0
+
+    @pytest.mark.skipif(fcntl is None, reason="Needs file locks")
+    def test_running_elsewhere(self, periodic):
+        with open(periodic.lock_path, "w") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            assert periodic.run_if_due() is None
+        assert periodic.run_if_due() is not None
+
+    def test_disabled(self, periodic):
+        periodic.interval = 0
+        periodic.start()
+        assert periodic._thread is None
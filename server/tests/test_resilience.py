@@ -0,0 +1,140 @@
+import io
+import threading
+import time
+
+import pytest
+
+import metrics
+import resilience
+from resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Guard,
+    HookTimeoutError,
+    LatencyTracker,
+)
+from tests.temp_hooks import MemorySQLite3, file_system
+
+
+def fail():
+    raise ConnectionError("backend down")
+
+
+class TestCircuitBreaker:
+    @pytest.fixture
+    def guard(self) -> Guard:
+        return Guard("test", CircuitBreaker("test", 3, reset_seconds=0.05))
+
+    def test_opens_after_failures(self, guard):
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                guard.call(fail)
+        assert guard.breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError) as error:
+            guard.call(lambda: "not called")
+        assert error.value.retry_after >= 1
+
+    def test_expected_errors_are_not_failures(self, guard):
+        def missing():
+            raise FileNotFoundError
+
+        for _ in range(5):
+            with pytest.raises(FileNotFoundError):
+                guard.call(missing)
+        assert guard.breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_trial(self, guard):
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                guard.call(fail)
+        time.sleep(0.06)
+        assert guard.breaker.state == CircuitBreaker.HALF_OPEN
+        # A failed trial opens the circuit again straight away
+        with pytest.raises(ConnectionError):
+            guard.call(fail)
+        assert guard.breaker.state == CircuitBreaker.OPEN
+        time.sleep(0.06)
+        assert guard.call(lambda: "ok") == "ok"
+        assert guard.breaker.state == CircuitBreaker.CLOSED
+
+    def test_single_trial(self, guard):
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                guard.call(fail)
+        time.sleep(0.06)
+        release = threading.Event()
+        trial = threading.Thread(target=guard.call, args=(release.wait,))
+        trial.start()
+        time.sleep(0.01)
+        with pytest.raises(CircuitOpenError):
+            guard.call(lambda: "not called")
+        release.set()
+        trial.join()
+        assert guard.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_timeout():
+    guard = Guard("slow", CircuitBreaker("slow", 1, 30), timeout=0.05)
+    before = metrics.HOOK_TIMEOUTS.value("slow")
+    with pytest.raises(HookTimeoutError):
+        guard.call(time.sleep, 0.5)
+    assert metrics.HOOK_TIMEOUTS.value("slow") == before + 1
+    assert guard.breaker.state == CircuitBreaker.OPEN
+
+
+def test_latency_percentile():
+    tracker = LatencyTracker(size=100, min_samples=10)
+    for i in range(9):
+        tracker.add(i)
+    assert tracker.percentile(95) is None
+    for i in range(9, 200):
+        tracker.add(i)
+    assert tracker.percentile(50) == 150  # Only the last 100 are kept
+
+
+def test_hedged_read():
+    guard = Guard(
+        "hedged", CircuitBreaker("hedged", 3, 30), hedge_percentile=95, timeout=5
+    )
+    for _ in range(20):
+        guard.latencies.add(0.001)
+    calls = []
+
+    def fetch():
+        calls.append(None)
+        if len(calls) == 1:
+            time.sleep(1)  # The first request is stuck, the duplicate is not
+            return "slow"
+        return "fast"
+
+    before = metrics.HEDGED_REQUESTS.value("hedged", "won")
+    start = time.perf_counter()
+    assert guard.call(fetch, hedge=True) == "fast"
+    assert time.perf_counter() - start < 0.5
+    assert metrics.HEDGED_REQUESTS.value("hedged", "won") == before + 1
+
+
+def test_protected_hook():
+    hook = file_system()
+    guard = Guard("FileSystemHook", CircuitBreaker("FileSystemHook", 1, 30))
+    resilience.protect(hook, guard)
+    key = hook.save(b"image", "image.png")
+    assert hook.fetch(key) == b"image"
+    guard.breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        hook.fetch(key)
+
+
+def test_circuit_open_response():
+    from app import create_app
+
+    file_hook = file_system()
+    app = create_app(file_hook, MemorySQLite3())
+    for _ in range(file_hook.guard.breaker.failure_threshold):
+        file_hook.guard.breaker.record_failure()
+    response = app.test_client().post(
+        "/api/receipt/", data={"file": (io.BytesIO(b"x"), "x.png")}
+    )
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert "circuit_breaker_state" in metrics.render()
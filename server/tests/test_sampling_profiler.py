@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+from flask.testing import FlaskClient
+
+from configure import CONFIG
+from sampling_profiler import SamplingProfiler
+from tests.temp_hooks import MemorySQLite3, file_system
+
+
+def busy_wait(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_sampling_profiler():
+    worker = threading.Thread(target=busy_wait, args=(0.2,))
+    with SamplingProfiler(0.001) as profiler:
+        worker.start()
+        worker.join()
+
+    lines = profiler.folded().splitlines()
+    assert any("busy_wait (test_sampling_profiler.py:" in line for line in lines)
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+
+
+def test_sampling_profiler_thread_filter():
+    with SamplingProfiler(0.001, [threading.get_ident()]) as profiler:
+        busy_wait(0.05)
+
+    assert all("test_sampling_profiler_thread_filter" in s for s in profiler.samples)
+
+
+@pytest.fixture
+def client(monkeypatch) -> FlaskClient:
+    from app import create_app
+
+    monkeypatch.setattr(CONFIG.Profiling, "sampling_token", "secret")
+    return create_app(file_system(), MemorySQLite3()).test_client()
+
+
+def test_profile_endpoint(client: FlaskClient):
+    assert client.get("/debug/profile?seconds=0.01").status_code == 401
+    assert (
+        client.get(
+            "/debug/profile?seconds=0.01", headers={"Authorization": "Bearer wrong"}
+        ).status_code
+        == 401
+    )
+
+    response = client.get(
+        "/debug/profile?seconds=0.05", headers={"Authorization": "Bearer secret"}
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+
+
+def test_profile_request(client: FlaskClient):
+    response = client.get("/metrics", headers={"X-Profile": "secret"})
+    profile_id = response.headers["X-Profile-Id"]
+
+    assert client.get(f"/debug/profile/{profile_id}").status_code == 401
+    response = client.get(
+        f"/debug/profile/{profile_id}", headers={"Authorization": "Bearer secret"}
+    )
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in client.get("/metrics").headers
@@ -0,0 +1,85 @@
+import struct
+import zlib
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import synthetic
+from receipt import Receipt, Tag, receipt_tag
+from storage_hooks.file_system import FileSystemHook
+from temp_hooks import MemorySQLite3
+
+
+@pytest.fixture
+def meta_hook() -> MemorySQLite3:
+    hook = MemorySQLite3()
+    hook.engine.echo = False
+    hook.initialize_storage()
+    return hook
+
+
+@pytest.fixture
+def file_hook(tmp_path) -> FileSystemHook:
+    return FileSystemHook(str(tmp_path))
+
+
+def test_placeholder_png():
+    image = synthetic.placeholder_png(42)
+    assert image.startswith(b"\x89PNG\r\n\x1a\n")
+    assert image != synthetic.placeholder_png(43)
+
+    # Walk the chunks, checking lengths and CRCs
+    offset = 8
+    kinds = []
+    while offset < len(image):
+        (length,) = struct.unpack(">I", image[offset : offset + 4])
+        body = image[offset + 4 : offset + 8 + length]
+        (crc,) = struct.unpack(">I", image[offset + 8 + length : offset + 12 + length])
+        assert zlib.crc32(body) == crc
+        kinds.append(body[:4])
+        offset += 12 + length
+    assert kinds == [b"IHDR", b"tEXt", b"IDAT", b"IEND"]
+
+
+def test_generate(meta_hook, file_hook):
+    ids = synthetic.generate(meta_hook, file_hook, 250, batch_size=100, years=2)
+    assert ids == list(range(1, 251))
+
+    with Session(meta_hook.engine) as session:
+        assert session.scalar(select(func.count(Receipt.id))) == 250
+        assert session.scalar(select(func.count(Tag.id))) == len(synthetic.TAG_NAMES)
+        assert session.scalar(select(func.count()).select_from(receipt_tag)) > 250
+        oldest, newest = session.execute(
+            select(func.min(Receipt.upload_dt), func.max(Receipt.upload_dt))
+        ).one()
+        assert (newest - oldest).days > 365
+        keys = session.scalars(select(Receipt.storage_key)).all()
+
+    assert len(set(keys)) == 250
+    assert file_hook.fetch(keys[0]).startswith(b"\x89PNG")
+
+    # A second run appends and reuses the existing tags
+    more = synthetic.generate(meta_hook, file_hook, 10, images=1)
+    assert more == list(range(251, 261))
+    # Ids were assigned by the database, so its next insert follows them
+    receipt = meta_hook.create_receipt(Receipt(storage_key="manual.png"))
+    assert receipt.id == 261
+    with Session(meta_hook.engine) as session:
+        assert session.scalar(select(func.count(Tag.id))) == len(synthetic.TAG_NAMES)
+        shared = session.scalars(
+            select(Receipt.storage_key).where(Receipt.id.in_(more))
+        ).all()
+    assert len(set(shared)) == 1
+
+
+def test_generate_is_reproducible(file_hook):
+    names = []
+    for _ in range(2):
+        meta_hook = MemorySQLite3()
+        meta_hook.engine.echo = False
+        meta_hook.initialize_storage()
+        synthetic.generate(meta_hook, file_hook, 50, seed=7)
+        with Session(meta_hook.engine) as session:
+            names.append(session.scalars(select(Receipt.name)).all())
+    assert names[0] == names[1]